@@ -0,0 +1,106 @@
+"""Throughput benchmark: per-request generate threads vs the batch scheduler.
+
+Drives `GLMOCR.process_image_stream` from 1, 4 and 16 concurrent clients and
+reports mean/p95 latency, mean TTFT and aggregate decode throughput for both
+the legacy path (`max_batch_size=0`, one `model.generate` thread per request)
+and the continuous batching scheduler.
+
+Runs on CPU against a tiny randomly initialised model by default:
+
+    python -m bench.batching
+    python -m bench.batching --model zai-org/GLM-OCR --device auto
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+import torch
+
+from glm import GLMOCR
+from bench.tiny_model import build_tiny_model
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGES = [
+    (os.path.join(ROOT, "test_images", "hand_written_table.jpg"), "table"),
+    (os.path.join(ROOT, "test_images", "test_text.PNG"), "text"),
+]
+
+
+def run_clients(ocr, clients, requests_per_client):
+    results = []
+    lock = threading.Lock()
+
+    def client(index):
+        for n in range(requests_per_client):
+            image_path, mode = IMAGES[(index + n) % len(IMAGES)]
+            start = time.perf_counter()
+            first = None
+            text = ""
+            for chunk in ocr.process_image_stream(image_path, type=mode):
+                if first is None:
+                    first = time.perf_counter()
+                text += chunk
+            end = time.perf_counter()
+            tokens = len(ocr.processor.tokenizer(text).input_ids)
+            with lock:
+                results.append((end - start, (first or end) - start, tokens))
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    wall_start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - wall_start
+
+    latencies = sorted(r[0] for r in results)
+    return {
+        "requests": len(results),
+        "mean_latency": statistics.mean(latencies),
+        "p95_latency": latencies[max(0, int(round(0.95 * len(latencies))) - 1)],
+        "mean_ttft": statistics.mean(r[1] for r in results),
+        "throughput": sum(r[2] for r in results) / wall,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", help="Model path; defaults to a freshly built tiny model")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests-per-client", type=int, default=2)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--threads", type=int, help="torch.set_num_threads for the run")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path = args.model or build_tiny_model(os.path.join(tmp, "tiny-glm-ocr"))
+        print(f"{'mode':<10}{'clients':>8}{'reqs':>6}{'mean lat':>10}{'p95 lat':>10}{'ttft':>9}{'tok/s':>10}")
+        for label, batch_size in (("generate", 0), ("batched", args.max_batch_size)):
+            ocr = GLMOCR(model_path, device=args.device, max_batch_size=batch_size, max_new_tokens=args.max_new_tokens)
+            # Warm-up so neither mode pays one-off allocator/kernel costs
+            with contextlib.redirect_stdout(io.StringIO()):
+                run_clients(ocr, 1, 1)
+            for clients in args.clients:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    stats = run_clients(ocr, clients, args.requests_per_client)
+                print(
+                    f"{label:<10}{clients:>8}{stats['requests']:>6}"
+                    f"{stats['mean_latency']:>9.2f}s{stats['p95_latency']:>9.2f}s"
+                    f"{stats['mean_ttft']:>8.2f}s{stats['throughput']:>10.1f}"
+                )
+            ocr.close()
+            del ocr
+
+
+if __name__ == "__main__":
+    main()
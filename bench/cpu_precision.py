@@ -0,0 +1,134 @@
+"""CPU inference at each weight precision against the unquantised baseline.
+
+Loads the model once per `--precisions` entry (`auto` is the checkpoint's
+own dtype, `fp32`, `bf16` where the CPU has native kernels, `int8` dynamic
+quantisation of the language model) and streams every
+`test_images/<name>.*` with a `<name>_expected.*` reference through it, one
+request at a time. Reports per precision and image: time to first token,
+decode tokens/s (both as measured by the generation loop), character error
+rate against the reference, the size of the weights in memory and the peak
+resident memory growth during the request, plus each precision's speed-up
+over the first one listed.
+
+The default tiny random model is too small for int8 to pay off and only
+checks that every path runs; use the real checkpoint for numbers:
+
+    python -m bench.cpu_precision
+    python -m bench.cpu_precision --model zai-org/GLM-OCR --threads 16 --output cpu.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import statistics
+import tempfile
+
+import torch
+
+import metrics
+from glm import GLMOCR, CPU_PRECISIONS, bf16_supported, set_cpu_threads
+from bench.image_budget import character_error_rate, find_cases, normalize, peak_memory, read_expected
+from bench.tiny_model import build_tiny_model
+
+COMMENT = re.compile(r"<!--.*?-->", re.S)
+CPU = torch.device("cpu")
+
+
+def weight_bytes(model):
+    """Bytes held by parameters and buffers, int8 packed weights included."""
+    total = 0
+    for value in model.state_dict().values():
+        # Dynamically quantised layers store (weight, bias) as one packed entry
+        for tensor in value if isinstance(value, tuple) else (value,):
+            if isinstance(tensor, torch.Tensor):
+                total += tensor.nelement() * tensor.element_size()
+    return total
+
+
+def histogram_delta(child, before):
+    return child.sum - before[0], sum(child.counts) - before[1]
+
+
+def run_case(ocr, data, mode):
+    ttft, tps, tokens = (metric.labels(mode) for metric in (metrics.TTFT, metrics.DECODE_TPS, metrics.OUTPUT_TOKENS))
+    before = {child: (child.sum, sum(child.counts)) for child in (ttft, tps, tokens)}
+    chunks = []
+    with peak_memory(CPU) as memory:
+        for chunk in ocr.process_image_stream(data, type=mode):
+            chunks.append(chunk)
+    ttft_sum, _ = histogram_delta(ttft, before[ttft])
+    tps_sum, tps_count = histogram_delta(tps, before[tps])
+    tokens_sum, _ = histogram_delta(tokens, before[tokens])
+    return {"ttft": ttft_sum, "tokens": int(tokens_sum), "decode_tps": tps_sum / tps_count if tps_count else 0.0,
+            "peak_memory_mb": memory["peak"] / 1024**2, "text": "".join(chunks)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", help="Model path; defaults to a freshly built tiny model")
+    parser.add_argument("--precisions", nargs="+", choices=CPU_PRECISIONS, default=["fp32", "bf16", "int8"])
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--threads", type=int, help="Intra-op threads (torch.set_num_threads)")
+    parser.add_argument("--interop-threads", type=int, help="Inter-op threads")
+    parser.add_argument("--output", help="JSON file for the results")
+    args = parser.parse_args()
+
+    set_cpu_threads(args.threads, args.interop_threads)
+    precisions = [p for p in args.precisions if p != "bf16" or bf16_supported()]
+    if len(precisions) < len(args.precisions):
+        print("Skipping bf16: no native bf16 kernels on this CPU")
+
+    cases = []
+    for image_path, mode, expected_path in find_cases():
+        with open(image_path, "rb") as f:
+            cases.append((os.path.basename(image_path), mode, f.read(), read_expected(expected_path)))
+
+    report = {"meta": {"model": args.model or "tiny", "threads": torch.get_num_threads(),
+                       "cpus": os.cpu_count(), "torch": torch.__version__}, "results": {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path = args.model or build_tiny_model(os.path.join(tmp, "tiny-glm-ocr"))
+        print(f"{'precision':<10}{'image':<24}{'tokens':>7}{'ttft':>8}{'dec tok/s':>11}{'weights':>11}"
+              f"{'peak mem':>11}{'CER':>7}")
+        for precision in precisions:
+            # Batching and the vision cache off: every request pays its full cost
+            with contextlib.redirect_stdout(io.StringIO()):
+                ocr = GLMOCR(model_path, device="cpu", max_batch_size=0, max_new_tokens=args.max_new_tokens,
+                             vision_cache_bytes=0, cpu_precision=precision, warmup=True)
+            weights_mb = weight_bytes(ocr.model) / 1024**2
+
+            rows = []
+            for name, mode, data, reference in cases:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    stats = run_case(ocr, data, mode)
+                stats["cer"] = character_error_rate(normalize(COMMENT.sub("", stats.pop("text"))), reference)
+                rows.append(stats)
+                print(f"{precision:<10}{name:<24}{stats['tokens']:>7}{stats['ttft']:>7.2f}s"
+                      f"{stats['decode_tps']:>11.1f}{weights_mb:>9.1f}MB{stats['peak_memory_mb']:>9.1f}MB{stats['cer']:>7.3f}")
+            report["results"][precision] = {
+                "weights_mb": weights_mb,
+                "mean_ttft": statistics.mean(r["ttft"] for r in rows),
+                "decode_tps": statistics.mean(r["decode_tps"] for r in rows),
+                "peak_memory_mb": max(r["peak_memory_mb"] for r in rows),
+                "mean_cer": statistics.mean(r["cer"] for r in rows),
+            }
+            del ocr
+
+    baseline_name = precisions[0]
+    baseline = report["results"][baseline_name]
+    print(f"\nAgainst {baseline_name}:")
+    for precision, result in report["results"].items():
+        speedup = result["decode_tps"] / baseline["decode_tps"] if baseline["decode_tps"] else 0.0
+        ttft = result["mean_ttft"] / baseline["mean_ttft"] if baseline["mean_ttft"] else 0.0
+        print(f"{precision:<10}decode x{speedup:.2f}  ttft x{ttft:.2f}  weights x{result['weights_mb'] / baseline['weights_mb']:.2f}"
+              f"  CER {result['mean_cer'] - baseline['mean_cer']:+.3f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
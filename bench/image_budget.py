@@ -0,0 +1,162 @@
+"""Accuracy vs cost sweep over the visual-token budget.
+
+Runs every `test_images/<name>.*` that has a `<name>_expected.*` reference
+through `GLMOCR.process_image_stream` at a range of `image_token_budget`
+values and reports, per image and budget: visual tokens fed to the model,
+character error rate against the reference, prefill latency (time to first
+token) and peak memory during the request (CUDA allocator peak on GPU,
+resident set size growth on CPU).
+
+The default tiny random model only exercises the cost side; CER is
+meaningful with the real checkpoint:
+
+    python -m bench.image_budget
+    python -m bench.image_budget --model zai-org/GLM-OCR --device auto --budgets 512 1024 2048 4096 0
+"""
+import argparse
+import contextlib
+import csv
+import glob
+import io
+import os
+import re
+import tempfile
+import threading
+import time
+
+import torch
+
+from glm import GLMOCR
+from bench.tiny_model import build_tiny_model
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def find_cases():
+    cases = []
+    for expected_path in sorted(glob.glob(os.path.join(ROOT, "test_images", "*_expected.*"))):
+        stem = os.path.basename(expected_path).rsplit("_expected.", 1)[0]
+        images = [p for p in glob.glob(os.path.join(ROOT, "test_images", stem + ".*")) if p != expected_path]
+        if images:
+            mode = "table" if expected_path.endswith(".csv") else "text"
+            cases.append((images[0], mode, expected_path))
+    return cases
+
+
+def normalize(text):
+    # Compare cell contents and words only: markup, quoting and spacing are not OCR errors
+    text = re.sub(r"<[^>]+>", " ", text)
+    return " ".join(text.split())
+
+
+def read_expected(path):
+    with open(path, encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            return normalize("\n".join(" ".join(row) for row in csv.reader(f)))
+        return normalize(f.read())
+
+
+def character_error_rate(hypothesis, reference):
+    previous = list(range(len(hypothesis) + 1))
+    for i, ref_char in enumerate(reference, 1):
+        current = [i]
+        for j, hyp_char in enumerate(hypothesis, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ref_char != hyp_char)))
+        previous = current
+    return previous[-1] / max(1, len(reference))
+
+
+def rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * PAGE_SIZE
+
+
+@contextlib.contextmanager
+def peak_memory(device):
+    """Yields a dict whose "peak" is filled with the bytes allocated above the starting point."""
+    result = {"peak": 0}
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        start = torch.cuda.memory_allocated()
+        yield result
+        torch.cuda.synchronize()
+        result["peak"] = torch.cuda.max_memory_allocated() - start
+        return
+
+    start = rss_bytes()
+    peak = start
+    done = threading.Event()
+
+    def sample():
+        nonlocal peak
+        while not done.wait(0.002):
+            peak = max(peak, rss_bytes())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        yield result
+    finally:
+        done.set()
+        sampler.join()
+        result["peak"] = max(peak, rss_bytes()) - start
+
+
+def run_case(ocr, image_path, mode):
+    with open(image_path, "rb") as f:
+        data = f.read()
+    inputs, _ = ocr._prepare_inputs(data, mode)
+    visual_tokens = int(inputs["image_grid_thw"][0].prod()) // ocr.processor.image_processor.merge_size ** 2
+
+    with peak_memory(ocr.device) as memory:
+        start = time.perf_counter()
+        first = None
+        chunks = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            for chunk in ocr.process_image_stream(data, type=mode):
+                if first is None:
+                    first = time.perf_counter()
+                chunks.append(chunk)
+        end = time.perf_counter()
+    return visual_tokens, "".join(chunks), (first or end) - start, memory["peak"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", help="Model path; defaults to a freshly built tiny model")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--budgets", type=int, nargs="+", default=[64, 128, 256, 512, 1024, 0],
+                        help="Visual-token budgets to try; 0 = processor default")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=3, help="Runs per point; the fastest is reported")
+    args = parser.parse_args()
+
+    cases = find_cases()
+    with tempfile.TemporaryDirectory() as tmp:
+        # A generous processor limit so the sweep, not the processor, decides the size
+        model_path = args.model or build_tiny_model(os.path.join(tmp, "tiny-glm-ocr"), max_pixels=28 * 28 * 4096)
+        # No vision cache or batching: every run pays the full preprocessing and prefill
+        ocr = GLMOCR(model_path, device=args.device, max_batch_size=0, max_new_tokens=args.max_new_tokens,
+                     vision_cache_bytes=0)
+        # Warm-up so the first point does not pay one-off allocator/kernel costs
+        with contextlib.redirect_stdout(io.StringIO()):
+            run_case(ocr, cases[0][0], cases[0][1])
+
+        print(f"{'image':<26}{'budget':>8}{'tokens':>8}{'CER':>8}{'prefill':>10}{'peak mem':>11}")
+        for image_path, mode, expected_path in cases:
+            reference = read_expected(expected_path)
+            for budget in args.budgets:
+                ocr.image_token_budget = {mode: budget}
+                runs = [run_case(ocr, image_path, mode) for _ in range(args.repeats)]
+                visual_tokens, text, prefill, peak = min(runs, key=lambda r: r[2])
+                cer = character_error_rate(normalize(text), reference)
+                print(
+                    f"{os.path.basename(image_path):<26}{budget or 'max':>8}{visual_tokens:>8}{cer:>8.3f}"
+                    f"{prefill * 1000:>8.1f}ms{peak / 1024**2:>9.1f}MB"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Greedy vs n-gram speculative decoding, one request at a time.
+
+For every test image and mode, runs plain greedy `model.generate`
+(`max_batch_size=0`) and the speculative decoder at each draft length, and
+reports decode throughput, forward passes, draft acceptance rate and
+tokens per forward pass. Outputs are checked to be identical.
+
+Runs on CPU against a tiny randomly initialised model by default:
+
+    python -m bench.speculative
+    python -m bench.speculative --model zai-org/GLM-OCR --device auto --draft-tokens 4 8 16
+"""
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import threading
+import time
+
+import torch
+
+from glm import GLMOCR, GenerationRequest
+from bench.tiny_model import build_tiny_model
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGES = [
+    (os.path.join(ROOT, "test_images", "hand_written_table.jpg"), "table"),
+    (os.path.join(ROOT, "test_images", "test_text.PNG"), "text"),
+]
+
+
+def run_greedy(ocr, image_path, mode):
+    inputs, _ = ocr._prepare_inputs(image_path, mode)
+    stopping_criteria, criteria = ocr._stopping(mode, threading.Event(), inputs["input_ids"].shape[1])
+    start = time.perf_counter()
+    with torch.no_grad():
+        output = ocr.model.generate(**inputs, max_new_tokens=ocr.max_new_tokens, stopping_criteria=stopping_criteria)
+    elapsed = time.perf_counter() - start
+    generated = output[0, inputs["input_ids"].shape[1]:].tolist()
+    return generated, elapsed, len(generated), None
+
+
+def run_speculative(ocr, image_path, mode):
+    inputs, _ = ocr._prepare_inputs(image_path, mode)
+    stopping_criteria, _ = ocr._stopping(mode, threading.Event(), inputs["input_ids"].shape[1])
+    request = GenerationRequest(inputs, stopping_criteria=stopping_criteria, max_new_tokens=ocr.max_new_tokens)
+    start = time.perf_counter()
+    ocr.speculative.run(request)
+    elapsed = time.perf_counter() - start
+    if request.error is not None:
+        raise request.error
+    # The first token comes out of the prefill pass
+    return request.generated, elapsed, request.steps + 1, request
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", help="Model path; defaults to a freshly built tiny model")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--draft-tokens", type=int, nargs="+", default=[4, 8])
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--threads", type=int, help="torch.set_num_threads for the run")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path = args.model or build_tiny_model(os.path.join(tmp, "tiny-glm-ocr"))
+        # Batching and the vision cache off: both sides pay the same prefill
+        ocr = GLMOCR(model_path, device=args.device, max_batch_size=0, max_new_tokens=args.max_new_tokens,
+                     vision_cache_bytes=0, speculative_draft_tokens=max(args.draft_tokens))
+        with contextlib.redirect_stdout(io.StringIO()):
+            run_greedy(ocr, *IMAGES[0])
+            run_speculative(ocr, *IMAGES[0])
+
+        print(f"{'image':<24}{'decoder':<14}{'tokens':>7}{'passes':>8}{'tok/s':>9}{'accept':>8}{'tok/pass':>10}{'same':>6}")
+        for image_path, mode in IMAGES:
+            reference, elapsed, passes, _ = run_greedy(ocr, image_path, mode)
+            name = os.path.basename(image_path)
+            print(f"{name:<24}{'greedy':<14}{len(reference):>7}{passes:>8}{len(reference) / elapsed:>9.1f}"
+                  f"{'-':>8}{1.0:>10.2f}{'-':>6}")
+            for draft_tokens in args.draft_tokens:
+                ocr.speculative.draft_tokens = draft_tokens
+                generated, elapsed, passes, request = run_speculative(ocr, image_path, mode)
+                acceptance = request.accepted / request.drafted if request.drafted else 0.0
+                print(f"{name:<24}{f'ngram x{draft_tokens}':<14}{len(generated):>7}{passes:>8}"
+                      f"{len(generated) / elapsed:>9.1f}{acceptance:>8.1%}{len(generated) / passes:>10.2f}"
+                      f"{'yes' if generated == reference else 'NO':>6}")
+
+
+if __name__ == "__main__":
+    main()
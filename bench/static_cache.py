@@ -0,0 +1,146 @@
+"""Eager decoding on a dynamic KV cache vs the static cache with a compiled decode step.
+
+For every test image and mode, generates a fixed number of tokens with
+plain `model.generate` and through a StaticCachePool (after compiling its
+buckets, timed separately), one request at a time. Reports per-token
+decode latency (median and p90, the prefill token excluded), allocator
+churn per decoded token (allocations and bytes allocated beyond what a
+prefill-only run allocates: from the CUDA caching allocator's counters on
+a GPU, from the profiler's memory events on the CPU) and checks both
+produce the same tokens. The timed static runs go with torch.compile set
+to fail on recompiling, so one needing a graph the warm-up did not build
+stops the benchmark. The static path builds its attention mask over
+the whole bucket every step, so its bytes per token grow with the bucket
+length even as the number of allocations drops.
+
+Runs on CPU against a tiny randomly initialised model by default:
+
+    python -m bench.static_cache
+    python -m bench.static_cache --model zai-org/GLM-OCR --device auto --tokens 256
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import tempfile
+import time
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+from transformers import StoppingCriteria
+
+from glm import GLMOCR, StaticCachePool
+from bench.tiny_model import build_tiny_model
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGES = [
+    (os.path.join(ROOT, "test_images", "hand_written_table.jpg"), "table"),
+    (os.path.join(ROOT, "test_images", "test_text.PNG"), "text"),
+]
+
+
+class TokenTimer(StoppingCriteria):
+    """Timestamps every token as generate checks whether to stop."""
+
+    def __init__(self, device):
+        self.device = device
+        self.times = []
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        self.times.append(time.perf_counter())
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+
+@contextlib.contextmanager
+def allocations(device):
+    """Counts allocations and bytes allocated inside the block into the yielded dict."""
+    churn = {}
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        before = torch.cuda.memory_stats(device)
+        yield churn
+        torch.cuda.synchronize(device)
+        after = torch.cuda.memory_stats(device)
+        churn["count"] = after["allocation.all.allocated"] - before["allocation.all.allocated"]
+        churn["bytes"] = after["allocated_bytes.all.allocated"] - before["allocated_bytes.all.allocated"]
+        return
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as profiler:
+        yield churn
+    # The raw events: the aggregated view drops allocations it cannot attribute to an op
+    sizes = [event.nbytes() for event in profiler.profiler.kineto_results.events() if event.name() == "[memory]"]
+    churn["count"] = sum(1 for size in sizes if size > 0)
+    churn["bytes"] = sum(size for size in sizes if size > 0)
+
+
+def run(generate, inputs, tokens, device):
+    # A prefill-only run first: its allocations are taken off, leaving the decode steps'
+    with allocations(device) as prefill:
+        generate(inputs, max_new_tokens=1)
+    timer = TokenTimer(device)
+    with allocations(device) as churn:
+        output = generate(inputs, max_new_tokens=tokens, min_new_tokens=tokens, stopping_criteria=[timer])
+    decode = tokens - 1
+    latencies = sorted(b - a for a, b in zip(timer.times, timer.times[1:]))
+    return {
+        "ids": output[0, inputs["input_ids"].shape[1]:].tolist(),
+        "median_ms": statistics.median(latencies) * 1000,
+        "p90_ms": latencies[int(len(latencies) * 0.9)] * 1000,
+        "allocs_per_token": (churn["count"] - prefill["count"]) / decode,
+        "kb_per_token": (churn["bytes"] - prefill["bytes"]) / decode / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", help="Model path; defaults to a freshly built tiny model")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--tokens", type=int, default=128, help="Tokens generated per request")
+    parser.add_argument("--buckets", type=int, nargs="+", default=[2048, 4096], help="Static cache lengths")
+    parser.add_argument("--threads", type=int, help="torch.set_num_threads for the run")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path = args.model or build_tiny_model(os.path.join(tmp, "tiny-glm-ocr"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            ocr = GLMOCR(model_path, device=args.device, max_batch_size=0, vision_cache_bytes=0)
+        device = ocr.model.device
+        eager = lambda inputs, **kwargs: ocr.model.generate(**inputs, **kwargs)
+        pool = StaticCachePool(ocr.model, args.buckets)
+
+        cases = []
+        for image_path, mode in IMAGES:
+            inputs, _ = ocr._prepare_inputs(image_path, mode)
+            cases.append((os.path.basename(image_path), inputs))
+        with torch.no_grad():
+            # Both paths warmed up the same way; compiling is the static path's one-off cost
+            eager(cases[0][1], max_new_tokens=4)
+            start = time.perf_counter()
+            for bucket in pool.buckets:
+                pool.generate(cases[0][1], max_new_tokens=4, bucket=bucket)
+            print(f"Compiled {len(pool.buckets)} bucket(s) ({', '.join(map(str, pool.buckets))}) "
+                  f"in {time.perf_counter() - start:.1f}s")
+
+            print(f"{'image':<24}{'path':<9}{'median':>9}{'p90':>9}{'allocs/tok':>12}{'KB/tok':>9}{'same':>6}")
+            for name, inputs in cases:
+                reference = run(eager, inputs, args.tokens, device)
+                try:
+                    with torch.compiler.set_stance("fail_on_recompile"):
+                        static = run(pool.generate, inputs, args.tokens, device)
+                except RuntimeError as e:
+                    raise SystemExit(f"{name}: recompiled after warm-up: {e}")
+                for label, result in (("eager", reference), ("static", static)):
+                    same = "-" if result is reference else ("yes" if result["ids"] == reference["ids"] else "NO")
+                    print(f"{name:<24}{label:<9}{result['median_ms']:>7.2f}ms{result['p90_ms']:>7.2f}ms"
+                          f"{result['allocs_per_token']:>12.1f}{result['kb_per_token']:>9.1f}{same:>6}")
+                print(f"{'':<24}speed-up x{reference['median_ms'] / static['median_ms']:.2f} median per token")
+        print("Recompilations after warm-up: none")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Event-loop overhead per streamed token: per-token threadpool hops vs the queue bridge.
+
+A fake producer yields short chunks from a blocking iterator at a fixed rate
+(or as fast as it can), standing in for `process_image_stream`. Each strategy
+drains it from inside an asyncio loop; reported are the wall time per token,
+the CPU time the whole process spent per token, and the number of chunks
+handed to the HTTP layer (i.e. response writes).
+
+    python -m bench.stream_bridge
+    python -m bench.stream_bridge --tokens 20000 --rate 0
+"""
+import argparse
+import asyncio
+import time
+
+from fastapi.concurrency import run_in_threadpool
+
+from streaming import stream_in_thread
+
+
+def fake_stream(tokens, rate):
+    interval = 1.0 / rate if rate else 0
+    next_at = time.perf_counter()
+    for i in range(tokens):
+        if interval:
+            next_at += interval
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        yield f"<td>{i % 100}</td>"
+
+
+async def per_token(tokens, rate):
+    """The old response_generator loop: one run_in_threadpool round trip per chunk."""
+    gen = fake_stream(tokens, rate)
+
+    def safe_next(g):
+        try:
+            return next(g)
+        except StopIteration:
+            return None
+
+    writes = 0
+    while True:
+        chunk = await run_in_threadpool(safe_next, gen)
+        if chunk is None:
+            break
+        writes += 1
+    return writes
+
+
+async def bridged(tokens, rate, flush_interval, flush_bytes):
+    writes = 0
+    async for _ in stream_in_thread(lambda: fake_stream(tokens, rate), flush_interval, flush_bytes):
+        writes += 1
+    return writes
+
+
+def measure(factory):
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    writes = asyncio.run(factory())
+    return time.perf_counter() - wall_start, time.process_time() - cpu_start, writes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=5000)
+    parser.add_argument("--rate", type=float, default=2000, help="Producer tokens/s; 0 = unthrottled")
+    parser.add_argument("--flush-ms", type=float, default=25)
+    parser.add_argument("--flush-bytes", type=int, default=4096)
+    args = parser.parse_args()
+
+    flush = args.flush_ms / 1000
+    runs = [
+        ("per-token", lambda: per_token(args.tokens, args.rate)),
+        ("bridge", lambda: bridged(args.tokens, args.rate, 0, args.flush_bytes)),
+        (f"bridge+{args.flush_ms:g}ms", lambda: bridged(args.tokens, args.rate, flush, args.flush_bytes)),
+    ]
+    print(f"{args.tokens} tokens at {'max' if not args.rate else f'{args.rate:g}'} tok/s")
+    print(f"{'strategy':<16}{'wall us/tok':>12}{'cpu us/tok':>12}{'writes':>9}")
+    for label, factory in runs:
+        wall, cpu, writes = measure(factory)
+        print(f"{label:<16}{wall / args.tokens * 1e6:>12.1f}{cpu / args.tokens * 1e6:>12.1f}{writes:>9}")
+
+
+if __name__ == "__main__":
+    main()
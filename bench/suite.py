@@ -0,0 +1,389 @@
+"""Benchmark suite with JSON results and a regression check.
+
+`run` drives the OCR pipeline two ways at each concurrency level:
+
+- `direct`: client threads calling `GLMOCR.process_image_stream`;
+- `api`: client threads streaming `POST /ocr` over HTTP from the FastAPI app,
+  served by uvicorn in this process (job queue, stream bridge and all).
+
+Every `test_images/<name>.*` with a `<name>_expected.*` reference is used.
+Per target and level it records mean/p95 latency, mean/p95 time to first
+token, mean decode tokens/s, aggregate output tokens/s, requests/s, peak
+memory (CUDA allocator peak on GPU, resident set growth on CPU) and the
+character error rate against the references, and writes them to JSON.
+
+`compare` lines up two result files and flags every metric that got worse
+by more than the threshold; it exits with status 1 if any did.
+
+With `--replicas N` the model runs as a `pool.ModelPool` of N worker
+processes, each on its own slice of the CPU cores (or its own GPU), so
+runs at 1, 2, 4 replicas show how throughput scales; peak memory then
+covers the server process only, not the workers.
+
+The default tiny random model needs no network and only measures cost; CER
+is meaningful with the real checkpoint. (Its gibberish output is mostly
+partial UTF-8, which the streamer holds back, so its TTFT is close to the
+full latency.)
+
+    python -m bench.suite run --output before.json
+    python -m bench.suite run --model zai-org/GLM-OCR --device auto --clients 1 4 8 --output after.json
+    python -m bench.suite run --replicas 4 --clients 4 8 16 --output pool.json
+    python -m bench.suite compare before.json after.json --threshold 0.1
+"""
+import argparse
+import contextlib
+import http.client
+import io
+import json
+import os
+import platform
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import torch
+import transformers
+
+import metrics
+from glm import GLMOCR
+from pool import ModelPool, core_sets, default_devices
+from bench.image_budget import character_error_rate, find_cases, normalize, peak_memory, read_expected
+from bench.tiny_model import build_tiny_model
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMENT = re.compile(r"<!--.*?-->", re.S)
+
+# Metric name -> True when lower is better
+DIRECTIONS = {
+    "mean_latency": True,
+    "p95_latency": True,
+    "mean_ttft": True,
+    "p95_ttft": True,
+    "peak_memory_mb": True,
+    "decode_tps": False,
+    "throughput": False,
+    "requests_per_s": False,
+}
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[max(0, int(round(fraction * len(values))) - 1)]
+
+
+def histogram_totals(histogram):
+    """(sum, count) over every label set of a metrics.Histogram."""
+    with histogram.lock:
+        children = list(histogram.children.values())
+    return sum(child.sum for child in children), sum(sum(child.counts) for child in children)
+
+
+class DirectTarget:
+    name = "direct"
+
+    def __init__(self, ocr):
+        self.ocr = ocr
+
+    def request(self, data, mode):
+        start = time.perf_counter()
+        first = None
+        chunks = []
+        for chunk in self.ocr.process_image_stream(data, type=mode):
+            if first is None and chunk:
+                first = time.perf_counter()
+            chunks.append(chunk)
+        end = time.perf_counter()
+        return end - start, (first or end) - start, "".join(chunks)
+
+    def close(self):
+        pass
+
+
+class ApiTarget:
+    """The FastAPI app on a local port; every request bypasses the result cache."""
+
+    name = "api"
+
+    def __init__(self, ocr, workdir, max_in_flight):
+        import uvicorn
+
+        import main
+        from cache import ResultCache
+        from jobs import JobQueue
+
+        main.ocr_model = ocr
+        main.UPLOAD_DIR = os.path.join(workdir, "uploads")
+        main.result_cache = ResultCache(os.path.join(workdir, "ocr_cache"), memory_max_bytes=0, disk_max_bytes=0)
+        main.job_queue = JobQueue(max_in_flight=max_in_flight, max_queued=1024)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.server = uvicorn.Server(uvicorn.Config(main.app, lifespan="off", log_level="warning", access_log=False))
+        self.thread = threading.Thread(target=self.server.run, kwargs={"sockets": [self.sock]}, daemon=True)
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+
+    def request(self, data, mode):
+        boundary = uuid.uuid4().hex
+        fields = {"type": mode, "no_cache": "true"}
+        body = b"".join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+            for name, value in fields.items()
+        )
+        body += (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="page"\r\n'
+            f"Content-Type: application/octet-stream\r\n\r\n"
+        ).encode() + data + f"\r\n--{boundary}--\r\n".encode()
+
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=3600)
+        try:
+            start = time.perf_counter()
+            connection.request("POST", "/ocr", body, {"Content-Type": f"multipart/form-data; boundary={boundary}"})
+            response = connection.getresponse()
+            if response.status != 200:
+                raise RuntimeError(f"/ocr answered {response.status}: {response.read()[:200]!r}")
+            first = None
+            received = b""
+            while True:
+                chunk = response.read1(65536)
+                if not chunk:
+                    break
+                received += chunk
+                # Queue position updates are not output
+                if first is None and COMMENT.sub("", received.decode("utf-8", "ignore")):
+                    first = time.perf_counter()
+            end = time.perf_counter()
+        finally:
+            connection.close()
+        return end - start, (first or end) - start, received.decode("utf-8", "replace")
+
+    def close(self):
+        self.server.should_exit = True
+        self.thread.join()
+        self.sock.close()
+
+
+def run_level(target, cases, clients, requests_per_client, device):
+    results = []
+    errors = []
+    lock = threading.Lock()
+
+    def client(index):
+        try:
+            for n in range(requests_per_client):
+                case = cases[(index + n) % len(cases)]
+                latency, ttft, text = target.request(case["data"], case["mode"])
+                with lock:
+                    results.append((case["name"], latency, ttft, text))
+        except Exception as e:
+            errors.append(e)
+
+    tokens_before, _ = histogram_totals(metrics.OUTPUT_TOKENS)
+    tps_before = histogram_totals(metrics.DECODE_TPS)
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    with peak_memory(device) as memory:
+        wall_start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - wall_start
+    if errors:
+        raise errors[0]
+    tokens = histogram_totals(metrics.OUTPUT_TOKENS)[0] - tokens_before
+    tps_sum, tps_count = (after - before for after, before in zip(histogram_totals(metrics.DECODE_TPS), tps_before))
+
+    cer = {}
+    for name, _, _, text in results:
+        if name not in cer:
+            reference = next(case["reference"] for case in cases if case["name"] == name)
+            cer[name] = character_error_rate(normalize(COMMENT.sub("", text)), reference)
+
+    latencies = [r[1] for r in results]
+    ttfts = [r[2] for r in results]
+    return {
+        "requests": len(results),
+        "mean_latency": statistics.mean(latencies),
+        "p95_latency": percentile(latencies, 0.95),
+        "mean_ttft": statistics.mean(ttfts),
+        "p95_ttft": percentile(ttfts, 0.95),
+        "decode_tps": tps_sum / tps_count if tps_count else 0.0,
+        "throughput": tokens / wall,
+        "requests_per_s": len(results) / wall,
+        "peak_memory_mb": memory["peak"] / 1024**2,
+        "memory": "vram" if device.type == "cuda" else "rss",
+        "cer": cer,
+        "mean_cer": statistics.mean(cer.values()),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    cases = []
+    for image_path, mode, expected_path in find_cases():
+        with open(image_path, "rb") as f:
+            data = f.read()
+        cases.append({"name": os.path.basename(image_path), "mode": mode, "data": data,
+                      "reference": read_expected(expected_path)})
+
+    report = {
+        "meta": {
+            "model": args.model or "tiny",
+            "device": args.device,
+            "clients": args.clients,
+            "requests_per_client": args.requests_per_client,
+            "max_new_tokens": args.max_new_tokens,
+            "max_batch_size": args.max_batch_size,
+            "replicas": args.replicas,
+            "git": git_revision(),
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "threads": torch.get_num_threads(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": {},
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path = args.model or build_tiny_model(os.path.join(tmp, "tiny-glm-ocr"))
+        # No vision cache: repeats of the same test image must cost what a new image does
+        model_kwargs = dict(max_batch_size=args.max_batch_size, max_new_tokens=args.max_new_tokens, vision_cache_bytes=0)
+        if args.replicas > 1:
+            devices = default_devices(args.replicas) if args.device == "auto" else [args.device]
+            ocr = ModelPool(args.replicas, {"model_path": model_path, **model_kwargs}, devices=devices,
+                            cores=core_sets(args.replicas))
+            device = torch.device("cpu")
+        else:
+            ocr = GLMOCR(model_path, device=args.device, **model_kwargs)
+            device = ocr.device
+
+        print(f"{'target':<8}{'clients':>8}{'reqs':>6}{'mean lat':>10}{'p95 lat':>10}{'ttft':>9}"
+              f"{'dec tok/s':>11}{'tok/s':>9}{'req/s':>8}{'peak mem':>11}{'CER':>7}")
+        for target_name in args.targets:
+            with contextlib.redirect_stdout(io.StringIO()):
+                if target_name == "api":
+                    target = ApiTarget(ocr, tmp, max(1, args.max_batch_size) * args.replicas)
+                else:
+                    target = DirectTarget(ocr)
+            try:
+                # Warm-up so the first level does not pay one-off allocator/kernel costs
+                with contextlib.redirect_stdout(io.StringIO()):
+                    run_level(target, cases, 1, 1, device)
+                for clients in args.clients:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        stats = run_level(target, cases, clients, args.requests_per_client, device)
+                    report["results"][f"{target_name}/{clients}"] = stats
+                    print(
+                        f"{target_name:<8}{clients:>8}{stats['requests']:>6}"
+                        f"{stats['mean_latency']:>9.2f}s{stats['p95_latency']:>9.2f}s{stats['mean_ttft']:>8.2f}s"
+                        f"{stats['decode_tps']:>11.1f}{stats['throughput']:>9.1f}{stats['requests_per_s']:>8.2f}"
+                        f"{stats['peak_memory_mb']:>9.1f}MB{stats['mean_cer']:>7.3f}"
+                    )
+            finally:
+                target.close()
+        ocr.close()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    return report
+
+
+def compare_results(baseline, candidate, threshold=0.1, cer_threshold=0.01):
+    """Rows of (key, metric, baseline, candidate, change, regressed) for results present in both."""
+    rows = []
+    for key, base in baseline["results"].items():
+        new = candidate["results"].get(key)
+        if new is None:
+            continue
+        for metric, lower_is_better in DIRECTIONS.items():
+            if metric not in base or metric not in new:
+                continue
+            before, after = base[metric], new[metric]
+            change = (after - before) / before if before else 0.0
+            worse = change if lower_is_better else -change
+            rows.append((key, metric, before, after, change, worse > threshold))
+        # Error rates are compared in absolute terms: 0.00 -> 0.01 is not a 100% regression
+        if "mean_cer" in base and "mean_cer" in new:
+            change = new["mean_cer"] - base["mean_cer"]
+            rows.append((key, "mean_cer", base["mean_cer"], new["mean_cer"], change, change > cer_threshold))
+    return rows
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    for name, report in (("baseline", baseline), ("candidate", candidate)):
+        meta = report["meta"]
+        print(f"{name:<10} {meta['model']} on {meta['device']} @ {meta['git']} ({meta['timestamp']})")
+
+    missing = sorted(set(baseline["results"]) ^ set(candidate["results"]))
+    if missing:
+        print(f"Not in both files, skipped: {', '.join(missing)}")
+
+    rows = compare_results(baseline, candidate, args.threshold, args.cer_threshold)
+    print(f"\n{'result':<12}{'metric':<16}{'baseline':>12}{'candidate':>12}{'change':>10}")
+    for key, metric, before, after, change, regressed in rows:
+        shown = f"{change:+.3f}" if metric == "mean_cer" else f"{change:+.1%}"
+        print(f"{key:<12}{metric:<16}{before:>12.3f}{after:>12.3f}{shown:>10}{'  REGRESSION' if regressed else ''}")
+
+    regressions = sum(row[5] for row in rows)
+    print(f"\n{regressions} regression(s) beyond {args.threshold:.0%} (CER: +{args.cer_threshold})")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run the suite and write JSON results")
+    run_parser.add_argument("--model", help="Model path; defaults to a freshly built tiny model")
+    run_parser.add_argument("--device", default="cpu")
+    run_parser.add_argument("--targets", nargs="+", choices=["direct", "api"], default=["direct", "api"])
+    run_parser.add_argument("--clients", type=int, nargs="+", default=[1, 4])
+    run_parser.add_argument("--requests-per-client", type=int, default=2)
+    run_parser.add_argument("--max-new-tokens", type=int, default=64)
+    run_parser.add_argument("--max-batch-size", type=int, default=8)
+    run_parser.add_argument("--replicas", type=int, default=1, help="Model worker processes (pool.ModelPool)")
+    run_parser.add_argument("--threads", type=int, help="torch.set_num_threads for the run")
+    run_parser.add_argument("--output", help="JSON file for the results")
+
+    compare_parser = commands.add_parser("compare", help="Flag regressions between two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="Relative change that counts as a regression (default 10%%)")
+    compare_parser.add_argument("--cer-threshold", type=float, default=0.01,
+                                help="Absolute CER increase that counts as a regression")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == "__main__":
+    main()
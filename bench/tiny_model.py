@@ -0,0 +1,129 @@
+"""Build a tiny, randomly initialised GLM-OCR checkpoint for offline benchmarks.
+
+The checkpoint uses the real GLM-OCR architecture (vision tower, M-RoPE text
+decoder, Glm46V processor) at a toy size, with a small byte-level BPE
+tokenizer trained on the spot. It needs no network access and runs on CPU,
+so `GLMOCR(model_path=...)` can be exercised end to end.
+
+    python -m bench.tiny_model bench/tiny-glm-ocr
+"""
+import argparse
+import os
+
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import GlmOcrConfig, GlmOcrForConditionalGeneration, PreTrainedTokenizerFast
+from transformers.models.glm46v.image_processing_pil_glm46v import Glm46VImageProcessorPil
+from transformers.models.glm46v.processing_glm46v import Glm46VProcessor
+from transformers.models.glm46v.video_processing_glm46v import Glm46VVideoProcessor
+
+SPECIAL_TOKENS = [
+    "<|endoftext|>",
+    "<|user|>",
+    "<|assistant|>",
+    "<|begin_of_image|>",
+    "<|end_of_image|>",
+    "<|image|>",
+    "<|begin_of_video|>",
+    "<|end_of_video|>",
+    "<|video|>",
+]
+
+# Mirrors the structure GLMOCR builds: one image item followed by a prompt
+# item whose text lives under the key named by its "type".
+CHAT_TEMPLATE = (
+    "{% for message in messages %}<|{{ message.role }}|>"
+    "{% for item in message.content %}"
+    "{% if item.type == 'image' %}<|begin_of_image|><|image|><|end_of_image|>"
+    "{% else %}{{ item[item.type] }}{% endif %}"
+    "{% endfor %}{% endfor %}"
+    "{% if add_generation_prompt %}<|assistant|>{% endif %}"
+)
+
+TOKENIZER_CORPUS = [
+    "<table><thead><tr><th>Name</th><th>Qty</th></tr></thead>",
+    "<tbody><tr><td>Item</td><td>1</td></tr></tbody></table>",
+    "Table Recognition: Text Recognition:",
+    "The quick brown fox jumps over the lazy dog. 0123456789",
+]
+
+
+def build_tokenizer():
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=512,
+        special_tokens=SPECIAL_TOKENS,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator(TOKENIZER_CORPUS, trainer)
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        eos_token="<|endoftext|>",
+        pad_token="<|endoftext|>",
+    )
+
+
+def build_tiny_model(output_dir, max_pixels=28 * 28 * 256, seed=0):
+    """Write a tiny GLM-OCR checkpoint (model + processor) to `output_dir`."""
+    tokenizer = build_tokenizer()
+    processor = Glm46VProcessor(
+        image_processor=Glm46VImageProcessorPil(max_pixels=max_pixels, min_pixels=28 * 28 * 4),
+        tokenizer=tokenizer,
+        video_processor=Glm46VVideoProcessor(),
+        chat_template=CHAT_TEMPLATE,
+    )
+
+    token_id = tokenizer.convert_tokens_to_ids
+    config = GlmOcrConfig(
+        text_config=dict(
+            vocab_size=len(tokenizer),
+            hidden_size=128,
+            intermediate_size=256,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            num_key_value_heads=2,
+            rope_parameters={
+                "rope_type": "default",
+                "rope_theta": 10000,
+                "mrope_section": [2, 3, 3],
+                "partial_rotary_factor": 0.5,
+            },
+            eos_token_id=token_id("<|endoftext|>"),
+            pad_token_id=token_id("<|endoftext|>"),
+        ),
+        vision_config=dict(
+            depth=1,
+            hidden_size=32,
+            intermediate_size=64,
+            num_heads=2,
+            out_hidden_size=128,
+            patch_size=14,
+            spatial_merge_size=2,
+            temporal_patch_size=2,
+        ),
+        image_token_id=token_id("<|image|>"),
+        video_token_id=token_id("<|video|>"),
+        image_start_token_id=token_id("<|begin_of_image|>"),
+        image_end_token_id=token_id("<|end_of_image|>"),
+        video_start_token_id=token_id("<|begin_of_video|>"),
+        video_end_token_id=token_id("<|end_of_video|>"),
+    )
+
+    torch.manual_seed(seed)
+    model = GlmOcrForConditionalGeneration(config)
+    model.generation_config.eos_token_id = token_id("<|endoftext|>")
+    model.generation_config.pad_token_id = token_id("<|endoftext|>")
+
+    os.makedirs(output_dir, exist_ok=True)
+    model.save_pretrained(output_dir)
+    processor.save_pretrained(output_dir)
+    return output_dir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("output_dir", nargs="?", default=os.path.join("bench", "tiny-glm-ocr"))
+    args = parser.parse_args()
+    print(f"Tiny GLM-OCR checkpoint written to {build_tiny_model(args.output_dir)}")
@@ -0,0 +1,309 @@
+"""Resumable bulk OCR of a directory or a manifest of images, without the server.
+
+Images are read, decoded and encoded (vision tower included) by a pool of
+`--workers` threads ahead of the model, while `--batch-size` generations
+run at once in the model's continuous batching loop. Each result is
+appended to the output as soon as it finishes: one JSON object per line
+for `.jsonl`, or `path,mode,seconds,error,text` rows for `.csv`.
+
+Next to the output, `<output>.checkpoint` records every finished path with
+the output size after its record was synced to disk. On restart, the
+output is cut back to the last checkpointed size (dropping a record
+written just before a crash) and checkpointed paths are skipped, so a run
+can be killed and restarted any number of times and every input ends up
+in the output exactly once. Files that fail are recorded with an `error`
+and not retried.
+
+`--rule PATTERN=MODE[:BATCH]` picks the mode (and optionally the batch
+size) for paths matching a glob pattern, first match wins; manifests may
+also give a mode per line. Files are processed rule by rule.
+
+    python bulk.py scans/ --output results.jsonl
+    python bulk.py scans/ --output results.csv --rule "*/tables/*=table:8" --rule "*.tif=text:2"
+    python bulk.py manifest.txt --output results.jsonl --model ./GLM-OCR --cpu-precision int8
+"""
+import argparse
+import collections
+import contextlib
+import csv
+import fnmatch
+import io
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from glm import GLMOCR, CPU_PRECISIONS
+from pages import document_type
+
+EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".gif", ".webp", ".tif", ".tiff", ".pdf"}
+MODES = ("table", "text")
+
+
+def log(message):
+    # Progress goes to stderr; the model's per-request lines go to stdout
+    print(message, file=sys.stderr, flush=True)
+
+
+def parse_rule(value):
+    pattern, _, target = value.rpartition("=")
+    mode, _, batch = target.partition(":")
+    if not pattern or mode not in MODES or (batch and not batch.isdigit()):
+        raise argparse.ArgumentTypeError(f"Expected PATTERN=table|text[:BATCH], got {value!r}")
+    return pattern, mode, int(batch) if batch else None
+
+
+def list_inputs(source):
+    """(path, mode or None) for every image in a directory tree, or every entry of a manifest.
+
+    A manifest has one path per line (relative paths are taken from the
+    manifest's directory), or one JSON object with `path` and optionally
+    `mode` per line.
+    """
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in EXTENSIONS:
+                    yield os.path.join(root, name), None
+        return
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            entry = json.loads(line) if line.startswith("{") else {"path": line}
+            yield os.path.join(base, entry["path"]), entry.get("mode")
+
+
+class Output:
+    """The results file plus its checkpoint manifest; see the module docstring."""
+
+    def __init__(self, path):
+        self.path = path
+        self.checkpoint_path = path + ".checkpoint"
+        self.csv = path.lower().endswith(".csv")
+        self.done = set()
+        offset = valid = 0
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, "rb") as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Cut short by a crash mid-write: that record is not checkpointed
+                        break
+                    self.done.add(entry["path"])
+                    offset = entry["offset"]
+                    valid += len(line)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size < offset:
+            raise SystemExit(f"{path} is shorter than its checkpoint says; remove {self.checkpoint_path} to start over")
+
+        self.file = open(path, "ab")
+        self.file.truncate(offset)
+        self.checkpoint = open(self.checkpoint_path, "a", encoding="utf-8")
+        # Drop a torn last line so what is appended from here on stays readable
+        self.checkpoint.truncate(valid)
+        if self.csv and offset == 0:
+            self._write_csv(["path", "mode", "seconds", "error", "text"])
+            self._sync(None)
+
+    def _write_csv(self, row):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(row)
+        self.file.write(buffer.getvalue().encode("utf-8"))
+
+    def _sync(self, path):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        if path is not None:
+            # Only once the record is on disk does the checkpoint claim it
+            self.checkpoint.write(json.dumps({"path": path, "offset": self.file.tell()}) + "\n")
+            self.checkpoint.flush()
+            self.done.add(path)
+
+    def write(self, record):
+        if self.csv:
+            self._write_csv([record["path"], record["mode"], f"{record['seconds']:.3f}",
+                             record.get("error", ""), record.get("text", "")])
+        else:
+            self.file.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+        self._sync(record["path"])
+
+    def close(self):
+        self.file.close()
+        self.checkpoint.close()
+
+
+class Progress:
+    """Images per minute over the whole run and over the last `window` seconds."""
+
+    def __init__(self, total, window=60):
+        self.total = total
+        self.window = window
+        self.start = time.monotonic()
+        self.finished = collections.deque()
+        self.count = 0
+        self.errors = 0
+        self.last_report = 0.0
+
+    def add(self, error=False):
+        now = time.monotonic()
+        self.count += 1
+        self.errors += bool(error)
+        self.finished.append(now)
+        while self.finished and self.finished[0] < now - self.window:
+            self.finished.popleft()
+
+    def rates(self):
+        now = time.monotonic()
+        overall = self.count / max(now - self.start, 1e-9) * 60
+        span = min(self.window, now - self.start)
+        recent = len(self.finished) / max(span, 1e-9) * 60
+        return overall, recent
+
+    def report(self, force=False, every=10.0):
+        now = time.monotonic()
+        if not force and now - self.last_report < every:
+            return
+        self.last_report = now
+        overall, recent = self.rates()
+        log(f"[BULK] {self.count}/{self.total} done, {self.errors} failed | "
+            f"{recent:.1f} images/min (last {self.window}s), {overall:.1f} images/min overall")
+
+
+def run_group(ocr, paths, mode, batch_size, workers, output, progress, source_root):
+    """OCR `paths` in one mode, `batch_size` generations at a time, preprocessing up to `workers` ahead."""
+    pending = queue.Queue(maxsize=batch_size + workers)
+    results = queue.Queue()
+    stop = threading.Event()
+
+    def prepare(path):
+        with open(path, "rb") as f:
+            data = f.read()
+        if document_type(data):
+            # Multi-page: pages are rendered and encoded ahead inside the document stream
+            return "document", data
+        return "image", ocr._prepare_stream(data, mode)
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def feed():
+        for path in paths:
+            put((path, time.monotonic(), executor.submit(prepare, path)))
+        for _ in range(batch_size):
+            put(None)
+
+    def generate():
+        while not stop.is_set():
+            try:
+                item = pending.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is None:
+                return
+            path, start, future = item
+            record = {"path": os.path.relpath(path, source_root), "mode": mode}
+            try:
+                kind, prepared = future.result()
+                if kind == "document":
+                    record["text"] = "".join(ocr.process_document_stream(prepared, type=mode))
+                else:
+                    record["text"] = "".join(ocr._generate_stream(prepared, mode, None, time.time()))
+            except Exception as e:
+                record["error"] = str(e)
+            record["seconds"] = round(time.monotonic() - start, 3)
+            results.put(record)
+
+    executor = ThreadPoolExecutor(workers)
+    threads = [threading.Thread(target=feed, daemon=True)]
+    threads += [threading.Thread(target=generate, daemon=True) for _ in range(batch_size)]
+    for thread in threads:
+        thread.start()
+    try:
+        for _ in paths:
+            record = results.get()
+            output.write(record)
+            progress.add("error" in record)
+            progress.report()
+    finally:
+        # On an interrupt, generations in progress are abandoned; their files were not checkpointed
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="Directory of images, or a manifest file")
+    parser.add_argument("--output", required=True, help="Results file, .jsonl or .csv")
+    parser.add_argument("--mode", choices=MODES, default="table", help="Mode for files no rule matches")
+    parser.add_argument("--batch-size", type=int, default=8, help="Generations run at once")
+    parser.add_argument("--rule", type=parse_rule, action="append", default=[], metavar="PATTERN=MODE[:BATCH]")
+    parser.add_argument("--workers", type=int, default=4, help="Threads reading and preprocessing ahead")
+    parser.add_argument("--model", default="zai-org/GLM-OCR")
+    parser.add_argument("--device", default="auto")
+    parser.add_argument("--max-new-tokens", type=int, default=8192)
+    parser.add_argument("--cpu-precision", choices=CPU_PRECISIONS, default="auto")
+    parser.add_argument("--threads", type=int, help="torch intra-op threads")
+    parser.add_argument("--kv-cache-budget-mb", type=float, default=0,
+                        help="Memory the KV caches of running generations may take; long ones degrade to a "
+                             "quantised or offloaded cache or wait (0 = unbounded)")
+    parser.add_argument("--verbose", action="store_true", help="Keep the model's per-image [METRICS] lines")
+    args = parser.parse_args(argv)
+
+    source_root = args.source if os.path.isdir(args.source) else os.path.dirname(os.path.abspath(args.source))
+    output = Output(args.output)
+    groups = collections.OrderedDict()
+    skipped = 0
+    for path, mode in list_inputs(args.source):
+        relative = os.path.relpath(path, source_root)
+        if relative in output.done:
+            skipped += 1
+            continue
+        batch = args.batch_size
+        for pattern, rule_mode, rule_batch in args.rule:
+            if fnmatch.fnmatch(relative, pattern):
+                mode = mode or rule_mode
+                batch = rule_batch or batch
+                break
+        groups.setdefault((mode or args.mode, batch), []).append(path)
+    total = sum(len(paths) for paths in groups.values())
+    log(f"[BULK] {total} to do, {skipped} already done according to {output.checkpoint_path}")
+    if not total:
+        output.close()
+        return
+
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+        # No vision cache: nothing repeats across a bulk run, it would only cost memory
+        ocr = GLMOCR(args.model, device=args.device, max_new_tokens=args.max_new_tokens,
+                     max_batch_size=max(batch for _, batch in groups), vision_cache_bytes=0,
+                     cpu_precision=args.cpu_precision, num_threads=args.threads,
+                     kv_cache_budget_bytes=int(args.kv_cache_budget_mb * 1024**2), warmup=True)
+        progress = Progress(total)
+        try:
+            for (mode, batch), paths in groups.items():
+                log(f"[BULK] {len(paths)} files as {mode}, {batch} at a time")
+                run_group(ocr, paths, mode, batch, args.workers, output, progress, source_root)
+        finally:
+            ocr.close()
+            output.close()
+            progress.report(force=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def cache_key(image_digest, mode, signature):
+    """Content address for an OCR result: the image's SHA-256 hex digest + mode + model/generation signature.
+
+    The digest is the one the request computed once for every content-addressed
+    store (result cache, vision cache, uploads), so the image is not hashed again.
+    """
+    return hashlib.sha256(f"{image_digest}\0{mode}\0{signature}".encode()).hexdigest()
+
+
+class ResultCache:
+    """Two-tier cache of finished OCR outputs.
+
+    A bounded in-memory LRU sits in front of a size-capped directory of text
+    files. Entries older than `max_age` seconds are treated as misses and
+    removed; when a tier goes over its byte budget the least recently used
+    entries are evicted first (disk recency is tracked through file mtimes).
+    Safe to call from worker threads.
+    """
+
+    def __init__(self, directory, memory_max_bytes=64 * 1024**2, disk_max_bytes=512 * 1024**2, max_age=30 * 86400):
+        self.directory = directory
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+
+        self.memory = OrderedDict()  # key -> (text, created_at)
+        self.memory_bytes = 0
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0}
+
+        self.disk_bytes = 0
+        if self.disk_max_bytes:
+            os.makedirs(self.directory, exist_ok=True)
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".txt"):
+                    self.disk_bytes += entry.stat().st_size
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.txt")
+
+    def _expired(self, created_at):
+        return self.max_age and time.time() - created_at > self.max_age
+
+    def get(self, key):
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[1]):
+                    self.memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    return entry[0]
+                self._drop_memory(key)
+                self.counters["expired"] += 1
+
+            entry = self._read_disk(key)
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self.counters["disk_hits"] += 1
+            self._store_memory(key, *entry)
+            return entry[0]
+
+    def put(self, key, text):
+        with self.lock:
+            now = time.time()
+            self._store_memory(key, text, now)
+            self._write_disk(key, text, now)
+            self.counters["stores"] += 1
+
+    def _store_memory(self, key, text, created_at):
+        size = len(text.encode("utf-8"))
+        if size > self.memory_max_bytes:
+            return
+        if key in self.memory:
+            self._drop_memory(key)
+        self.memory[key] = (text, created_at)
+        self.memory_bytes += size
+        while self.memory_bytes > self.memory_max_bytes:
+            oldest = next(iter(self.memory))
+            self._drop_memory(oldest)
+            self.counters["evictions"] += 1
+
+    def _drop_memory(self, key):
+        text, _ = self.memory.pop(key)
+        self.memory_bytes -= len(text.encode("utf-8"))
+
+    def _read_disk(self, key):
+        if not self.disk_max_bytes:
+            return None
+        path = self._path(key)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        # First line holds the write time; mtime is bumped on every read for LRU order
+        with open(path, "r", encoding="utf-8") as f:
+            created_at = float(f.readline())
+            text = f.read()
+        if self._expired(created_at):
+            self._remove_disk(path, stat.st_size)
+            self.counters["expired"] += 1
+            return None
+        os.utime(path)
+        return text, created_at
+
+    def _write_disk(self, key, text, created_at):
+        if not self.disk_max_bytes:
+            return
+        data = f"{created_at}\n{text}".encode("utf-8")
+        if len(data) > self.disk_max_bytes:
+            return
+        path = self._path(key)
+        if os.path.exists(path):
+            self._remove_disk(path, os.path.getsize(path))
+        # Atomic replace so a concurrent reader never sees a half-written entry
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.disk_bytes += len(data)
+        if self.disk_bytes > self.disk_max_bytes:
+            self._evict_disk()
+
+    def _remove_disk(self, path, size):
+        try:
+            os.remove(path)
+            self.disk_bytes -= size
+        except FileNotFoundError:
+            pass
+
+    def _evict_disk(self):
+        entries = [e for e in os.scandir(self.directory) if e.name.endswith(".txt")]
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        # Entries not even read within max_age are certainly expired; drop those first
+        for entry in entries:
+            if self._expired(entry.stat().st_mtime):
+                self._remove_disk(entry.path, entry.stat().st_size)
+                self.counters["expired"] += 1
+        for entry in entries:
+            if self.disk_bytes <= self.disk_max_bytes:
+                break
+            if os.path.exists(entry.path):
+                self._remove_disk(entry.path, entry.stat().st_size)
+                self.counters["evictions"] += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counters["memory_hits"] + self.counters["disk_hits"] + self.counters["misses"]
+            hits = lookups - self.counters["misses"]
+            return {
+                **self.counters,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "memory_entries": len(self.memory),
+                "memory_bytes": self.memory_bytes,
+                "disk_bytes": self.disk_bytes,
+            }
@@ -1,10 +1,23 @@
-from transformers import AutoProcessor, AutoModelForImageTextToText, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+from transformers import AutoProcessor, AutoModelForImageTextToText, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer, DynamicCache, StaticCache, CompileConfig, QuantizedCache
+from transformers.modeling_outputs import BaseModelOutputWithPooling
+from transformers.utils import is_hqq_available, is_optimum_quanto_available
 import torch
+import torch.nn.functional as F
+import functools
+import hashlib
+import io
+import math
 import os
+import queue
+import re
 import threading
 import time
-from datetime import datetime
-from PIL import Image
+from collections import OrderedDict
+from PIL import Image, ImageOps
+from tiling import band_boxes, stitch_tables, stitch_text
+from pages import iter_pages
+import metrics
+from tracing import Trace
 
 class AbortCriteria(StoppingCriteria):
     def __init__(self, abort_event):
@@ -13,90 +26,1195 @@ class AbortCriteria(StoppingCriteria):
     def __call__(self, input_ids, scores, **kwargs):
         return self.abort_event.is_set()
 
+
+class TokenCounter(StoppingCriteria):
+    """Never stops; counts the decode steps it is called for (one per generated token)."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.count += 1
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+
+class MemoryPeak(StoppingCriteria):
+    """Never stops; the most CUDA memory allocated on `device` at any token boundary of the generation."""
+
+    def __init__(self, device):
+        self.device = device
+        self.peak = 0
+
+    def __call__(self, input_ids, scores, **kwargs):
+        # A host-side counter: no device sync
+        self.peak = max(self.peak, torch.cuda.memory_allocated(self.device))
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+
+class RepetitionCriteria(StoppingCriteria):
+    """Stops a sequence stuck in a loop, e.g. endless `<td></td>` or the same line over and over.
+
+    Fires when the generated tail is periodic with a period of at most
+    `max_period` tokens, covering at least `repeats` periods and `min_span`
+    tokens. Only checked every `check_every` tokens to stay off the hot path.
+    """
+
+    def __init__(self, prompt_length, max_period=64, repeats=8, min_span=96, check_every=8):
+        self.prompt_length = prompt_length
+        self.max_period = max_period
+        self.repeats = repeats
+        self.min_span = min_span
+        self.check_every = check_every
+        self.window = max(max_period * repeats, min_span) + max_period
+        self.steps = 0
+        self.fired = False
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.steps += 1
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        if self.steps % self.check_every:
+            return done
+        start = max(self.prompt_length, input_ids.shape[1] - self.window)
+        for row, tail in enumerate(input_ids[:, start:].tolist()):
+            for period in range(1, self.max_period + 1):
+                span = max(period * self.repeats, self.min_span)
+                if len(tail) < span + period:
+                    break
+                if tail[-span:] == tail[-span - period:-period]:
+                    done[row] = True
+                    self.fired = True
+                    break
+        return done
+
+
+class TableEndCriteria(StoppingCriteria):
+    """Stops `table` mode as soon as the outermost <table> element is closed."""
+
+    TAG = re.compile(r"(</table\s*>)|<table\b", re.IGNORECASE)
+
+    def __init__(self, tokenizer, prompt_length):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.rows = {}  # row -> [tokens seen, undecided text tail, depth, opened]
+        self.fired = False
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        for row in range(input_ids.shape[0]):
+            state = self.rows.setdefault(row, [self.prompt_length, "", 0, False])
+            text = state[1] + self.tokenizer.decode(input_ids[row, state[0]:].tolist())
+            state[0] = input_ids.shape[1]
+            end = 0
+            for match in self.TAG.finditer(text):
+                state[2] += -1 if match.group(1) else 1
+                state[3] = True
+                end = match.end()
+            # Keep a few characters in case a tag is split across tokens
+            state[1] = text[max(end, len(text) - 8):]
+            if state[3] and state[2] <= 0:
+                done[row] = True
+                self.fired = True
+        return done
+
+
+class GenerationRequest:
+    """One sequence admitted to the BatchScheduler.
+
+    Holds the prefill inputs, the per-sequence decode state (next token, rope
+    position, generated ids) and the streamer the tokens are pushed to.
+    """
+
+    def __init__(self, inputs, streamer=None, stopping_criteria=None, max_new_tokens=8192):
+        self.inputs = inputs
+        self.streamer = streamer
+        self.stopping_criteria = stopping_criteria or StoppingCriteriaList()
+        self.max_new_tokens = max_new_tokens
+
+        self.input_ids = inputs["input_ids"]
+        self.generated = []
+        self.next_token = None
+        self.position = None
+        self.error = None
+        self.cancelled = False
+        self.done = threading.Event()
+        # Decode forward passes and draft tokens proposed/accepted (speculative decoding)
+        self.steps = 0
+        self.drafted = 0
+        self.accepted = 0
+
+    def cancel(self):
+        # Picked up by the decode loop at the next token boundary
+        self.cancelled = True
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    def emit(self, token, eos_token_ids):
+        """Record a generated token; returns True once the sequence is finished."""
+        self.generated.append(token)
+        self.next_token = token
+        token_tensor = torch.tensor([[token]], device=self.input_ids.device)
+        self.input_ids = torch.cat([self.input_ids, token_tensor], dim=1)
+        if self.streamer is not None:
+            self.streamer.put(token_tensor[0].cpu())
+
+        if self.cancelled or token in eos_token_ids:
+            return True
+        if len(self.generated) >= self.max_new_tokens:
+            return True
+        return bool(self.stopping_criteria(self.input_ids, None).any())
+
+    def finish(self):
+        if self.streamer is not None:
+            self.streamer.end()
+        self.done.set()
+
+
+def _eos_token_ids(model):
+    eos = model.generation_config.eos_token_id
+    if eos is None:
+        return set()
+    if isinstance(eos, int):
+        return {eos}
+    return set(eos)
+
+
+def _prefill(model, request):
+    """Run the prompt of one request through the model on a fresh cache.
+
+    Returns (logits of the last prompt position, cache, attention mask) and
+    sets `request.position` to the rope position of the first new token.
+    """
+    inputs = request.inputs
+    # Compute M-RoPE positions here rather than inside forward, so the shared
+    # `rope_deltas` on the model is never touched by concurrent sequences.
+    position_ids, rope_deltas = model.model.get_rope_index(
+        inputs["input_ids"],
+        mm_token_type_ids=inputs["mm_token_type_ids"],
+        image_grid_thw=inputs.get("image_grid_thw"),
+        attention_mask=inputs.get("attention_mask"),
+    )
+    cache = DynamicCache(config=model.config)
+    outputs = model(
+        **inputs,
+        position_ids=position_ids,
+        past_key_values=cache,
+        use_cache=True,
+        logits_to_keep=1,
+    )
+    request.position = inputs["input_ids"].shape[1] + int(rope_deltas[0, 0])
+
+    if request.streamer is not None:
+        request.streamer.put(inputs["input_ids"].cpu())
+
+    mask = inputs.get("attention_mask")
+    if mask is None:
+        mask = torch.ones_like(inputs["input_ids"])
+    return outputs.logits[0, -1], cache, mask
+
+
+class BatchScheduler:
+    """Continuous batching decode loop shared by every request on one model.
+
+    Requests are queued with `submit` and admitted into the running batch at
+    token boundaries: each new request gets its own batch-size-1 prefill, its
+    KV cache is left-padded and concatenated onto the running cache, and from
+    then on a single forward pass decodes one token for every active sequence.
+    Finished sequences are retired from the batch immediately so the next
+    queued request can take their slot.
+
+    Decoding is greedy, matching the defaults used by `model.generate`.
+    Running out of device memory costs one sequence its place, not the
+    whole batch: the one being admitted, or else the longest in the batch,
+    finishes with a `torch.OutOfMemoryError` that its caller answers by
+    continuing it on its own (see GLMOCR._resume_off_batch).
+    """
+
+    def __init__(self, ocr, max_batch_size=8):
+        self.ocr = ocr
+        self.model = ocr.model
+        self.max_batch_size = max(1, int(max_batch_size))
+
+        self.eos_token_ids = _eos_token_ids(self.model)
+
+        self.pending = []
+        self.active = []
+        self.cache = None
+        self.attention_mask = None
+        self.condition = threading.Condition()
+        self.thread = None
+        self.closed = False
+
+    def submit(self, request):
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("Batch scheduler is closed")
+            self.pending.append(request)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._loop, name="glm-batch-scheduler", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return request
+
+    def stats(self):
+        with self.condition:
+            return {"active": len(self.active), "pending": len(self.pending)}
+
+    def close(self):
+        """Stop the loop after its current step and wait for it; unfinished requests fail.
+
+        A loop thread still inside torch when the interpreter exits can abort the process.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+
+    def _loop(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.active and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    unfinished = self.active + self.pending
+                    self.active, self.pending, self.cache, self.attention_mask = [], [], None, None
+                    for request in unfinished:
+                        request.error = RuntimeError("Batch scheduler closed")
+                        request.finish()
+                    return
+                free_slots = self.max_batch_size - len(self.active)
+                admitted = self.pending[:free_slots]
+                del self.pending[:free_slots]
+
+            try:
+                with torch.no_grad():
+                    for request in admitted:
+                        self._prefill(request)
+                    if self.active:
+                        try:
+                            self._decode_step()
+                        except torch.OutOfMemoryError as e:
+                            self._evict(e)
+            except Exception as e:
+                print(f"Batch scheduler error: {e}")
+                failed = self.active + [r for r in admitted if not r.done.is_set()]
+                self.active, self.cache, self.attention_mask = [], None, None
+                for request in failed:
+                    request.error = e
+                    request.finish()
+
+    def _prefill(self, request):
+        if request.cancelled:
+            request.finish()
+            return
+
+        try:
+            logits, cache, mask = _prefill(self.model, request)
+            if request.emit(int(logits.argmax()), self.eos_token_ids):
+                request.finish()
+                return
+            self._merge(request, cache, mask)
+        except torch.OutOfMemoryError as e:
+            # The running batch is untouched until the merge succeeds
+            cache = mask = None
+            _free_device_memory()
+            print("Batch scheduler out of memory admitting a request; it continues outside the batch")
+            request.error = e
+            request.finish()
+
+    def _merge(self, request, cache, mask):
+        if not self.active:
+            self.active = [request]
+            self.cache = cache
+            self.attention_mask = mask
+            return
+
+        current = self.attention_mask.shape[1]
+        incoming = mask.shape[1]
+        length = max(current, incoming)
+        layers = []
+        for (keys, values, _), (new_keys, new_values, _) in zip(self.cache, cache):
+            layers.append((
+                torch.cat([_pad_left(keys, length - current), _pad_left(new_keys, length - incoming)]),
+                torch.cat([_pad_left(values, length - current), _pad_left(new_values, length - incoming)]),
+            ))
+        self.cache = DynamicCache(layers)
+        self.attention_mask = torch.cat([
+            F.pad(self.attention_mask, (length - current, 0)),
+            F.pad(mask, (length - incoming, 0)),
+        ])
+        self.active.append(request)
+
+    def _decode_step(self):
+        batch_size = len(self.active)
+        device = self.attention_mask.device
+        input_ids = torch.tensor([[r.next_token] for r in self.active], device=device)
+        position_ids = torch.tensor([r.position for r in self.active], device=device)
+        position_ids = position_ids.view(1, batch_size, 1).expand(3, batch_size, 1)
+        attention_mask = torch.cat(
+            [self.attention_mask, self.attention_mask.new_ones((batch_size, 1))], dim=1
+        )
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self.cache,
+            use_cache=True,
+        )
+        self.attention_mask = attention_mask
+        tokens = outputs.logits[:, -1].argmax(dim=-1).tolist()
+
+        keep = []
+        finished = []
+        for index, (request, token) in enumerate(zip(self.active, tokens)):
+            request.position += 1
+            if request.emit(token, self.eos_token_ids):
+                finished.append(request)
+            else:
+                keep.append(index)
+
+        if finished:
+            self._retire(keep)
+        for request in finished:
+            request.finish()
+
+    def _evict(self, error):
+        """Drop the longest sequence after a decode step ran out of memory; the rest carry on."""
+        # Layers the failed step got to hold one position too many
+        length = self.attention_mask.shape[1]
+        self.cache = DynamicCache([(k[:, :, :length], v[:, :, :length]) for k, v, _ in self.cache])
+        _free_device_memory()
+        victim = max(range(len(self.active)), key=lambda i: self.active[i].input_ids.shape[1])
+        request = self.active[victim]
+        print(f"Batch scheduler out of memory at {len(self.active)} sequences; "
+              f"the longest ({request.input_ids.shape[1]} tokens) continues outside the batch")
+        self._retire([i for i in range(len(self.active)) if i != victim])
+        request.error = error
+        request.finish()
+
+    def _retire(self, keep):
+        if not keep:
+            self.active, self.cache, self.attention_mask = [], None, None
+            return
+        self.active = [self.active[i] for i in keep]
+        indices = torch.tensor(keep, device=self.attention_mask.device)
+        self.cache.batch_select_indices(indices)
+        self.attention_mask = self.attention_mask[indices]
+
+        # Drop the left padding no remaining sequence needs any more
+        start = int(self.attention_mask.any(dim=0).nonzero()[0])
+        if start > 0:
+            self.attention_mask = self.attention_mask[:, start:]
+            self.cache = DynamicCache([(k[:, :, start:], v[:, :, start:]) for k, v, _ in self.cache])
+
+
+def _extend_inputs(inputs, tokens):
+    """`inputs` with `tokens` appended to the prompt, to rerun a sequence so far on a new cache."""
+    extended = dict(inputs)
+    ids = torch.tensor([tokens], dtype=inputs["input_ids"].dtype, device=inputs["input_ids"].device)
+    extended["input_ids"] = torch.cat([inputs["input_ids"], ids], dim=1)
+    if "attention_mask" in inputs:
+        extended["attention_mask"] = torch.cat([inputs["attention_mask"], torch.ones_like(ids)], dim=1)
+    if "mm_token_type_ids" in inputs:
+        extended["mm_token_type_ids"] = torch.cat([inputs["mm_token_type_ids"], torch.zeros_like(ids)], dim=1)
+    return extended
+
+
+def _free_device_memory():
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def _pad_left(tensor, amount):
+    # KV tensors are [batch, heads, seq, head_dim]; pad the sequence axis
+    if amount == 0:
+        return tensor
+    return F.pad(tensor, (0, 0, amount, 0))
+
+
+class NgramIndex:
+    """Where each recent n-gram of the output last ended, for drafting continuations.
+
+    After every token the longest suffix (up to `max_ngram` tokens) that
+    occurred before is looked up, and the tokens that followed it back then
+    become the draft. Updates and lookups are O(max_ngram).
+    """
+
+    def __init__(self, max_ngram=3):
+        self.max_ngram = max_ngram
+        self.tokens = []
+        self.last_end = {}
+        self.match_end = None
+
+    def append(self, token):
+        self.tokens.append(token)
+        end = len(self.tokens)
+        self.match_end = None
+        for n in range(min(self.max_ngram, end), 0, -1):
+            key = tuple(self.tokens[end - n:])
+            previous = self.last_end.get(key)
+            self.last_end[key] = end
+            if self.match_end is None and previous is not None:
+                self.match_end = previous
+
+    def draft(self, size):
+        if self.match_end is None:
+            return []
+        return self.tokens[self.match_end:self.match_end + size]
+
+
+class SpeculativeDecoder:
+    """Greedy decoding with drafts looked up in the sequence's own output.
+
+    Table markup repeats itself (`<tr>`, `<td>`, closing tags, whole column
+    patterns), so the tokens that followed the last occurrence of the current
+    n-gram are a cheap guess at what comes next. Each step feeds the pending
+    token plus up to `draft_tokens` guesses in one forward pass, keeps the
+    guesses the model agrees with and one more token from its own prediction,
+    and crops the rejected positions off the KV cache. The output is exactly
+    what plain greedy decoding produces; only the number of forward passes
+    changes. Runs one sequence at a time on the caller's thread.
+    """
+
+    def __init__(self, model, draft_tokens=8, max_ngram=3):
+        self.model = model
+        self.draft_tokens = draft_tokens
+        self.max_ngram = max_ngram
+        self.eos_token_ids = _eos_token_ids(model)
+
+    def run(self, request):
+        try:
+            with torch.no_grad():
+                self._run(request)
+        except Exception as e:
+            print(f"Speculative decoding error: {e}")
+            request.error = e
+        finally:
+            request.finish()
+        return request
+
+    def _run(self, request):
+        if request.cancelled:
+            return
+        logits, cache, mask = _prefill(self.model, request)
+        index = NgramIndex(self.max_ngram)
+        token = int(logits.argmax())
+        index.append(token)
+        if request.emit(token, self.eos_token_ids):
+            return
+
+        device = mask.device
+        while True:
+            draft = index.draft(min(self.draft_tokens, request.max_new_tokens - len(request.generated) - 1))
+            input_ids = torch.tensor([[request.next_token] + draft], device=device)
+            length = input_ids.shape[1]
+            position_ids = torch.arange(request.position, request.position + length, device=device)
+            position_ids = position_ids.view(1, 1, length).expand(3, 1, length)
+            mask = torch.cat([mask, mask.new_ones((1, length))], dim=1)
+
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=mask,
+                position_ids=position_ids,
+                past_key_values=cache,
+                use_cache=True,
+            )
+            predicted = outputs.logits[0].argmax(dim=-1).tolist()
+            accepted = 0
+            while accepted < len(draft) and draft[accepted] == predicted[accepted]:
+                accepted += 1
+            request.steps += 1
+            request.drafted += len(draft)
+            request.accepted += accepted
+
+            # Only the pending token and the accepted guesses stay in the cache;
+            # the model's own next prediction becomes the new pending token
+            rejected = len(draft) - accepted
+            if rejected:
+                cache.crop(-rejected)
+                mask = mask[:, :-rejected]
+            request.position += accepted + 1
+            for token in draft[:accepted] + [predicted[accepted]]:
+                index.append(token)
+                if request.emit(token, self.eos_token_ids):
+                    return
+
+
+class StaticCachePool:
+    """Preallocated KV caches for `model.generate`, with the decode step compiled.
+
+    A dynamic cache grows by one position per layer every token; a static
+    cache is allocated once at its full length, so the decode forward sees
+    the same shapes every step and `torch.compile` can specialise it. Cache
+    lengths come from `buckets`: a request takes the smallest bucket that
+    fits its prompt plus its token budget, and each bucket compiles to one
+    graph whatever the prompt length, so warming every bucket up once means
+    no request recompiles. Caches are reset and reused, one per concurrent
+    request and bucket. Batches (tiled bands) and requests longer than the
+    largest bucket run on a dynamic cache as before. Prefill stays eager.
+
+    `model.generate` only compiles on accelerators, so the pool compiles the
+    forward itself, with `compile_config`, and routes single-token steps on a
+    static cache to it on any device; generate's own compilation is turned off.
+    """
+
+    def __init__(self, model, buckets, compile_config=None):
+        self.model = model
+        self.buckets = sorted(set(int(bucket) for bucket in buckets))
+        self.free = {bucket: [] for bucket in self.buckets}
+        self.lock = threading.Lock()
+        self.compile_config = compile_config or CompileConfig()
+        self.counters = {"requests": 0, "allocated": 0, "fallbacks": 0}
+        eager = model.forward
+        compiled = torch.compile(eager, **self.compile_config.to_dict())
+
+        # Wrapped so generate still validates its arguments against the model's signature
+        @functools.wraps(eager)
+        def forward(*args, **kwargs):
+            input_ids = kwargs.get("input_ids")
+            if (isinstance(kwargs.get("past_key_values"), StaticCache)
+                    and input_ids is not None and input_ids.shape[1] == 1):
+                return compiled(*args, **kwargs)
+            return eager(*args, **kwargs)
+
+        model.forward = forward
+
+    def bucket(self, length):
+        return next((bucket for bucket in self.buckets if bucket >= length), None)
+
+    def generate(self, inputs, max_new_tokens, bucket=None, **kwargs):
+        if bucket is None and inputs["input_ids"].shape[0] == 1:
+            bucket = self.bucket(inputs["input_ids"].shape[1] + max_new_tokens)
+        if bucket is None:
+            with self.lock:
+                self.counters["fallbacks"] += 1
+            return self.model.generate(**inputs, max_new_tokens=max_new_tokens, **kwargs)
+
+        with self.lock:
+            self.counters["requests"] += 1
+            cache = self.free[bucket].pop() if self.free[bucket] else None
+        if cache is None:
+            cache = StaticCache(config=self.model.config, max_cache_len=bucket)
+            with self.lock:
+                self.counters["allocated"] += 1
+        try:
+            return self.model.generate(**inputs, max_new_tokens=max_new_tokens, past_key_values=cache,
+                                       disable_compile=True, **kwargs)
+        finally:
+            cache.reset()
+            with self.lock:
+                self.free[bucket].append(cache)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats["buckets"] = len(self.buckets)
+        return stats
+
+
+# KV cache strategies, fastest first, most compact last
+KV_STRATEGIES = ("full", "quantized", "offloaded")
+
+
+def _quantized_backend():
+    """The installed KV cache quantisation backend, or None."""
+    if is_optimum_quanto_available():
+        return "quanto"
+    if is_hqq_available():
+        return "hqq"
+    return None
+
+
+class KVReservation:
+    """A generation's share of a KVCacheBudget: the cache strategy it runs with and the bytes set aside."""
+
+    def __init__(self, tokens, rows, strategy, size, waited, batched):
+        self.tokens = tokens
+        self.rows = rows
+        self.strategy = strategy
+        self.size = size
+        self.waited = waited
+        # Rows in the scheduler's shared batch, accounted at the batch's padded length
+        self.batched = batched
+        self.released = False
+
+
+class KVCacheBudget:
+    """Admits generations against a memory budget for their KV caches.
+
+    A request reserves what its cache holds at its longest, prompt plus token
+    budget, under the first strategy that fits beside what running requests
+    have reserved: "full" keeps the cache in the model's dtype, "quantized"
+    stores it in 4 bits (optimum-quanto or HQQ, when installed) and
+    "offloaded" keeps all but the layer in use and the next one in host
+    memory (models on an accelerator only). When none fits, the request
+    waits for running ones to release theirs; a request too long to fit
+    even alone runs over the budget on the most compact strategy rather
+    than failing. Full-precision rows headed for the scheduler's shared
+    batch are left-padded to its longest row, so together they are
+    accounted as rows times the longest reservation among them.
+    """
+
+    def __init__(self, model, budget_bytes, quantized_backend="auto", nbits=4, residual_length=128):
+        config = model.config.get_text_config()
+        heads = config.num_attention_heads
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // heads
+        kv_heads = getattr(config, "num_key_value_heads", None) or heads
+        self.model = model
+        self.layers = config.num_hidden_layers
+        self.itemsize = model.dtype.itemsize
+        # Keys and values of every layer
+        self.bytes_per_token = 2 * self.layers * kv_heads * head_dim * self.itemsize
+        self.budget_bytes = budget_bytes
+        self.nbits = nbits
+        self.residual_length = residual_length
+        self.quantized_backend = _quantized_backend() if quantized_backend == "auto" else quantized_backend
+        self.strategies = ["full"]
+        if self.quantized_backend:
+            self.strategies.append("quantized")
+        if model.device.type != "cpu":
+            # Offloading moves layers to host memory: nothing to gain when that is where they live
+            self.strategies.append("offloaded")
+        self.condition = threading.Condition()
+        self.unbatched = 0
+        # Token length of every reserved row of the shared batch
+        self.batch = []
+        self.counters = {"peak_reserved": 0, "waited": 0, "over_budget": 0, "oom_fallbacks": 0,
+                         **{strategy: 0 for strategy in KV_STRATEGIES}}
+
+    def estimate(self, tokens, strategy="full"):
+        """Device bytes of one sequence's KV cache holding `tokens` positions."""
+        full = tokens * self.bytes_per_token
+        if strategy == "quantized":
+            # Packed codes plus a scale and zero point per group of 64 values, the latest
+            # tokens kept as they are until the next requantisation, which briefly
+            # dequantises one layer in full
+            codes = full * self.nbits // (8 * self.itemsize) + full * 2 // 64
+            residual = min(tokens, self.residual_length) * self.bytes_per_token
+            return codes + residual + full // self.layers
+        if strategy == "offloaded":
+            # The layer in use and the one being prefetched
+            return full * min(2, self.layers) // self.layers
+        return full
+
+    def _batch_bytes(self, lengths):
+        return len(lengths) * max(lengths, default=0) * self.bytes_per_token
+
+    def _reserved(self):
+        return self.unbatched + self._batch_bytes(self.batch)
+
+    def _cost(self, tokens, rows, strategy, batched):
+        if strategy == "full" and batched:
+            # Joining the batch can pad every row already in it to this one's length
+            return self._batch_bytes(self.batch + [tokens] * rows) - self._batch_bytes(self.batch)
+        return rows * self.estimate(tokens, strategy)
+
+    def reserve(self, tokens, abort_event=None, rows=1, batched=False):
+        """Blocks until a strategy fits (or `abort_event` is set); returns a KVReservation.
+
+        `rows` sequences of up to `tokens` positions each; `batched` when at
+        full precision they would decode in the scheduler's shared batch.
+        """
+        waited = False
+        with self.condition:
+            while True:
+                reserved = self._reserved()
+                for strategy in self.strategies:
+                    size = self._cost(tokens, rows, strategy, batched)
+                    if reserved + size <= self.budget_bytes:
+                        return self._take(tokens, rows, strategy, size, waited, batched)
+                strategy = self.strategies[-1]
+                size = self._cost(tokens, rows, strategy, batched)
+                # Too large even with nothing else running: waiting would not help
+                alone = self._cost(tokens, rows, strategy, False)
+                if alone > self.budget_bytes:
+                    self.counters["over_budget"] += 1
+                    print(f"[KV] {rows}x{tokens} tokens need {alone / 1024**2:.0f} MB as {strategy}, "
+                          f"over the {self.budget_bytes / 1024**2:.0f} MB budget; running anyway")
+                    return self._take(tokens, rows, strategy, size, waited, batched)
+                if abort_event is not None and abort_event.is_set():
+                    # Generation stops at its first token; no point holding it here
+                    return self._take(tokens, rows, strategy, size, waited, batched)
+                if not waited:
+                    waited = True
+                    self.counters["waited"] += 1
+                self.condition.wait(0.1)
+
+    def _take(self, tokens, rows, strategy, size, waited, batched):
+        batched = batched and strategy == "full"
+        if batched:
+            self.batch.extend([tokens] * rows)
+        else:
+            self.unbatched += size
+        self.counters["peak_reserved"] = max(self.counters["peak_reserved"], self._reserved())
+        self.counters[strategy] += 1
+        return KVReservation(tokens, rows, strategy, size, waited, batched)
+
+    def _drop(self, reservation):
+        if reservation.batched:
+            for _ in range(reservation.rows):
+                self.batch.remove(reservation.tokens)
+        else:
+            self.unbatched -= reservation.size
+
+    def release(self, reservation):
+        with self.condition:
+            if reservation.released:
+                return
+            reservation.released = True
+            self._drop(reservation)
+            self.condition.notify_all()
+
+    def fallback(self, reservation):
+        """Moves `reservation` off the shared batch, to the next more compact strategy when there
+        is one, after running out of memory; returns whether the strategy changed."""
+        with self.condition:
+            if reservation.released:
+                return False
+            index = self.strategies.index(reservation.strategy) + 1
+            changed = index < len(self.strategies)
+            if changed:
+                self.counters["oom_fallbacks"] += 1
+                reservation.strategy = self.strategies[index]
+            elif not reservation.batched:
+                return False
+            # Now a sequence of its own, accounted without the batch's padding
+            self._drop(reservation)
+            reservation.batched = False
+            reservation.size = self._cost(reservation.tokens, reservation.rows, reservation.strategy, False)
+            self.unbatched += reservation.size
+            self.condition.notify_all()
+            return changed
+
+    def new_cache(self, strategy):
+        """A cache for `model.generate` under `strategy`; None lets generate make its usual one."""
+        if strategy == "quantized":
+            return QuantizedCache(self.quantized_backend, config=self.model.config, nbits=self.nbits,
+                                  residual_length=self.residual_length)
+        if strategy == "offloaded":
+            return DynamicCache(config=self.model.config, offloading=True)
+        return None
+
+    def stats(self):
+        with self.condition:
+            return {"budget_bytes": self.budget_bytes, "reserved_bytes": self._reserved(), **self.counters}
+
+
+class VisionCache:
+    """LRU of vision-tower outputs keyed by image content hash.
+
+    An entry holds the image grid and the merged patch embeddings the
+    language model consumes, plus how long preprocessing and encoding took,
+    so a hit can report the time it saved. Embeddings are kept in host
+    memory, optionally as float16, and the total is bounded by `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=256 * 1024**2, half_precision=False):
+        self.max_bytes = max_bytes
+        self.half_precision = half_precision
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, image_grid_thw, embeds, encode_seconds):
+        embeds = embeds.detach().to("cpu", torch.float16 if self.half_precision else embeds.dtype)
+        size = embeds.numel() * embeds.element_size()
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)["bytes"]
+            self.entries[key] = {
+                "image_grid_thw": image_grid_thw.cpu(),
+                "embeds": embeds,
+                "encode_seconds": encode_seconds,
+                "bytes": size,
+            }
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted["bytes"]
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.total_bytes}
+
+
+def load_image(image, max_pixels=None, key=None):
+    """Decode a file path, raw bytes or PIL image once.
+
+    Returns (RGB image, content key, original (width, height)); the key hashes
+    the encoded bytes when there are any, so it matches however the same
+    upload arrives. A caller that already has the SHA-256 hex digest of the
+    bytes passes it as `key` and nothing is hashed again. With `max_pixels`,
+    JPEGs are decoded at the smallest DCT scale that still has at least that
+    many pixels.
+    """
+    if isinstance(image, Image.Image):
+        if key is None:
+            key = hashlib.sha256(f"{image.mode}{image.size}".encode() + image.tobytes()).hexdigest()
+    else:
+        if not isinstance(image, (bytes, bytearray)):
+            with open(image, "rb") as f:
+                image = f.read()
+        if key is None:
+            key = hashlib.sha256(image).hexdigest()
+        image = Image.open(io.BytesIO(image))
+    original_size = image.size
+    if max_pixels and image.format == "JPEG" and image.width * image.height > max_pixels:
+        scale = math.sqrt(max_pixels / (image.width * image.height))
+        image.draft("RGB", (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+    # Same normalisation the processor applies, so it has nothing left to do
+    image = ImageOps.exif_transpose(image).convert("RGB")
+    return image, key, original_size
+
+
+# Weight formats for a model running on the CPU (see GLMOCR's cpu_precision);
+# "auto" keeps the checkpoint's dtype
+CPU_PRECISIONS = ("auto", "fp32", "bf16", "int8")
+
+
+def bf16_supported():
+    """Whether oneDNN has native bf16 kernels on this CPU (AVX512-BF16/AMX); emulated bf16 is slower than fp32."""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def set_cpu_threads(num_threads=None, interop_threads=None):
+    """Size torch's intra-op and inter-op thread pools; 0 or None keeps torch's default."""
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            # Only allowed before the first inter-op parallel work in the process
+            print(f"Could not set inter-op threads: {e}")
+
+
+# Tokens of chat template and prompt text around the visual tokens
+PROMPT_OVERHEAD = 256
+
+# Why a generation ended, as counted in GLMOCR.stop_counts
+STOP_REASONS = ("eos", "max_new_tokens", "budget", "repetition", "table_end", "aborted")
+
+
 class GLMOCR:
-    def __init__(self, model_path="zai-org/GLM-OCR", device="auto"):
+    def __init__(self, model_path="zai-org/GLM-OCR", device="auto", max_batch_size=8, max_new_tokens=8192,
+                 vision_cache_bytes=256 * 1024**2, vision_cache_half=False, image_token_budget=None,
+                 output_token_ratio=None, stop_on_repetition=True, stop_on_table_end=True,
+                 speculative_draft_tokens=0, cpu_precision="auto", num_threads=None, interop_threads=None,
+                 static_cache_buckets=None, kv_cache_budget_bytes=0, warmup=False, progress=None):
+        """`cpu_precision` applies to a model on the CPU: "auto" keeps the checkpoint
+        dtype, "bf16" is used only where the CPU has native bf16 kernels (else
+        fp32), and "int8" quantises the language model's linear layers
+        dynamically and runs everything else in fp32. `static_cache_buckets`
+        (cache lengths, or "auto") runs every request through `model.generate`
+        on a preallocated static KV cache with a compiled decode step; see
+        StaticCachePool. `kv_cache_budget_bytes` bounds the memory the KV caches
+        of concurrent requests may take, degrading long requests to a quantised
+        or offloaded cache; see KVCacheBudget. `progress`, if given, is called
+        with the name of each loading stage as it starts."""
+        self.progress = progress or (lambda stage: None)
+        if cpu_precision not in CPU_PRECISIONS:
+            raise ValueError(f"Unknown cpu_precision {cpu_precision!r}, use one of {CPU_PRECISIONS}")
+        # Before loading: the thread pools cannot all be resized once torch has used them
+        set_cpu_threads(num_threads, interop_threads)
+        on_cpu = device == "cpu" or (device == "auto" and not torch.cuda.is_available())
+        # cpu_precision only applies on the CPU; GPUs keep the checkpoint dtype
+        self.precision = cpu_precision if on_cpu else "auto"
+        if self.precision == "bf16" and not bf16_supported():
+            print("bf16 requested but this CPU has no native bf16 kernels, keeping fp32")
+            self.precision = "fp32"
+
         print(f"Loading model from {model_path}...")
+        self.progress("loading processor")
         self.processor = AutoProcessor.from_pretrained(model_path)
+        self.progress("loading weights")
         self.model = AutoModelForImageTextToText.from_pretrained(
             pretrained_model_name_or_path=model_path,
-            torch_dtype="auto",
+            torch_dtype=torch.bfloat16 if self.precision == "bf16" else "auto",
             device_map=device,
+            # Only safetensors weights: fail instead of falling back to a pickled checkpoint
+            use_safetensors=True,
         )
+        if self.precision in ("fp32", "int8"):
+            self.model.float()
+        if self.precision == "int8":
+            self.progress("quantizing")
+            # Decoding on the CPU is bound by reading the language model's weights every
+            # token: int8 weights with activations quantised on the fly read 4x less.
+            # The vision encoder runs once per image and stays in floating point.
+            torch.ao.quantization.quantize_dynamic(
+                self.model.model.language_model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+            # quantize_dynamic only swaps children, hence the wrapper for the bare head
+            self.model.lm_head = torch.ao.quantization.quantize_dynamic(
+                torch.nn.Sequential(self.model.lm_head), {torch.nn.Linear}, dtype=torch.qint8)[0]
         self.device = self.model.device
-        self.abort_event = threading.Event()
-        print(f"Model loaded on {self.device}")
+        # Hub commit hash when available, so cached results die with the weights
+        self.revision = getattr(self.model.config, "_commit_hash", None) or model_path
+        self.max_new_tokens = max_new_tokens
+        # max_batch_size=0 falls back to one model.generate thread per request
+        self.scheduler = BatchScheduler(self, max_batch_size) if max_batch_size else None
+        if speculative_draft_tokens and static_cache_buckets:
+            raise ValueError("Speculative decoding and the static KV cache cannot be combined")
+        # Opt-in n-gram speculative decoding; takes single-image requests off the batch scheduler
+        self.speculative = SpeculativeDecoder(self.model, speculative_draft_tokens) if speculative_draft_tokens else None
+        # vision_cache_bytes=0 re-encodes the image on every request
+        self.vision_cache = VisionCache(vision_cache_bytes, vision_cache_half) if vision_cache_bytes else None
+        # Max visual tokens per mode ({"table": n, "text": n}); missing or 0 leaves sizing to the processor
+        self.image_token_budget = dict(image_token_budget or {})
+        image_processor = self.processor.image_processor
+        # Side of the pixel square that becomes one visual token after patch merging
+        self.token_side = image_processor.patch_size * image_processor.merge_size
+        # Output tokens allowed per visual token, per mode; caps max_new_tokens for small images
+        self.output_token_ratio = dict(output_token_ratio or {})
+        self.stop_on_repetition = stop_on_repetition
+        self.stop_on_table_end = stop_on_table_end
+        # How each generation ended, for tuning the criteria above
+        self.stop_counts = {reason: 0 for reason in STOP_REASONS}
+        self.stop_lock = threading.Lock()
+        self.static_caches = None
+        if static_cache_buckets:
+            if static_cache_buckets == "auto":
+                static_cache_buckets = self._static_cache_buckets()
+            # The compiled decode step serves one sequence; requests run one generate per thread
+            self.scheduler = None
+            self.static_caches = StaticCachePool(self.model, static_cache_buckets)
+            print(f"Static KV cache buckets: {', '.join(map(str, self.static_caches.buckets))} tokens")
+        # 0 leaves every request's cache unbounded, at full precision
+        self.kv_budget = KVCacheBudget(self.model, kv_cache_budget_bytes) if kv_cache_budget_bytes else None
+        if self.kv_budget is not None:
+            print(f"KV cache budget: {kv_cache_budget_bytes / 1024**2:.0f} MB "
+                  f"({', '.join(self.kv_budget.strategies)}; {self.kv_budget.bytes_per_token} bytes/token at full precision)")
+        print(f"Model loaded on {self.device} ({self.precision if self.precision != 'auto' else self.model.dtype})")
+        if warmup:
+            self.warmup()
 
-    def process_image(self, image_path, type="table"):
-        # Reset abort event at start of processing
-        self.abort_event.clear()
-        
-        table_prompt =  {
-            "type": "table",
-            "table": "Table Recognition:"
-        }
-        text_prompt = {
-            "type": "text",
-            "text": "Text Recognition:",
-        }
-        
-        selected_prompt = table_prompt if type == "table" else text_prompt
-        
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image",
-                        "url": image_path
-                    },
-                    selected_prompt
-                ],
-            }
-        ]
-        
+    def _static_cache_buckets(self):
+        """Powers of two from 1024 tokens up to the longest prompt plus token budget a request can have."""
+        lengths = [tokens + PROMPT_OVERHEAD + self._token_budget(mode, tokens)
+                   for mode, tokens in self.image_token_budget.items() if tokens]
+        # Without a budget, assume a prompt of 4096 visual tokens
+        longest = max(lengths, default=4096 + PROMPT_OVERHEAD + self.max_new_tokens)
+        buckets = [1024]
+        while buckets[-1] < longest:
+            buckets.append(buckets[-1] * 2)
+        return buckets
+
+    def _generate(self, inputs, kv_strategy="full", **kwargs):
+        """`model.generate`, on a static KV cache when the pool is enabled, or on a
+        quantised or offloaded cache when the KV budget picked one."""
+        if kv_strategy != "full":
+            return self.model.generate(**inputs, past_key_values=self.kv_budget.new_cache(kv_strategy), **kwargs)
+        if self.static_caches is not None:
+            return self.static_caches.generate(inputs, **kwargs)
+        return self.model.generate(**inputs, **kwargs)
+
+    def _reserve_kv(self, tokens, abort_event, trace=None, rows=1, batched=None):
+        """A KVReservation for `rows` sequences holding `tokens` positions at most, or None without a budget.
+
+        `batched` says whether at full precision they would join the scheduler's
+        shared batch, which single requests do unless speculative decoding takes them.
+        """
+        if self.kv_budget is None:
+            return None
+        if batched is None:
+            batched = self.scheduler is not None and self.speculative is None
+        with (trace or Trace()).span("kv_wait"):
+            return self.kv_budget.reserve(tokens, abort_event, rows=rows, batched=batched)
+
+    def _resume_off_batch(self, request, reservation):
+        """Continue a sequence the scheduler dropped when the device ran out of memory.
+
+        The prompt plus the tokens generated so far go through `model.generate`
+        on their own, on the next more compact KV cache when the budget has
+        one, streaming on where the batch stopped. Returns the ids generated
+        after resuming.
+        """
+        if reservation is not None and self.kv_budget.fallback(reservation):
+            print(f"[KV] Continuing on the {reservation.strategy} KV cache")
+        remaining = request.max_new_tokens - len(request.generated)
+        if remaining <= 0:
+            return []
+        inputs = _extend_inputs(request.inputs, request.generated)
+        counter = next((c for c in request.stopping_criteria if isinstance(c, TokenCounter)), TokenCounter())
+        with torch.no_grad():
+            output = self._generate_reserved(inputs, reservation, counter, max_new_tokens=remaining,
+                                             stopping_criteria=request.stopping_criteria, streamer=request.streamer)
+        return output[0, inputs["input_ids"].shape[1]:].tolist()
+
+    def _generate_reserved(self, inputs, reservation, counter, **kwargs):
+        """`_generate` under the reservation's KV cache strategy, then releases it.
+
+        Running out of device memory before anything was streamed retries on
+        the next more compact strategy instead of failing the request.
+        """
+        if reservation is None:
+            return self._generate(inputs, **kwargs)
+        streamer = kwargs.get("streamer")
+        try:
+            while True:
+                try:
+                    return self._generate(inputs, kv_strategy=reservation.strategy, **kwargs)
+                except torch.OutOfMemoryError:
+                    if (streamer is not None and counter.count) or not self.kv_budget.fallback(reservation):
+                        raise
+                    print(f"[KV] Out of memory, retrying on the {reservation.strategy} KV cache")
+                    torch.cuda.empty_cache()
+                    counter.count = 0
+                    if streamer is not None:
+                        # The retry puts the prompt again, which the streamer has to skip again
+                        streamer.next_tokens_are_prompt = True
+        finally:
+            self.kv_budget.release(reservation)
+
+    def _report_kv(self, reservation, type, tokens, criteria, trace=None):
+        """Log and record the KV cache strategy a generation ran with and how large it grew."""
+        if trace is not None and reservation.strategy != "full":
+            trace.mark("kv_cache_degraded")
+        mode = "table" if type == "table" else "text"
+        peak = self.kv_budget.estimate(tokens, reservation.strategy)
+        metrics.KV_CACHE_STRATEGY.labels(mode, reservation.strategy).inc()
+        metrics.KV_CACHE_PEAK_BYTES.labels(mode).observe(peak)
+        line = (f"[METRICS] KV cache: {reservation.strategy}{' (waited for budget)' if reservation.waited else ''}"
+                f" | Reserved: {reservation.size / 1024**2:.1f} MB | Peak: {peak / 1024**2:.1f} MB")
+        if "memory" in criteria:
+            line += f" | Device peak: {criteria['memory'].peak / 1024**2:.0f} MB"
+        print(line)
+
+    def _blank_inputs(self, side):
+        image = Image.new("RGB", (side, side), "white")
         inputs = self.processor.apply_chat_template(
-            messages,
+            self._messages(image, "text"),
             tokenize=True,
             add_generation_prompt=True,
             return_dict=True,
             return_tensors="pt"
         ).to(self.device)
-        
         inputs.pop("token_type_ids", None)
-        
-        stopping_criteria = StoppingCriteriaList([AbortCriteria(self.abort_event)])
-        
-        with torch.no_grad():
-            generated_ids = self.model.generate(
-                **inputs, 
-                max_new_tokens=8192,
-                stopping_criteria=stopping_criteria
-            )
-            
-        if self.abort_event.is_set():
-            print("Generation aborted by user.")
-            return "<!-- Process Aborted -->"
-            
-        output_text = self.processor.decode(generated_ids[0][inputs["input_ids"].shape[1]:], skip_special_tokens=False)
-        return output_text
+        return inputs
 
-    def process_image_stream(self, image_path, type="table"):
-        # Metrics initialization
-        start_time = time.time()
-        first_token_time = None
-        full_text = ""
-        
-        # Get Image Dimensions
-        try:
-            with Image.open(image_path) as img:
-                width, height = img.size
-                image_size_str = f"{height}x{width}"
-        except Exception:
-            image_size_str = "Unknown"
-
-        # Reset abort event at start of processing
-        self.abort_event.clear()
-        
+    def warmup(self):
+        """Short generations on blank pages of representative sizes, a small crop and each
+        mode's full visual-token budget, so first requests do not pay one-off costs
+        (kernel selection, allocator growth, lazy initialisation) for their shapes.
+        With the static KV cache, every bucket's decode step is compiled here too."""
+        self.progress("warming up")
+        start = time.perf_counter()
+        sides = {self.token_side * 4}
+        for tokens in self.image_token_budget.values():
+            if tokens:
+                sides.add(self.token_side * math.isqrt(tokens))
+        for side in sorted(sides):
+            with torch.no_grad():
+                self._generate(self._blank_inputs(side), max_new_tokens=4)
+        print(f"Warm-up over {len(sides)} image sizes done in {time.perf_counter() - start:.2f}s")
+
+        if self.static_caches is not None:
+            inputs = self._blank_inputs(self.token_side * 4)
+            for bucket in self.static_caches.buckets:
+                self.progress(f"compiling decode step for {bucket}-token cache")
+                bucket_start = time.perf_counter()
+                with torch.no_grad():
+                    self.static_caches.generate(inputs, max_new_tokens=4, bucket=bucket)
+                print(f"Static cache bucket {bucket} ready in {time.perf_counter() - bucket_start:.2f}s")
+
+    def cache_signature(self):
+        # Everything besides the image and mode that changes the generated text
+        budget = ",".join(f"{mode}:{tokens}" for mode, tokens in sorted(self.image_token_budget.items()))
+        ratio = ",".join(f"{mode}:{value}" for mode, value in sorted(self.output_token_ratio.items()))
+        return (
+            f"{self.revision}|greedy|max_new_tokens={self.max_new_tokens}|image_tokens={budget}"
+            f"|output_ratio={ratio}|stop_repetition={self.stop_on_repetition}|stop_table_end={self.stop_on_table_end}"
+            # A different precision changes the text; "auto" keeps the keys of existing cache entries
+            + (f"|precision={self.precision}" if self.precision != "auto" else "")
+        )
+
+    def _token_budget(self, type, visual_tokens):
+        ratio = self.output_token_ratio.get("table" if type == "table" else "text")
+        if not ratio:
+            return self.max_new_tokens
+        # A floor so tiny crops still get room for their markup
+        return min(self.max_new_tokens, 256 + math.ceil(ratio * visual_tokens))
+
+    def _stopping(self, type, abort_event, prompt_length):
+        """Fresh per-request stopping criteria; returns (StoppingCriteriaList, named criteria)."""
+        criteria = {"abort": AbortCriteria(abort_event), "counter": TokenCounter()}
+        if self.kv_budget is not None and self.device.type == "cuda":
+            criteria["memory"] = MemoryPeak(self.device)
+        if self.stop_on_repetition:
+            criteria["repetition"] = RepetitionCriteria(prompt_length)
+        if self.stop_on_table_end and type == "table":
+            criteria["table_end"] = TableEndCriteria(self.processor.tokenizer, prompt_length)
+        return StoppingCriteriaList(criteria.values()), criteria
+
+    def _record_stop(self, type, criteria, generated, max_new_tokens, trace=None):
+        """Count why a generation stopped; output cut short is marked on `trace` as not worth caching."""
+        if criteria["abort"].abort_event.is_set():
+            reason = "aborted"
+        elif "repetition" in criteria and criteria["repetition"].fired:
+            reason = "repetition"
+        elif "table_end" in criteria and criteria["table_end"].fired:
+            reason = "table_end"
+        elif generated >= max_new_tokens:
+            reason = "budget" if max_new_tokens < self.max_new_tokens else "max_new_tokens"
+        else:
+            reason = "eos"
+        if trace is not None and reason not in ("eos", "table_end"):
+            trace.mark("truncated")
+        with self.stop_lock:
+            self.stop_counts[reason] += 1
+        metrics.STOPS.labels("table" if type == "table" else "text", reason).inc()
+        return reason
+
+    def close(self):
+        """Stop the shared batch loop, if any; call before the process exits."""
+        if self.scheduler is not None:
+            self.scheduler.close()
+
+    def stop_stats(self):
+        with self.stop_lock:
+            return dict(self.stop_counts)
+
+    def _budget_pixels(self, type):
+        tokens = self.image_token_budget.get("table" if type == "table" else "text")
+        return tokens * self.token_side**2 if tokens else None
+
+    def _fit_budget(self, image, type):
+        """Downscale `image` to at most the mode's visual-token budget.
+
+        Sides are snapped down to whole tokens, so the processor keeps the
+        size as is instead of resampling a second time.
+        """
+        max_pixels = self._budget_pixels(type)
+        side = self.token_side
+        width, height = image.size
+        if not max_pixels or round(width / side) * round(height / side) * side**2 <= max_pixels:
+            return image
+        scale = math.sqrt(max_pixels / (width * height))
+        new_width = max(side, math.floor(width * scale / side) * side)
+        new_height = max(side, math.floor(height * scale / side) * side)
+        return image.resize((new_width, new_height), Image.BICUBIC, reducing_gap=2.0)
+
+    def _messages(self, image, type="table"):
         table_prompt =  {
             "type": "table",
             "table": "Table Recognition:"
@@ -105,95 +1223,490 @@ class GLMOCR:
             "type": "text",
             "text": "Text Recognition:",
         }
-        
+
         selected_prompt = table_prompt if type == "table" else text_prompt
-        
+
         messages = [
             {
                 "role": "user",
                 "content": [
                     {
                         "type": "image",
-                        "url": image_path
+                        "image": image
                     },
                     selected_prompt
                 ],
             }
         ]
-        
-        inputs = self.processor.apply_chat_template(
-            messages,
-            tokenize=True,
-            add_generation_prompt=True,
-            return_dict=True,
-            return_tensors="pt"
-        ).to(self.device)
-        
+        return messages
+
+    def _visual_tokens(self, inputs):
+        # Largest image in the batch
+        return int(inputs["image_grid_thw"].prod(dim=-1).max()) // self.processor.image_processor.merge_size ** 2
+
+    def _prepare_inputs(self, image, type="table", image_key=None, trace=None):
+        """Build model inputs; returns (inputs, stats) where stats describes the vision cache use.
+
+        `image` is a decoded PIL image, or anything `load_image` accepts.
+        """
+        trace = trace or Trace()
+        if image_key is None:
+            with trace.span("image_decode"):
+                image, image_key, _ = load_image(image, self._budget_pixels(type))
+        with trace.span("resize"):
+            image = self._fit_budget(image, type)
+        # Embeddings depend on the size the image was encoded at, not just its content
+        image_key = f"{image_key}|{image.width}x{image.height}"
+
+        messages = self._messages(image, type)
+
+        if self.vision_cache is None:
+            with trace.span("template"):
+                inputs = self.processor.apply_chat_template(
+                    messages,
+                    tokenize=True,
+                    add_generation_prompt=True,
+                    return_dict=True,
+                    return_tensors="pt"
+                ).to(self.device)
+
+            inputs.pop("token_type_ids", None)
+            return inputs, {"vision_cache": "off", "prefill_saved": 0.0}
+
+        entry = self.vision_cache.get(image_key)
+        if entry is not None:
+            # Same image seen before (any mode): only the text part is tokenised
+            with trace.span("template"):
+                inputs = self._inputs_from_cached_image(messages, entry)
+            return inputs, {"vision_cache": "hit", "prefill_saved": entry["encode_seconds"]}
+
+        start = time.perf_counter()
+        with trace.span("template"):
+            inputs = self.processor.apply_chat_template(
+                messages,
+                tokenize=True,
+                add_generation_prompt=True,
+                return_dict=True,
+                return_tensors="pt"
+            ).to(self.device)
+
+        inputs.pop("token_type_ids", None)
+
+        with torch.no_grad(), trace.span("vision_encode"):
+            image_outputs = self.model.get_image_features(inputs["pixel_values"], inputs["image_grid_thw"])
+        embeds = torch.cat(image_outputs.pooler_output, dim=0)
+        self.vision_cache.put(image_key, inputs["image_grid_thw"], embeds, time.perf_counter() - start)
+
+        # Hand the model the embeddings we already computed instead of the pixels
+        inputs.pop("pixel_values")
+        inputs["mm_encoder_outputs"] = {"image": BaseModelOutputWithPooling(pooler_output=(embeds,))}
+        return inputs, {"vision_cache": "miss", "prefill_saved": 0.0}
+
+    def _inputs_from_cached_image(self, messages, entry):
+        image_grid_thw = entry["image_grid_thw"]
+        merge_length = self.processor.image_processor.merge_size ** 2
+        num_image_tokens = int(image_grid_thw[0].prod()) // merge_length
+
+        # Same expansion the processor does, minus loading and resizing the image
+        prompt = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        image_token = self.processor.image_token
+        prompt = prompt.replace(image_token, image_token * num_image_tokens, 1)
+        bos_token = self.processor.tokenizer.bos_token
+        add_special_tokens = not (bos_token is not None and prompt.startswith(bos_token))
+        inputs = self.processor(text=[prompt], return_tensors="pt", add_special_tokens=add_special_tokens)
         inputs.pop("token_type_ids", None)
-        
+        inputs["image_grid_thw"] = image_grid_thw
+        inputs = inputs.to(self.device)
+
+        embeds = entry["embeds"].to(self.device, self.model.dtype)
+        inputs["mm_encoder_outputs"] = {"image": BaseModelOutputWithPooling(pooler_output=(embeds,))}
+        return inputs
+
+    def process_image(self, image, type="table", abort_event=None):
+        # Each call gets its own abort event so cancelling one job never touches another
+        if abort_event is None:
+            abort_event = threading.Event()
+
+        inputs, _ = self._prepare_inputs(image, type)
+        max_new_tokens = self._token_budget(type, self._visual_tokens(inputs))
+        prompt_length = inputs["input_ids"].shape[1]
+        stopping_criteria, criteria = self._stopping(type, abort_event, prompt_length)
+        reservation = self._reserve_kv(prompt_length + max_new_tokens, abort_event)
+        # Quantised and offloaded caches only exist in model.generate
+        full = reservation is None or reservation.strategy == "full"
+
+        try:
+            if full and self.speculative is not None:
+                request = self.speculative.run(GenerationRequest(
+                    inputs,
+                    stopping_criteria=stopping_criteria,
+                    max_new_tokens=max_new_tokens,
+                ))
+                if request.error is not None:
+                    raise request.error
+                output_ids = request.generated
+            elif full and self.scheduler is not None:
+                request = self.scheduler.submit(GenerationRequest(
+                    inputs,
+                    stopping_criteria=stopping_criteria,
+                    max_new_tokens=max_new_tokens,
+                ))
+                request.wait()
+                if isinstance(request.error, torch.OutOfMemoryError):
+                    output_ids = request.generated + self._resume_off_batch(request, reservation)
+                elif request.error is not None:
+                    raise request.error
+                else:
+                    output_ids = request.generated
+            else:
+                with torch.no_grad():
+                    generated_ids = self._generate_reserved(
+                        inputs,
+                        reservation,
+                        criteria["counter"],
+                        max_new_tokens=max_new_tokens,
+                        stopping_criteria=stopping_criteria
+                    )
+                output_ids = generated_ids[0][prompt_length:]
+        finally:
+            if reservation is not None:
+                self.kv_budget.release(reservation)
+        self._record_stop(type, criteria, len(output_ids), max_new_tokens)
+        if reservation is not None:
+            self._report_kv(reservation, type, prompt_length + len(output_ids), criteria)
+
+        if abort_event.is_set():
+            print("Generation aborted by user.")
+            return "<!-- Process Aborted -->"
+
+        output_text = self.processor.decode(output_ids, skip_special_tokens=False)
+        return output_text
+
+    def process_image_tiled(self, image, type="table", band_tokens=None, overlap=0.15, abort_event=None, trace=None):
+        """OCR an image as overlapping full-width bands and stitch the results.
+
+        Each band holds about `band_tokens` visual tokens (default: the mode's
+        budget, else 1024), so memory follows the band size instead of the
+        image size. Bands run as one batch: through the scheduler when there
+        is one, otherwise as a single left-padded `model.generate` call.
+        """
+        if abort_event is None:
+            abort_event = threading.Event()
+        trace = trace or Trace()
+
+        with trace.span("image_decode"):
+            # Bands are keyed for the vision cache on their own: no digest of the whole image needed
+            image, _, _ = load_image(image, key="")
+            band_tokens = band_tokens or self.image_token_budget.get("table" if type == "table" else "text") or 1024
+            side = self.token_side
+            band_height = max(4 * side, band_tokens * side**2 // image.width)
+            boxes = band_boxes(image.width, image.height, band_height, int(band_height * overlap))
+            bands = [self._fit_budget(image.crop(box), type) for box in boxes]
+        print(f"Tiled OCR: {image.height}x{image.width} image in {len(bands)} bands of {band_height}px")
+        # Bands decode side by side: one reservation covers them all
+        reservation = self._reserve_kv(band_tokens + PROMPT_OVERHEAD + self._token_budget(type, band_tokens),
+                                       abort_event, trace, rows=len(bands), batched=self.scheduler is not None)
+        full = reservation is None or reservation.strategy == "full"
+        try:
+            outputs = self._generate_bands(bands, type, full, reservation, abort_event, trace)
+        finally:
+            if reservation is not None:
+                self.kv_budget.release(reservation)
+        if reservation is not None and reservation.strategy != "full":
+            trace.mark("kv_cache_degraded")
+
+        if abort_event.is_set():
+            print("Generation aborted by user.")
+            return "<!-- Process Aborted -->"
+
+        with trace.span("stitch"):
+            parts = [self.processor.decode(ids, skip_special_tokens=True) for ids in outputs]
+            return stitch_tables(parts) if type == "table" else stitch_text(parts)
+
+    def _generate_bands(self, bands, type, full, reservation, abort_event, trace):
+        """Generated ids of every band: through the scheduler when there is one and the
+        cache is at full precision, otherwise as a single left-padded `model.generate` call.
+
+        A stop reason is recorded per generation: one per band in the scheduler, one for
+        the padded call.
+        """
+        if full and self.scheduler is not None:
+            requests = []
+            try:
+                for band in bands:
+                    inputs, _ = self._prepare_inputs(band, type, trace=trace)
+                    stopping_criteria, criteria = self._stopping(type, abort_event, inputs["input_ids"].shape[1])
+                    requests.append((self.scheduler.submit(GenerationRequest(
+                        inputs,
+                        stopping_criteria=stopping_criteria,
+                        max_new_tokens=self._token_budget(type, self._visual_tokens(inputs)),
+                    )), criteria))
+                outputs = []
+                with trace.span("generate"):
+                    for request, criteria in requests:
+                        request.wait()
+                        if isinstance(request.error, torch.OutOfMemoryError):
+                            # The bands share one reservation: a band dropped from the batch continues as it was
+                            outputs.append(request.generated + self._resume_off_batch(request, None))
+                        elif request.error is not None:
+                            raise request.error
+                        else:
+                            outputs.append(request.generated)
+                        self._record_stop(type, criteria, len(outputs[-1]), request.max_new_tokens, trace)
+            finally:
+                for request, _ in requests:
+                    request.cancel()
+            return outputs
+
+        with trace.span("template"):
+            inputs = self.processor.apply_chat_template(
+                [self._messages(band, type) for band in bands],
+                tokenize=True,
+                add_generation_prompt=True,
+                return_dict=True,
+                return_tensors="pt",
+                processor_kwargs={"padding": True, "padding_side": "left"},
+            ).to(self.device)
+        inputs.pop("token_type_ids", None)
+        # Rows that stop early are padded until the longest band is done
+        stopping_criteria, criteria = self._stopping(type, abort_event, inputs["input_ids"].shape[1])
+        max_new_tokens = self._token_budget(type, self._visual_tokens(inputs))
+        with torch.no_grad(), trace.span("generate"):
+            generated_ids = self._generate_reserved(
+                inputs,
+                reservation,
+                criteria["counter"],
+                max_new_tokens=max_new_tokens,
+                stopping_criteria=stopping_criteria
+            )
+        output_ids = generated_ids[:, inputs["input_ids"].shape[1]:]
+        self._record_stop(type, criteria, output_ids.shape[1], max_new_tokens, trace)
+        return output_ids
+
+    def process_image_stream(self, image, type="table", abort_event=None, trace=None, image_key=None):
+        """Stream the OCR output of one image; `image_key` is the SHA-256 hex digest of its bytes, if known."""
+        start_time = time.time()
+        prepared = self._prepare_stream(image, type, trace, image_key)
+        yield from self._generate_stream(prepared, type, abort_event, start_time, trace)
+
+    def process_document_stream(self, data, type="table", dpi=200, abort_event=None, trace=None):
+        """`process_pages_stream` over the pages of a PDF or multi-page TIFF given as bytes."""
+        return self.process_pages_stream(iter_pages(data, dpi), type=type, abort_event=abort_event, trace=trace)
+
+    def process_pages_stream(self, pages, type="table", abort_event=None, prefetch=1, trace=None):
+        """Stream OCR of a multi-page document, each page preceded by a `<!-- Page N -->` marker.
+
+        `pages` is an iterator of page images (see `pages.iter_pages`). A
+        worker thread rasterises and encodes up to `prefetch` pages ahead
+        while the current page generates, so preprocessing overlaps decoding
+        and only a few pages are held in memory whatever the page count.
+        """
+        if abort_event is None:
+            abort_event = threading.Event()
+        trace = trace or Trace()
+
+        ready = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def prepare_ahead():
+            try:
+                iterator = iter(pages)
+                while True:
+                    with trace.span("page_render"):
+                        page = next(iterator, None)
+                    if page is None:
+                        break
+                    if not put(self._prepare_stream(page, type, trace)):
+                        return
+                put(None)
+            except Exception as e:
+                put(e)
+            finally:
+                # The page source is closed on the thread that iterated it
+                close = getattr(pages, "close", None)
+                if close is not None:
+                    close()
+
+        worker = threading.Thread(target=prepare_ahead, daemon=True)
+        worker.start()
+        try:
+            number = 0
+            while True:
+                prepared = ready.get()
+                if prepared is None:
+                    break
+                if isinstance(prepared, Exception):
+                    raise prepared
+                number += 1
+                yield f"<!-- Page {number} -->\n"
+                for chunk in self._generate_stream(prepared, type, abort_event, time.time(), trace):
+                    yield chunk
+                if abort_event.is_set():
+                    # Aborted mid-page; the page stream has reported it
+                    break
+                yield "\n"
+        finally:
+            stop.set()
+
+    def _prepare_stream(self, image, type, trace=None, image_key=None):
+        """Everything before generation for one image; safe to run ahead on another thread."""
+        trace = trace or Trace()
+        # Decoded once; the same image feeds the processor and the size metric
+        with trace.span("image_decode"):
+            image, image_key, (width, height) = load_image(image, self._budget_pixels(type), image_key)
+        inputs, prep_stats = self._prepare_inputs(image, type, image_key, trace)
+        return {
+            "inputs": inputs,
+            "stats": prep_stats,
+            "image_size": f"{height}x{width}",
+            "visual_tokens": self._visual_tokens(inputs),
+        }
+
+    def _generate_stream(self, prepared, type, abort_event, start_time, trace=None):
+        # Metrics initialization
+        first_token_time = None
+
+        inputs = prepared["inputs"]
+        prep_stats = prepared["stats"]
+        image_size_str = prepared["image_size"]
+        visual_tokens = prepared["visual_tokens"]
+
+        if abort_event is None:
+            abort_event = threading.Event()
+
         streamer = TextIteratorStreamer(self.processor, skip_special_tokens=True, skip_prompt=True)
-        stopping_criteria = StoppingCriteriaList([AbortCriteria(self.abort_event)])
-        
-        generation_kwargs = dict(
-            **inputs,
-            streamer=streamer,
-            max_new_tokens=8192,
-            stopping_criteria=stopping_criteria
-        )
+        max_new_tokens = self._token_budget(type, visual_tokens)
+        stopping_criteria, criteria = self._stopping(type, abort_event, inputs["input_ids"].shape[1])
+
+        generation_start = time.time()
+        prompt_length = inputs["input_ids"].shape[1]
+        # Waiting for KV budget counts towards time to first token, like waiting for a batch slot
+        reservation = self._reserve_kv(prompt_length + max_new_tokens, abort_event, trace)
+        # Quantised and offloaded caches only exist in model.generate
+        full = reservation is None or reservation.strategy == "full"
+        request = None
+        failure = []
+        resumed = []
+        if full and (self.speculative is not None or self.scheduler is not None):
+            request = GenerationRequest(
+                inputs,
+                streamer=streamer,
+                stopping_criteria=stopping_criteria,
+                max_new_tokens=max_new_tokens,
+            )
+        if request is not None and self.speculative is not None:
+            threading.Thread(target=self.speculative.run, args=(request,), daemon=True).start()
+        elif request is not None:
+            self.scheduler.submit(request)
+        else:
+            generation_kwargs = dict(
+                streamer=streamer,
+                max_new_tokens=max_new_tokens,
+                stopping_criteria=stopping_criteria
+            )
+
+            def run():
+                try:
+                    self._generate_reserved(inputs, reservation, criteria["counter"], **generation_kwargs)
+                except Exception as e:
+                    # Ends the stream below instead of leaving it waiting for tokens
+                    print(f"Generation error: {e}")
+                    failure.append(e)
+                    streamer.end()
+
+            thread = threading.Thread(target=run)
+            thread.start()
+
+        def resume():
+            try:
+                resumed.extend(self._resume_off_batch(request, reservation))
+            except Exception as e:
+                print(f"Generation error: {e}")
+                failure.append(e)
+                streamer.end()
+
+        try:
+            aborted = False
+            while not aborted:
+                for new_text in streamer:
+                    if first_token_time is None:
+                        first_token_time = time.time()
+
+                    if abort_event.is_set():
+                        print("Generation aborted by user.")
+                        yield "<!-- Process Aborted -->"
+                        aborted = True
+                        break
+                    yield new_text
+                if aborted or request is None or not isinstance(request.error, torch.OutOfMemoryError):
+                    break
+                # Dropped from the batch for lack of memory: the same stream carries on outside it
+                request.error = None
+                threading.Thread(target=resume, daemon=True).start()
+        finally:
+            # Free the batch slot if the consumer went away mid-stream
+            if request is not None:
+                request.cancel()
+                if reservation is not None:
+                    self.kv_budget.release(reservation)
+
+        if request is not None and request.error is not None:
+            raise request.error
+        if failure:
+            raise failure[0]
+
+        # The decode loops skip the criteria on their own stop conditions, so count from their ids
+        generated = len(request.generated) + len(resumed) if request is not None else criteria["counter"].count
+        stop_reason = self._record_stop(type, criteria, generated, max_new_tokens, trace)
+        if reservation is not None:
+            self._report_kv(reservation, type, prompt_length + generated, criteria, trace)
 
-        thread = threading.Thread(target=self.model.generate, kwargs=generation_kwargs)
-        thread.start()
-
-        for new_text in streamer:
-            if first_token_time is None:
-                first_token_time = time.time()
-            
-            full_text += new_text
-
-            if self.abort_event.is_set():
-                print("Generation aborted by user.")
-                yield "<!-- Process Aborted -->"
-                break
-            yield new_text
-        
         # Calculations and Logging
         end_time = time.time()
         total_time = end_time - start_time
-        
+        mode = "table" if type == "table" else "text"
+        metrics.GENERATION_SECONDS.labels(mode).observe(total_time)
+        metrics.PROMPT_TOKENS.labels(mode).observe(visual_tokens)
+        metrics.OUTPUT_TOKENS.labels(mode).observe(generated)
+        if trace is not None:
+            # Prefill runs until the first token reaches the streamer, waiting for a batch slot included
+            first = first_token_time or end_time
+            trace.add("prefill", first - generation_start)
+            trace.add("decode", end_time - first)
+
         if first_token_time:
             ttft = first_token_time - start_time
             generation_time = end_time - first_token_time
-            
-            # Count tokens (Approximate by re-tokenizing)
-            # We use the processor's tokenizer
-            token_ids = self.processor.tokenizer(full_text).input_ids
-            token_count = len(token_ids)
-            
+
             # TPS Calculation: (Total Tokens - 1) / Generation Time
             # We subtract 1 because the first token is generated at `first_token_time`
             # so the time period `generation_time` covers the generation of the remaining `N-1` tokens.
-            if generation_time > 0 and token_count > 1:
-                tps = (token_count - 1) / generation_time
+            if generation_time > 0 and generated > 1:
+                tps = (generated - 1) / generation_time
             else:
                 tps = 0.0
-                
-            print(f"\n[METRICS] Image: {image_size_str} | Mode: {type}")
+            metrics.TTFT.labels(mode).observe(ttft)
+            if tps:
+                metrics.DECODE_TPS.labels(mode).observe(tps)
+
+            print(f"\n[METRICS] Image: {image_size_str} | Mode: {type} | Visual tokens: {visual_tokens}")
             print(f"[METRICS] TTFT: {ttft:.4f}s | Total Time: {total_time:.4f}s")
-            print(f"[METRICS] Tokens: {token_count} | TPS: {tps:.2f} tokens/s")
-            
-            # Log to file
-            log_file = "performance.log"
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            log_entry = (
-                f"[{timestamp}] Image: {image_size_str} | Mode: {type} | "
-                f"TTFT: {ttft:.4f}s | Total: {total_time:.4f}s | "
-                f"Tokens: {token_count} | TPS: {tps:.2f}\n"
-            )
-            try:
-                with open(log_file, "a") as f:
-                    f.write(log_entry)
-            except Exception as e:
-                print(f"Failed to write to {log_file}: {e}")
+            print(f"[METRICS] Tokens: {generated} | TPS: {tps:.2f} tokens/s")
+            print(f"[METRICS] Vision cache: {prep_stats['vision_cache']} | Prefill saved: {prep_stats['prefill_saved']:.4f}s")
+            stops = ", ".join(f"{reason}={count}" for reason, count in self.stop_stats().items() if count)
+            print(f"[METRICS] Stop: {stop_reason} (budget {max_new_tokens}) | Stops so far: {stops}")
+            if self.speculative is not None and request is not None and request.steps:
+                acceptance = request.accepted / request.drafted if request.drafted else 0.0
+                print(f"[METRICS] Speculative: acceptance {acceptance:.1%} | {(generated - 1) / request.steps:.2f} tokens/step")
         else:
              print(f"\n[METRICS] No tokens generated. Total Time: {total_time:.4f}s")
 
@@ -201,4 +1714,4 @@ if __name__ == "__main__":
     # Example usage mimicking original script
     ocr = GLMOCR()
     result = ocr.process_image("img.jpg")
-    print(result)
\ No newline at end of file
+    print(result)
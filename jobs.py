@@ -0,0 +1,151 @@
+import asyncio
+import threading
+import time
+import uuid
+from collections import deque
+
+PRIORITIES = ("interactive", "bulk")
+
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Job queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class Job:
+    def __init__(self, priority="interactive", session_id=None):
+        self.id = str(uuid.uuid4())
+        self.priority = priority
+        self.session_id = session_id
+        # Threading event so the generation thread can poll it between tokens
+        self.cancel_event = threading.Event()
+        self.state = "queued"
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def queue_wait(self):
+        if self.started_at is None:
+            return None
+        return self.started_at - self.created_at
+
+
+class JobQueue:
+    """Admission control in front of the model.
+
+    At most `max_in_flight` jobs run at once and at most `max_queued` wait
+    for a slot; anything beyond that is rejected with a retry hint. Waiting
+    jobs are granted slots interactive lane first, FIFO within a lane. Each
+    job carries its own cancel event, so cancelling one job never touches
+    another. All methods are called from the event loop thread.
+    """
+
+    def __init__(self, max_in_flight=8, max_queued=32):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.jobs = {}
+        self.lanes = {priority: deque() for priority in PRIORITIES}
+        self.running = set()
+        self.changed = None
+        # Moving average of job run time, used for Retry-After estimates
+        self.avg_duration = 30.0
+
+    def _notify(self):
+        if self.changed is not None:
+            self.changed.set()
+            self.changed = None
+
+    def queued_count(self):
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def retry_after(self):
+        waves = (self.queued_count() // max(1, self.max_in_flight)) + 1
+        return max(1, int(round(waves * self.avg_duration)))
+
+    def submit(self, priority="interactive", session_id=None):
+        if priority not in self.lanes:
+            raise ValueError(f"Unknown priority '{priority}', expected one of {', '.join(PRIORITIES)}")
+        if len(self.running) >= self.max_in_flight and self.queued_count() >= self.max_queued:
+            raise QueueFullError(self.retry_after())
+
+        job = Job(priority, session_id)
+        self.jobs[job.id] = job
+        self.lanes[priority].append(job)
+        self._promote()
+        return job
+
+    def _promote(self):
+        while len(self.running) < self.max_in_flight:
+            lane = next((self.lanes[p] for p in PRIORITIES if self.lanes[p]), None)
+            if lane is None:
+                break
+            job = lane.popleft()
+            job.state = "running"
+            job.started_at = time.time()
+            self.running.add(job)
+        self._notify()
+
+    def position(self, job):
+        """1-based place in line across all lanes, 0 once the job is running."""
+        if job.state != "queued":
+            return 0
+        ahead = 0
+        for priority in PRIORITIES:
+            lane = self.lanes[priority]
+            if priority == job.priority:
+                return ahead + lane.index(job) + 1
+            ahead += len(lane)
+        return ahead
+
+    async def wait(self, job, poll_interval=1.0):
+        """Yield the job's queue position until it starts running or is cancelled.
+
+        Also yields every `poll_interval` seconds while nothing changes, so the
+        caller gets a chance to check whether its client is still connected.
+        """
+        while job.state == "queued":
+            yield self.position(job)
+            if self.changed is None:
+                self.changed = asyncio.Event()
+            try:
+                await asyncio.wait_for(self.changed.wait(), poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def finish(self, job):
+        if job.state == "queued":
+            self.lanes[job.priority].remove(job)
+        elif job.state == "running":
+            self.running.discard(job)
+            duration = time.time() - job.started_at
+            self.avg_duration = 0.8 * self.avg_duration + 0.2 * duration
+        job.state = "cancelled" if job.cancel_event.is_set() else "done"
+        job.finished_at = time.time()
+        self.jobs.pop(job.id, None)
+        self._promote()
+
+    def cancel(self, job_id=None, session_id=None):
+        """Cancel one job or every job of a session."""
+        if job_id is None and session_id is None:
+            raise ValueError("Cancelling needs a job id or a session id")
+        cancelled = []
+        for job in list(self.jobs.values()):
+            if job_id is not None and job.id != job_id:
+                continue
+            if session_id is not None and job.session_id != session_id:
+                continue
+            job.cancel_event.set()
+            cancelled.append(job.id)
+            if job.state == "queued":
+                self.finish(job)
+        return cancelled
+
+    def stats(self):
+        return {
+            "running": len(self.running),
+            "queued": {priority: len(lane) for priority, lane in self.lanes.items()},
+            "max_in_flight": self.max_in_flight,
+            "max_queued": self.max_queued,
+        }
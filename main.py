@@ -1,37 +1,174 @@
 from fastapi import FastAPI
-from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Form
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Form, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.concurrency import run_in_threadpool
+from streaming import stream_in_thread
+import asyncio
+import hashlib
+import json
 import shutil
+import threading
 import os
+import time
 import uuid
 from datetime import datetime
 from glm import GLMOCR
+from pool import ModelPool, core_sets, default_devices
+from jobs import JobQueue, QueueFullError, PRIORITIES
+from cache import ResultCache, cache_key
+from sessions import SessionStore, StaleVersionError
+from uploads import UploadStore
+from table_events import StreamEvents, tables_to_csv
+from pages import document_type
+import metrics
+from tracing import Profiler, Trace
+from telemetry import TelemetrySampler
 from contextlib import asynccontextmanager
 
 
-# Global model instance
+# Concurrent /ocr requests share one continuous batching decode loop;
+# GLM_OCR_MAX_BATCH_SIZE=0 restores one generate thread per request.
+MAX_BATCH_SIZE = int(os.environ.get("GLM_OCR_MAX_BATCH_SIZE", "8"))
+
+# GLM_OCR_REPLICAS>1 runs that many models in worker processes, one per
+# GLM_OCR_REPLICA_DEVICES entry (default: GPUs round-robin, else CPU core slices)
+REPLICAS = int(os.environ.get("GLM_OCR_REPLICAS", "1"))
+
+# Model weights: a Hub id or a local directory
+MODEL_PATH = os.environ.get("GLM_OCR_MODEL", "zai-org/GLM-OCR")
+
+# Global model instance (a ModelPool when running replicas), set once loaded and warmed up
 ocr_model = None
+# Reported by /readyz: state is starting, loading, ready or failed; stage names the loading step
+model_status = {"state": "starting", "stage": None, "error": None, "started_at": None, "load_seconds": None}
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
+# Admission control in front of the model: jobs beyond the in-flight limit wait
+# in priority lanes, and beyond the queue limit are rejected with 429.
+job_queue = JobQueue(
+    max_in_flight=int(os.environ.get("GLM_OCR_MAX_IN_FLIGHT", (MAX_BATCH_SIZE or 1) * max(1, REPLICAS))),
+    max_queued=int(os.environ.get("GLM_OCR_MAX_QUEUED", "32")),
+)
+
+# Streamed tokens are written at most every STREAM_FLUSH_INTERVAL seconds,
+# or sooner once STREAM_FLUSH_BYTES characters are waiting.
+STREAM_FLUSH_INTERVAL = float(os.environ.get("GLM_OCR_STREAM_FLUSH_MS", "25")) / 1000
+STREAM_FLUSH_BYTES = int(os.environ.get("GLM_OCR_STREAM_FLUSH_BYTES", "4096"))
+
+# `events` values accepted by /ocr for a structured stream instead of plain text
+EVENT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "sse": "text/event-stream"}
+
+# Rasterisation resolution for PDF pages
+PDF_DPI = int(os.environ.get("GLM_OCR_PDF_DPI", "200"))
+
+def static_cache_buckets(value):
+    if value == "auto":
+        return value
+    return [int(length) for length in value.split(",") if int(length)]
+
+
+def load_model():
+    """Build the model (or replica pool) and warm it up; runs on a background thread
+    so the server answers /healthz and /readyz while it loads."""
     global ocr_model
+    start = time.monotonic()
+    model_status.update(state="loading", started_at=time.time())
+
+    def progress(stage):
+        model_status["stage"] = stage
+        print(f"[LOAD] {stage} ({time.monotonic() - start:.1f}s)")
+
     try:
-        ocr_model = GLMOCR()
+        model_kwargs = dict(
+            model_path=MODEL_PATH,
+            max_batch_size=MAX_BATCH_SIZE,
+            vision_cache_bytes=int(float(os.environ.get("GLM_OCR_VISION_CACHE_MB", "256")) * 1024**2),
+            vision_cache_half=os.environ.get("GLM_OCR_VISION_CACHE_FP16", "0") == "1",
+            # Handwriting needs more pixels than printed text to stay legible
+            image_token_budget={
+                "table": int(os.environ.get("GLM_OCR_IMAGE_TOKENS_TABLE", "4096")),
+                "text": int(os.environ.get("GLM_OCR_IMAGE_TOKENS_TEXT", "2048")),
+            },
+            # Table markup costs more output tokens per pixel than running text
+            output_token_ratio={
+                "table": float(os.environ.get("GLM_OCR_OUTPUT_RATIO_TABLE", "4")),
+                "text": float(os.environ.get("GLM_OCR_OUTPUT_RATIO_TEXT", "2")),
+            },
+            stop_on_repetition=os.environ.get("GLM_OCR_STOP_REPETITION", "1") == "1",
+            stop_on_table_end=os.environ.get("GLM_OCR_STOP_TABLE_END", "1") == "1",
+            speculative_draft_tokens=int(os.environ.get("GLM_OCR_SPECULATIVE_DRAFT", "0")),
+            # CPU profile: weight precision (auto/fp32/bf16/int8) and torch thread pools (0 = torch default)
+            cpu_precision=os.environ.get("GLM_OCR_CPU_PRECISION", "auto"),
+            num_threads=int(os.environ.get("GLM_OCR_THREADS", "0")),
+            interop_threads=int(os.environ.get("GLM_OCR_INTEROP_THREADS", "0")),
+            warmup=os.environ.get("GLM_OCR_WARMUP", "1") == "1",
+            # Opt-in static KV cache with a compiled decode step: "auto" or comma-separated cache lengths
+            static_cache_buckets=static_cache_buckets(os.environ.get("GLM_OCR_STATIC_CACHE", "0")),
+            # Memory the KV caches of concurrent requests may take, per replica (0 = unbounded)
+            kv_cache_budget_bytes=int(float(os.environ.get("GLM_OCR_KV_CACHE_BUDGET_MB", "0")) * 1024**2),
+        )
+        if REPLICAS > 1:
+            devices = os.environ.get("GLM_OCR_REPLICA_DEVICES")
+            devices = devices.split(",") if devices else default_devices(REPLICAS)
+            # GPU replicas still get a core slice each for preprocessing
+            model = ModelPool(REPLICAS, model_kwargs, devices=devices, cores=core_sets(REPLICAS), progress=progress)
+        else:
+            model = GLMOCR(**model_kwargs, progress=progress)
+        ocr_model = model
+        model_status.update(state="ready", stage=None, load_seconds=round(time.monotonic() - start, 1))
         print("GLM-OCR Model loaded successfully.")
     except Exception as e:
+        model_status.update(state="failed", error=str(e))
         print(f"Failed to load model: {e}")
+
+
+def replica_pids():
+    return [replica.process.pid for replica in ocr_model.replicas] if isinstance(ocr_model, ModelPool) else []
+
+
+# Device utilisation sampled in the background for /gpu: every GLM_OCR_TELEMETRY_INTERVAL
+# seconds (0 disables), keeping the last GLM_OCR_TELEMETRY_HISTORY samples
+telemetry = TelemetrySampler(
+    interval=float(os.environ.get("GLM_OCR_TELEMETRY_INTERVAL", "1")),
+    history=int(os.environ.get("GLM_OCR_TELEMETRY_HISTORY", "600")),
+    # Copied in one C-level call, so the event loop cannot change the set mid-way
+    jobs=lambda: [job.id for job in tuple(job_queue.running)],
+    processes=replica_pids,
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    threading.Thread(target=load_model, name="model-loader", daemon=True).start()
+    telemetry.start()
+    upload_store.start()
     yield 
     print('=== Closing ===')
+    telemetry.stop()
+    upload_store.stop()
+    if ocr_model is not None:
+        ocr_model.close()
+
+
+class SessionFiles(StaticFiles):
+    """The uploads directory as the web client links it: session references only.
+
+    The content store (`.store`, every user's uploads by digest) lives under the
+    same root, so no dot-prefixed path component is served.
+    """
+
+    async def get_response(self, path, scope):
+        if any(part.startswith(".") for part in path.replace("\\", "/").split("/")):
+            raise HTTPException(status_code=404)
+        return await super().get_response(path, scope)
 
 
 app = FastAPI(lifespan=lifespan)
 
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+app.mount("/uploads", SessionFiles(directory="uploads"), name="uploads")
 
 # Templates
 templates = Jinja2Templates(directory="templates")
@@ -42,6 +179,56 @@ DATA_DIR = "data"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(DATA_DIR, exist_ok=True)
 
+# Finished OCR results keyed by image content, mode and model/generation settings
+result_cache = ResultCache(
+    os.path.join(DATA_DIR, "ocr_cache"),
+    memory_max_bytes=int(float(os.environ.get("GLM_OCR_CACHE_MEMORY_MB", "64")) * 1024**2),
+    disk_max_bytes=int(float(os.environ.get("GLM_OCR_CACHE_DISK_MB", "512")) * 1024**2),
+    max_age=float(os.environ.get("GLM_OCR_CACHE_MAX_AGE_DAYS", "30")) * 86400,
+)
+
+# Saved sessions; /history lists them from an index instead of reading every file
+session_store = SessionStore(DATA_DIR)
+
+# Uploads are stored once per content and hardlinked into their sessions, within a disk quota;
+# unreferenced ones and never-saved sessions expire after the TTL
+upload_store = UploadStore(
+    UPLOAD_DIR,
+    quota_bytes=int(float(os.environ.get("GLM_OCR_UPLOAD_QUOTA_MB", "2048")) * 1024**2),
+    ttl=float(os.environ.get("GLM_OCR_UPLOAD_TTL_DAYS", "7")) * 86400,
+    preview_size=int(os.environ.get("GLM_OCR_PREVIEW_SIZE", "1280")),
+    sweep_interval=float(os.environ.get("GLM_OCR_UPLOAD_SWEEP_MINUTES", "10")) * 60,
+    is_saved=session_store.exists,
+)
+
+# Armed through POST /profile; captures land here as Chrome traces named by job id
+profiler = Profiler(os.path.join(DATA_DIR, "profiles"))
+
+
+def model_unavailable():
+    if model_status["state"] == "failed":
+        return HTTPException(status_code=503, detail=f"Model failed to load: {model_status['error']}")
+    # Still loading: well-behaved clients come back later
+    return HTTPException(status_code=503, detail=f"Model is loading ({model_status['stage'] or 'starting'})",
+                         headers={"Retry-After": "10"})
+
+
+def save_upload(session_id, file_id, filename, data, preview, digest, trace=None):
+    trace = trace or Trace()
+    with trace.span("upload_write"):
+        upload_store.add(session_id, file_id, filename, data, preview=preview, digest=digest)
+
+
+def persist_upload(session_id, file_id, filename, data, digest, preview=True, trace=None):
+    """Store an upload on a worker thread; OCR works from the bytes in memory."""
+    def report(future):
+        if future.exception() is not None:
+            print(f"Failed to save upload {filename}: {future.exception()}")
+
+    future = asyncio.get_running_loop().run_in_executor(
+        None, save_upload, session_id, file_id, filename, data, preview, digest, trace)
+    future.add_done_callback(report)
+
 
 
 
@@ -52,9 +239,14 @@ async def read_root(request: Request):
     return templates.TemplateResponse(request=request, name="index.html")
 
 @app.post("/ocr")
-async def process_image(file: UploadFile = File(...), type: str = Form("table"), session_id: str = Form(None)):
+async def process_image(request: Request, file: UploadFile = File(...), type: str = Form("table"), session_id: str = Form(None), priority: str = Form("interactive"), no_cache: bool = Form(False), tiled: bool = Form(False), timing: bool = Form(False), events: str = Form("")):
     if not ocr_model:
-        raise HTTPException(status_code=503, detail="Model not loaded. Check server logs.")
+        raise model_unavailable()
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"Invalid priority. Use one of: {', '.join(PRIORITIES)}")
+    if events and events not in EVENT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Invalid events format. Use one of: {', '.join(EVENT_MEDIA_TYPES)}")
+    media_type = EVENT_MEDIA_TYPES.get(events, "text/plain")
     
     # Determine session ID
     if not session_id or session_id == "null":
@@ -62,159 +254,353 @@ async def process_image(file: UploadFile = File(...), type: str = Form("table"),
     else:
         final_session_id = session_id
 
-    # Create session directory
-    session_dir = os.path.join(UPLOAD_DIR, final_session_id)
-    os.makedirs(session_dir, exist_ok=True)
-
-    # Save uploaded file
+    # The upload is kept for the history view, linked into the session from the store in the background
     file_id = str(uuid.uuid4())
-    extension = file.filename.split(".")[-1]
-    # Use absolute path for robustness in WSL
-    file_path = os.path.abspath(os.path.join(session_dir, f"{file_id}.{extension}"))
+    try:
+        session_dir = upload_store.session_dir(final_session_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    reference, preview_reference = upload_store.reference_names(file_id, file.filename)
+    session_url = f"/uploads/{os.path.basename(session_dir)}"
+
+    headers = {
+        "X-File-ID": file_id,
+        "X-Session-ID": final_session_id,
+        "X-Filename": file.filename,
+        "X-OCR-Type": type,
+        "X-Image-URL": f"{session_url}/{reference}",
+    }
+
+    request_start = time.monotonic()
+    trace = Trace()
+    with trace.span("read"):
+        image_bytes = await file.read()
+    mode = label = "table" if type == "table" else "text"
+    # PDFs and multi-page TIFFs are streamed page by page; tiling applies to single images
+    document = document_type(image_bytes)
+    if document:
+        tiled = False
+        headers["X-Document-Type"] = document
+        if document == "pdf":
+            mode += f"+dpi={PDF_DPI}"
+    else:
+        # Downscaled copy for the image viewer; PDFs and TIFFs are not shown there
+        headers["X-Preview-URL"] = f"{session_url}/{preview_reference}"
+    if tiled:
+        mode += "+tiled"
+    # Hashing a large photo is real work, keep it off the event loop. Hashed once: the digest
+    # addresses the upload in the result cache, the vision cache and the upload store alike.
+    with trace.span("hash"):
+        digest = await run_in_threadpool(lambda: hashlib.sha256(image_bytes).hexdigest())
+    result_key = cache_key(digest, mode, ocr_model.cache_signature())
+
+    # Cache hits skip the job queue entirely
+    with trace.span("cache_lookup"):
+        cached = None if no_cache else await run_in_threadpool(result_cache.get, result_key)
+    if cached is not None:
+        persist_upload(final_session_id, file_id, file.filename, image_bytes, digest, preview=not document)
+        metrics.REQUESTS.labels(label, "cache_hit").inc()
+        metrics.REQUEST_SECONDS.labels(label).observe(time.monotonic() - request_start)
+        print(f"Cache hit for {file.filename} ({mode}), key {result_key[:12]}")
+        if timing:
+            cached += f"<!-- Server-Timing: {trace.server_timing()} -->"
+        if events:
+            encoder = StreamEvents(events, parse_tables=type == "table")
+            cached = encoder.feed(cached) + encoder.close()
+        return StreamingResponse(iter([cached]), media_type=media_type,
+                                 headers={**headers, "X-Cache": "hit", "Server-Timing": trace.server_timing()})
+
+    # Admission control before touching the disk
+    try:
+        job = job_queue.submit(priority=priority, session_id=final_session_id)
+    except QueueFullError as e:
+        metrics.REQUESTS.labels(label, "rejected").inc()
+        raise HTTPException(
+            status_code=429,
+            detail="Too many OCR jobs queued. Try again later.",
+            headers={"Retry-After": str(e.retry_after)},
+        )
     
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-            
-        print(f"Processing image (Stream): {file_path} with mode: {type}")
+        persist_upload(final_session_id, file_id, file.filename, image_bytes, digest, preview=not document,
+                       trace=trace)
+
+        print(f"Processing image (Stream): {file.filename} with mode: {type} (job {job.id}, {priority})")
         
         async def response_generator():
-            # Run the blocking iterator in a threadpool to keep the event loop free
-            def sync_gen():
-                for chunk in ocr_model.process_image_stream(file_path, type=type):
-                    yield chunk
+            completed = False
+            failed = False
+            try:
+                # Stream queue position updates until the job gets a slot
+                last_position = None
+                async for position in job_queue.wait(job):
+                    if await request.is_disconnected():
+                        print(f"Client disconnected while queued, cancelling job {job.id}")
+                        return
+                    if position != last_position:
+                        last_position = position
+                        yield f"<!-- Queue position: {position} -->"
+                if last_position is not None:
+                    yield "<!-- Queue position: 0 -->"
+                if job.queue_wait is not None:
+                    metrics.QUEUE_WAIT.labels(label).observe(job.queue_wait)
+                    trace.add("queue", job.queue_wait)
 
-            # Helper to safely get next item without raising StopIteration across async boundary
-            def safe_next(iterator):
-                try:
-                    return next(iterator)
-                except StopIteration:
-                    return None
+                if job.cancel_event.is_set():
+                    completed = True
+                    yield "<!-- Process Aborted -->"
+                    return
 
-            import asyncio
-            gen = sync_gen()
-            
-            while True:
-                try:
-                    # Get next chunk in a threadpool
-                    chunk = await run_in_threadpool(safe_next, gen)
-                    
-                    if chunk is None:
-                        break
-                        
-                    if chunk == "<!-- Process Aborted -->":
+                output = []
+                with trace.span("stream"):
+                    async for chunk in stream_job():
+                        output.append(chunk)
                         yield chunk
-                        break
+                completed = True
+
+                # Only clean, complete, full-precision generations are worth replaying: not ones cut
+                # short by a token budget or repetition, which a later setting may let run to the end
+                text = "".join(output)
+                failed = "<!-- Process Aborted -->" in text or "<!-- Error:" in text
+                if not job.cancel_event.is_set() and not failed and not trace.marks & {"kv_cache_degraded", "truncated"}:
+                    await run_in_threadpool(result_cache.put, result_key, text)
+                if timing:
+                    # After the cache write: timings belong to this run only
+                    yield f"<!-- Server-Timing: {trace.server_timing()} -->"
+            finally:
+                # Reached on completion, and also when the stream is closed
+                # because the client went away: stop generating for it.
+                if not completed:
+                    job.cancel_event.set()
+                job_queue.finish(job)
+                if job.cancel_event.is_set():
+                    metrics.ABORTS.labels(label).inc()
+                    outcome = "aborted"
+                else:
+                    outcome = "failed" if failed else "completed"
+                metrics.REQUESTS.labels(label, outcome).inc()
+                metrics.REQUEST_SECONDS.labels(label).observe(time.monotonic() - request_start)
+                print(f"[TRACE] Job {job.id} ({outcome}): {trace.summary()}")
+
+        async def stream_job():
+            # The blocking generator runs on one worker thread; tokens reach the
+            # event loop in coalesced batches instead of one threadpool hop each.
+            def make_iterator():
+                if document:
+                    iterator = ocr_model.process_document_stream(
+                        image_bytes, type=type, dpi=PDF_DPI, abort_event=job.cancel_event, trace=trace)
+                elif tiled:
+                    # Bands are stitched only once all of them are done, so this arrives in one piece
+                    def run_tiled():
+                        yield ocr_model.process_image_tiled(image_bytes, type=type, abort_event=job.cancel_event, trace=trace)
+                    iterator = run_tiled()
+                else:
+                    iterator = ocr_model.process_image_stream(image_bytes, type=type, abort_event=job.cancel_event,
+                                                              trace=trace, image_key=digest)
+                return profiler.capture(iterator, job.id)
+
+            last_check = time.monotonic()
+            try:
+                async for chunk in stream_in_thread(make_iterator, STREAM_FLUSH_INTERVAL, STREAM_FLUSH_BYTES):
                     yield chunk
-                except Exception as e:
-                    print(f"Streaming error: {e}")
-                    yield f"<!-- Error: {str(e)} -->"
-                    break
+
+                    # Abandoned streams are not always noticed until a write fails
+                    if time.monotonic() - last_check > 1.0:
+                        last_check = time.monotonic()
+                        if await request.is_disconnected():
+                            print(f"Client disconnected, cancelling job {job.id}")
+                            job.cancel_event.set()
+                            break
+            except Exception as e:
+                print(f"Streaming error: {e}")
+                yield f"<!-- Error: {str(e)} -->"
+
+        async def event_stream(chunks):
+            # Same stream, re-encoded: raw text plus a `row` event per completed table row
+            encoder = StreamEvents(events, parse_tables=type == "table")
+            try:
+                async for chunk in chunks:
+                    encoded = encoder.feed(chunk)
+                    if encoded:
+                        yield encoded
+                yield encoder.close()
+            finally:
+                await chunks.aclose()
 
         return StreamingResponse(
-            response_generator(), 
-            media_type="text/plain",  
-            headers={
-                "X-File-ID": file_id,
-                "X-Session-ID": final_session_id,
-                "X-Filename": file.filename,
-                "X-OCR-Type": type
-            }
+            event_stream(response_generator()) if events else response_generator(), 
+            media_type=media_type,  
+            # Stages up to here; the rest follow in the `timing=true` stream comment and the [TRACE] log line
+            headers={**headers, "X-Job-ID": job.id, "X-Cache": "bypass" if no_cache else "miss",
+                     "Server-Timing": trace.server_timing()}
         )
 
     except HTTPException as he:
+        job_queue.finish(job)
         raise he
     except Exception as e:
+        job_queue.finish(job)
         import traceback
         traceback.print_exc()
         # Return the actual error message to the client
         raise HTTPException(status_code=500, detail=f"Processing failed: {str(e)}")
 
+@app.get("/healthz")
+async def healthz():
+    # Liveness: the process serves requests; a failed load needs a restart, not more waiting
+    if model_status["state"] == "failed":
+        return JSONResponse(status_code=503, content={"status": "failed", "error": model_status["error"]})
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    # Readiness: only route traffic here once the model is loaded and warmed up
+    status = dict(model_status)
+    if status["state"] == "loading":
+        status["elapsed"] = round(time.time() - status["started_at"], 1)
+    return JSONResponse(status_code=200 if status["state"] == "ready" else 503, content=status)
+
 @app.post("/cancel")
-async def cancel_processing():
+async def cancel_processing(data: dict = None):
+    # Data expected: { "job_id": "optional", "session_id": "optional" }, at least one of them:
+    # one client must not be able to stop everyone else's jobs
+    data = data or {}
+    if not data.get("job_id") and not data.get("session_id"):
+        raise HTTPException(status_code=400, detail="Give the job_id or session_id to cancel")
     if ocr_model:
-        ocr_model.abort_event.set()
-        return {"status": "cancelled"}
+        cancelled = job_queue.cancel(job_id=data.get("job_id"), session_id=data.get("session_id"))
+        return {"status": "cancelled", "jobs": cancelled}
     return {"status": "no model"}
 
+@app.get("/cache")
+async def get_cache_stats():
+    vision_cache = ocr_model.vision_cache if ocr_model else None
+    return {
+        "results": result_cache.stats(),
+        "vision": vision_cache.stats() if vision_cache else None,
+    }
+
+@app.get("/metrics")
+async def get_metrics():
+    # Point-in-time state is sampled on scrape; counters and histograms update as requests run
+    jobs = job_queue.stats()
+    state = {"jobs": {**jobs["queued"], "running": jobs["running"]}}
+    state["result_cache"] = {key: value for key, value in result_cache.stats().items() if key != "hit_rate"}
+    state["uploads"] = upload_store.stats()
+    if isinstance(ocr_model, ModelPool):
+        for index, replica in enumerate(ocr_model.stats()):
+            state[f"replica_{index}"] = {key: value for key, value in replica.items() if key != "device"}
+    latest = telemetry.latest()
+    if latest is not None:
+        state["process"] = {key: value for key, value in latest["process"].items() if value is not None}
+        for device in latest["devices"]:
+            state[f"gpu_{device['index']}"] = {key: value for key, value in device.items()
+                                               if key not in ("index", "name") and value is not None}
+    if ocr_model:
+        if ocr_model.scheduler is not None:
+            state["batch"] = ocr_model.scheduler.stats()
+        if ocr_model.vision_cache is not None:
+            state["vision_cache"] = ocr_model.vision_cache.stats()
+        if ocr_model.static_caches is not None:
+            state["static_cache"] = ocr_model.static_caches.stats()
+        if ocr_model.kv_budget is not None:
+            state["kv_budget"] = ocr_model.kv_budget.stats()
+    for component, fields in state.items():
+        for field, value in fields.items():
+            metrics.STATE.labels(component, field).set(value)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.post("/profile")
+async def arm_profiler(data: dict = None):
+    # Data expected: { "requests": N }; N=0 disarms
+    requests = int((data or {}).get("requests", 1))
+    profiler.arm(requests)
+    return profiler.status()
+
+@app.get("/profile")
+async def get_profiler_status():
+    return profiler.status()
+
 @app.get("/gpu")
-async def get_gpu_status():
-    import torch
-    status = {
-        "available": torch.cuda.is_available(),
-        "device_count": torch.cuda.device_count(),
-        "info": []
+async def get_gpu_status(seconds: float = None):
+    # Served from the sampler's buffer: no device is queried on this path
+    latest = telemetry.latest() or {"time": None, "devices": [], "process": None, "jobs": []}
+    return {
+        "available": bool(latest["devices"]),
+        "source": telemetry.source,
+        "interval": telemetry.interval,
+        "device_count": len(latest["devices"]),
+        "time": latest["time"],
+        "info": latest["devices"],
+        "process": latest["process"],
+        "jobs": latest["jobs"],
+        # Oldest first; `seconds` limits it to the most recent window
+        "series": telemetry.series(seconds),
     }
-    
-    if status["available"]:
-        for i in range(status["device_count"]):
-            props = torch.cuda.get_device_properties(i)
-            # Memory in MB
-            total_mem = props.total_memory / 1024**2
-            reserved_mem = torch.cuda.memory_reserved(i) / 1024**2
-            allocated_mem = torch.cuda.memory_allocated(i) / 1024**2
-            free_mem = total_mem - reserved_mem # Approximation of free memory in terms of reservation
-            
-            status["info"].append({
-                "name": props.name,
-                "total_memory": f"{total_mem:.0f} MB",
-                "reserved_memory": f"{reserved_mem:.0f} MB",
-                "allocated_memory": f"{allocated_mem:.0f} MB",
-                "utilization": f"{(reserved_mem/total_mem)*100:.1f}%"
-            })
-    return status
 
 @app.post("/save")
 async def save_table(data: dict):
     # Data expected: { "content": "html/json...", "name": "optional name", "id": "optional id" }
+    # or, for incremental saves: { "id", "name", "base_version": N, "ops": [{"op": "put", "table_id", "html"},
+    # {"op": "remove", "table_id"}], "order": [table ids, only when changed] }
     
     save_id = data.get("id")
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
-    # If ID provided, look for existing file
-    existing_file = None
     if save_id:
-        # Security check: ensure ID is just a UUID/filename and not a path traversal
-        safe_id = os.path.basename(save_id)
-        possible_path = os.path.join(DATA_DIR, f"table_{safe_id}.json")
-        if os.path.exists(possible_path):
-            existing_file = possible_path
-            filename = f"table_{safe_id}.json"
-        else:
-            # If ID provided but not found, treat as new or keep ID? 
-            # Let's keep the ID to maintain session continuity if frontend thinks it exists.
-            filename = f"table_{safe_id}.json"
+        # Security check: ensure ID is just a UUID/filename and not a path traversal.
+        # An unknown ID keeps the ID to maintain session continuity if frontend thinks it exists.
+        save_id = os.path.basename(save_id)
     else:
         save_id = str(uuid.uuid4())
-        filename = f"table_{save_id}.json"
         
-    filepath = os.path.join(DATA_DIR, filename)
-    
-    save_data = {
-        "id": save_id,
-        "timestamp": timestamp,
-        "name": data.get("name", "Untitled"),
-        "content": data.get("content")
-    }
-    
-    import json
-    with open(filepath, "w") as f:
-        json.dump(save_data, f, indent=2)
-        
-    return {"status": "success", "id": save_id}
+    name = data.get("name", "Untitled")
+    if "ops" not in data and "order" not in data:
+        version = await run_in_threadpool(session_store.save, save_id, name, data.get("content"), timestamp)
+        return {"status": "success", "id": save_id, "version": version}
+
+    try:
+        version = await run_in_threadpool(
+            session_store.apply, save_id, name, timestamp, data.get("base_version", 0), data.get("ops") or [], data.get("order"))
+    except StaleVersionError as e:
+        # The client resends on top of the current version
+        return JSONResponse(status_code=409, content={"status": "stale", "id": save_id, "version": e.version})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"status": "success", "id": save_id, "version": version}
+
+@app.get("/session/{session_id}")
+async def get_session(session_id: str):
+    # Full saved content of one session; /history only lists metadata
+    session = await run_in_threadpool(session_store.get, session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return session
+
+@app.get("/session/{session_id}/csv")
+async def export_session_csv(session_id: str):
+    # Built from the saved tables, so the browser never has to walk the DOM
+    session = await run_in_threadpool(session_store.get, session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    content = await run_in_threadpool(tables_to_csv, session["content"] or "")
+    if content is None:
+        raise HTTPException(status_code=404, detail="No tables to export")
+    return Response(content=content, media_type="text/csv",
+                    headers={"Content-Disposition": 'attachment; filename="extracted_tables.csv"'})
 
 @app.delete("/session/{session_id}")
 async def delete_session(session_id: str):
     safe_id = os.path.basename(session_id)
-    filename = f"table_{safe_id}.json"
-    filepath = os.path.join(DATA_DIR, filename)
     
     # Delete JSON data
-    if os.path.exists(filepath):
-        os.remove(filepath)
+    await run_in_threadpool(session_store.delete, safe_id)
     
-    # Delete uploads directory for this session
-    session_upload_dir = os.path.join(UPLOAD_DIR, safe_id)
+    # Delete this session's references to its uploads; the stored copies expire once nothing links to them
+    try:
+        session_upload_dir = upload_store.session_dir(safe_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     if os.path.exists(session_upload_dir):
         try:
             shutil.rmtree(session_upload_dir)
@@ -226,21 +612,17 @@ async def delete_session(session_id: str):
     return {"status": "success", "message": "Session deleted"}
 
 @app.get("/history")
-async def get_history():
-    files = []
-    if os.path.exists(DATA_DIR):
-        import json
-        for f in os.listdir(DATA_DIR):
-            if f.endswith(".json"):
-                with open(os.path.join(DATA_DIR, f), "r") as json_file:
-                    try:
-                        data = json.load(json_file)
-                        files.append(data)
-                    except:
-                        pass
-    # Sort by timestamp desc
-    files.sort(key=lambda x: x.get("timestamp", ""), reverse=True)
-    return files
+async def get_history(request: Request, offset: int = 0, limit: int = 50):
+    # Metadata only (id, name, timestamp, size), newest first; content comes from GET /session/{id}
+    limit = max(1, min(limit, 500))
+    total, items = await run_in_threadpool(session_store.list, max(0, offset), limit)
+    body = json.dumps(items)
+    etag = '"' + hashlib.sha1(f"{total}:{body}".encode()).hexdigest() + '"'
+    # Browsers revalidate on every call (no-cache) and get a bodyless 304 while nothing changed
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "X-Total-Count": str(total)}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 if __name__ == "__main__":
     import uvicorn
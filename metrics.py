@@ -0,0 +1,201 @@
+"""In-process metrics exposed in the Prometheus text format at GET /metrics.
+
+A deliberately small subset of what prometheus_client offers (counters,
+gauges and fixed-bucket histograms with labels), so the server needs no
+extra dependency. Metrics are module globals, safe to update from any thread.
+"""
+import bisect
+import threading
+
+REGISTRY = []
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+        key = tuple(str(v) for v in values)
+        with self.lock:
+            child = self.children.get(key)
+            if child is None:
+                child = self.children[key] = self._new_child()
+            return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            children = list(self.children.items())
+        for values, child in sorted(children):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=(0.1, 0.5, 1, 5, 10)):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def _render_child(self, values, child):
+        with child.lock:
+            counts = list(child.counts)
+            total = child.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, [("le", _format_value(bound))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def collect(reset=False):
+    """Counter and histogram values by metric name and label values.
+
+    With `reset`, the values are zeroed as they are read, so a model worker
+    process can ship what it recorded since the last call to the server.
+    """
+    values = {}
+    for metric in REGISTRY:
+        if isinstance(metric, Gauge):
+            continue
+        with metric.lock:
+            children = list(metric.children.items())
+        entries = values[metric.name] = {}
+        for key, child in children:
+            with child.lock:
+                if isinstance(child, _HistogramValue):
+                    entries[key] = (list(child.counts), child.sum)
+                    if reset:
+                        child.counts = [0] * len(child.counts)
+                        child.sum = 0.0
+                else:
+                    entries[key] = child.value
+                    if reset:
+                        child.value = 0.0
+    return values
+
+
+def merge(values):
+    """Add values from `collect` in another process to the metrics of this one."""
+    by_name = {metric.name: metric for metric in REGISTRY}
+    for name, entries in values.items():
+        metric = by_name.get(name)
+        if metric is None:
+            continue
+        for key, value in entries.items():
+            child = metric.labels(*key)
+            with child.lock:
+                if isinstance(child, _HistogramValue):
+                    counts, total = value
+                    child.counts = [a + b for a, b in zip(child.counts, counts)]
+                    child.sum += total
+                else:
+                    child.value += value
+
+# Generation, recorded by GLMOCR
+TTFT = Histogram("glm_ocr_ttft_seconds", "Time from request start to the first generated token.", ["mode"],
+                 buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+DECODE_TPS = Histogram("glm_ocr_decode_tokens_per_second", "Decode speed after the first token.", ["mode"],
+                       buckets=(1, 5, 10, 20, 40, 80, 160, 320, 640))
+GENERATION_SECONDS = Histogram("glm_ocr_generation_seconds", "Preprocessing plus generation time per image.", ["mode"],
+                               buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+PROMPT_TOKENS = Histogram("glm_ocr_prompt_visual_tokens", "Visual tokens in the prompt.", ["mode"],
+                          buckets=(64, 256, 512, 1024, 2048, 4096, 8192, 16384))
+OUTPUT_TOKENS = Histogram("glm_ocr_output_tokens", "Generated tokens per image.", ["mode"],
+                          buckets=(16, 64, 256, 512, 1024, 2048, 4096, 8192))
+STOPS = Counter("glm_ocr_generation_stops_total", "Finished generations by stop reason.", ["mode", "reason"])
+KV_CACHE_STRATEGY = Counter("glm_ocr_kv_cache_strategy_total",
+                            "Generations by the KV cache strategy the memory budget gave them.", ["mode", "strategy"])
+KV_CACHE_PEAK_BYTES = Histogram("glm_ocr_kv_cache_peak_bytes", "Device memory of a generation's KV cache at its longest.",
+                                ["mode"], buckets=tuple(2**n * 1024**2 for n in range(3, 14)))
+
+# Requests, recorded by the server
+REQUEST_SECONDS = Histogram("glm_ocr_request_seconds", "End-to-end /ocr latency, queue wait included.", ["mode"],
+                            buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+QUEUE_WAIT = Histogram("glm_ocr_queue_wait_seconds", "Time a job waited for a model slot.", ["mode"],
+                       buckets=(0.01, 0.1, 0.5, 1, 5, 15, 30, 60, 120, 300))
+REQUESTS = Counter("glm_ocr_requests_total", "OCR requests by how they were served.", ["mode", "outcome"])
+ABORTS = Counter("glm_ocr_aborts_total", "Jobs cancelled by the user or a disconnect.", ["mode"])
+STATE = Gauge("glm_ocr_state", "Current queue, batch and cache occupancy, and sampled device utilisation.", ["component", "field"])
@@ -0,0 +1,45 @@
+import io
+
+from PIL import Image, ImageSequence
+
+PDF_MAGIC = b"%PDF-"
+TIFF_MAGICS = (b"II*\x00", b"MM\x00*")
+
+
+def document_type(data):
+    """"pdf" or "tiff" for multi-page documents, None for anything read as a single image."""
+    if data.startswith(PDF_MAGIC):
+        return "pdf"
+    if data[:4] in TIFF_MAGICS:
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                if getattr(image, "n_frames", 1) > 1:
+                    return "tiff"
+        except Exception:
+            pass
+    return None
+
+
+def iter_pages(data, dpi=200):
+    """Yield the pages of a PDF or multi-page TIFF as RGB images, one at a time.
+
+    Pages are rasterised or decoded only when asked for, so memory holds a
+    page or two regardless of the document length.
+    """
+    if document_type(data) == "pdf":
+        import pypdfium2 as pdfium
+
+        pdf = pdfium.PdfDocument(data)
+        try:
+            for index in range(len(pdf)):
+                page = pdf[index]
+                try:
+                    yield page.render(scale=dpi / 72).to_pil().convert("RGB")
+                finally:
+                    page.close()
+        finally:
+            pdf.close()
+    else:
+        with Image.open(io.BytesIO(data)) as image:
+            for frame in ImageSequence.Iterator(image):
+                yield frame.convert("RGB")
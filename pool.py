@@ -0,0 +1,297 @@
+"""A pool of GLMOCR replicas in worker processes, behind one dispatcher.
+
+Each replica is a spawned process owning one model, pinned to a device (a
+GPU) or to a slice of the CPU cores with `torch.set_num_threads` set to the
+slice size, so replicas do not fight over cores. The server process keeps
+no model: `ModelPool` offers the GLMOCR streaming methods the server uses
+and sends each job to the replica with the fewest jobs running. Within a
+replica, concurrent jobs share its batch scheduler as they would in a
+single-model server.
+
+Uploaded bytes go to the worker through a shared memory block rather than
+being pickled into the pipe; only control messages and generated text
+travel over the pipes. When a job ends the worker also sends back its
+stage timings and the metrics it recorded, so /metrics and Server-Timing
+cover the replicas too.
+"""
+import multiprocessing
+import os
+import queue
+import threading
+import uuid
+from multiprocessing import shared_memory
+
+import torch
+
+import metrics
+from tracing import Trace
+
+
+def default_devices(replicas):
+    """One device per replica: GPUs round-robin when there are any, else the CPU."""
+    if torch.cuda.is_available():
+        return [f"cuda:{i % torch.cuda.device_count()}" for i in range(replicas)]
+    return ["cpu"] * replicas
+
+
+def core_sets(replicas):
+    """The CPUs this process may use, split into `replicas` contiguous slices (None where unsupported)."""
+    if not hasattr(os, "sched_getaffinity"):
+        return [None] * replicas
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) < replicas:
+        return [None] * replicas
+    size, extra = divmod(len(cores), replicas)
+    sets, start = [], 0
+    for i in range(replicas):
+        end = start + size + (1 if i < extra else 0)
+        sets.append(cores[start:end])
+        start = end
+    return sets
+
+
+def _worker(index, device, cores, model_kwargs, requests, results):
+    from glm import GLMOCR
+
+    if cores:
+        os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+    if device.startswith("cuda"):
+        torch.cuda.set_device(device)
+    try:
+        ocr = GLMOCR(device=device, **model_kwargs)
+    except Exception as e:
+        results.send(("failed", None, str(e)))
+        return
+    results.send(("ready", None, ocr.cache_signature()))
+
+    send_lock = threading.Lock()
+    cancel_events = {}
+
+    def send(*message):
+        with send_lock:
+            results.send(message)
+
+    def run(job_id, kind, block, size, type, options):
+        abort_event = cancel_events[job_id]
+        trace = Trace()
+        try:
+            # The server owns the block and unlinks it (spawned workers share its resource tracker)
+            shm = shared_memory.SharedMemory(name=block)
+            try:
+                data = bytes(shm.buf[:size])
+            finally:
+                shm.close()
+            if kind == "document":
+                iterator = ocr.process_document_stream(data, type=type, abort_event=abort_event, trace=trace, **options)
+            elif kind == "tiled":
+                iterator = iter([ocr.process_image_tiled(data, type=type, abort_event=abort_event, trace=trace)])
+            else:
+                iterator = ocr.process_image_stream(data, type=type, abort_event=abort_event, trace=trace, **options)
+            for chunk in iterator:
+                send("chunk", job_id, chunk)
+            send("done", job_id, (dict(trace.spans), trace.marks, metrics.collect(reset=True)))
+        except Exception as e:
+            send("error", job_id, str(e))
+        finally:
+            cancel_events.pop(job_id, None)
+
+    print(f"Replica {index} ready on {device}" + (f", cores {cores[0]}-{cores[-1]}" if cores else ""))
+    while True:
+        try:
+            message = requests.recv()
+        except EOFError:
+            break
+        if message[0] == "run":
+            job_id = message[1]
+            cancel_events[job_id] = threading.Event()
+            threading.Thread(target=run, args=message[1:], daemon=True).start()
+        elif message[0] == "cancel":
+            event = cancel_events.get(message[1])
+            if event is not None:
+                event.set()
+        elif message[0] == "stop":
+            break
+    ocr.close()
+
+
+class Replica:
+    def __init__(self, index, device, cores, process, requests, results):
+        self.index = index
+        self.device = device
+        self.cores = cores
+        self.process = process
+        self.requests = requests
+        self.results = results
+        self.send_lock = threading.Lock()
+        self.alive = True
+        self.active = 0
+        self.completed = 0
+
+    def send(self, message):
+        with self.send_lock:
+            self.requests.send(message)
+
+
+class ModelPool:
+    """`replicas` GLMOCR worker processes; blocks until every one has loaded its model."""
+
+    # The server reads these off a single GLMOCR; replicas keep their own
+    scheduler = None
+    vision_cache = None
+    static_caches = None
+    kv_budget = None
+
+    def __init__(self, replicas, model_kwargs=None, devices=None, cores=None, progress=None):
+        context = multiprocessing.get_context("spawn")
+        devices = devices or default_devices(replicas)
+        cores = cores or core_sets(replicas)
+        self.lock = threading.Lock()
+        self.jobs = {}  # job id -> (replica, message queue)
+        self.replicas = []
+        for index in range(replicas):
+            device = devices[index % len(devices)]
+            requests_receiver, requests_sender = context.Pipe(duplex=False)
+            results_receiver, results_sender = context.Pipe(duplex=False)
+            process = context.Process(
+                target=_worker, name=f"glm-ocr-replica-{index}", daemon=True,
+                args=(index, device, cores[index], dict(model_kwargs or {}), requests_receiver, results_sender))
+            process.start()
+            # Only the worker keeps these ends, so a dead worker shows up as EOF here
+            requests_receiver.close()
+            results_sender.close()
+            self.replicas.append(Replica(index, device, cores[index], process, requests_sender, results_receiver))
+
+        progress = progress or (lambda stage: None)
+        signatures = set()
+        try:
+            for replica in self.replicas:
+                progress(f"loading replicas ({replica.index}/{replicas} ready)")
+                while not replica.results.poll(1):
+                    if not replica.process.is_alive():
+                        raise RuntimeError(f"Replica {replica.index} exited while loading")
+                kind, _, payload = replica.results.recv()
+                if kind != "ready":
+                    raise RuntimeError(f"Replica {replica.index} failed to load: {payload}")
+                signatures.add(payload)
+        except BaseException:
+            self.close()
+            raise
+        if len(signatures) != 1:
+            self.close()
+            raise RuntimeError("Replicas loaded different model revisions or settings")
+        self.signature = signatures.pop()
+
+        for replica in self.replicas:
+            threading.Thread(target=self._read, args=(replica,), daemon=True).start()
+
+    def cache_signature(self):
+        return self.signature
+
+    def _read(self, replica):
+        while True:
+            try:
+                kind, job_id, payload = replica.results.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                job = self.jobs.get(job_id)
+            if job is not None:
+                job[1].put((kind, payload))
+
+        with self.lock:
+            replica.alive = False
+            orphans = [messages for owner, messages in self.jobs.values() if owner is replica]
+        print(f"Replica {replica.index} exited")
+        for messages in orphans:
+            messages.put(("error", f"Model replica {replica.index} exited"))
+
+    def _assign(self, job_id, messages):
+        with self.lock:
+            alive = [replica for replica in self.replicas if replica.alive]
+            if not alive:
+                raise RuntimeError("No model replica is running")
+            # Fewest running jobs; ties go to the one that has done the least
+            replica = min(alive, key=lambda replica: (replica.active, replica.completed))
+            self.jobs[job_id] = (replica, messages)
+            replica.active += 1
+            return replica
+
+    def _run(self, kind, data, type, abort_event, trace, options=None):
+        abort_event = abort_event or threading.Event()
+        trace = trace or Trace()
+        if isinstance(data, str):
+            with open(data, "rb") as f:
+                data = f.read()
+        with trace.span("shm_write"):
+            block = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+            block.buf[:len(data)] = data
+        job_id = uuid.uuid4().hex
+        messages = queue.Queue()
+        finished = cancelled = False
+        replica = None
+        try:
+            replica = self._assign(job_id, messages)
+            replica.send(("run", job_id, kind, block.name, len(data), type, options or {}))
+            while True:
+                if abort_event.is_set() and not cancelled:
+                    replica.send(("cancel", job_id))
+                    cancelled = True
+                try:
+                    message, payload = messages.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if message == "chunk":
+                    yield payload
+                elif message == "done":
+                    spans, marks, recorded = payload
+                    for name, (seconds, count) in spans.items():
+                        trace.add(name, seconds, count)
+                    for name in marks:
+                        trace.mark(name)
+                    metrics.merge(recorded)
+                    finished = True
+                    return
+                else:
+                    finished = True
+                    raise RuntimeError(payload)
+        finally:
+            if replica is not None:
+                with self.lock:
+                    self.jobs.pop(job_id, None)
+                    replica.active -= 1
+                    replica.completed += 1
+                # Closed early, e.g. the client went away: stop generating for it
+                if not finished and not cancelled and replica.alive:
+                    try:
+                        replica.send(("cancel", job_id))
+                    except OSError:
+                        pass
+            block.close()
+            block.unlink()
+
+    def process_image_stream(self, image, type="table", abort_event=None, trace=None, image_key=None):
+        return self._run("image", image, type, abort_event, trace, {"image_key": image_key})
+
+    def process_document_stream(self, data, type="table", dpi=200, abort_event=None, trace=None):
+        return self._run("document", data, type, abort_event, trace, {"dpi": dpi})
+
+    def process_image_tiled(self, image, type="table", abort_event=None, trace=None):
+        return "".join(self._run("tiled", image, type, abort_event, trace))
+
+    def stats(self):
+        with self.lock:
+            return [{"device": replica.device, "alive": int(replica.alive), "active": replica.active,
+                     "completed": replica.completed} for replica in self.replicas]
+
+    def close(self):
+        for replica in self.replicas:
+            try:
+                replica.send(("stop",))
+            except OSError:
+                pass
+        for replica in self.replicas:
+            replica.process.join(timeout=10)
+            if replica.process.is_alive():
+                replica.process.terminate()
+            replica.requests.close()
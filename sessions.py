@@ -0,0 +1,274 @@
+import json
+import os
+import threading
+
+
+class StaleVersionError(Exception):
+    """A save was based on an older version of the session than the stored one."""
+
+    def __init__(self, version):
+        super().__init__(f"Session is at version {version}")
+        self.version = version
+
+
+class SessionStore:
+    """Saved sessions on disk, with an in-memory metadata index.
+
+    A session is a snapshot `table_<id>.json` plus an append-only journal
+    `table_<id>.journal` holding one JSON line per incremental save: the
+    tables put or removed, their order when it changed, and the session
+    name. A save therefore writes only what changed. Every `compact_every`
+    records the journal is folded into a new snapshot, written to a
+    temporary file and renamed over the old one, and then removed; journal
+    lines already covered by the snapshot's version are skipped on replay,
+    so a crash at any point leaves a readable session.
+
+    Each save names the version it was based on and bumps it; a save based
+    on an older version raises StaleVersionError, so out-of-order or
+    concurrent deltas are never applied on top of each other.
+
+    Listing never opens a session whose files' mtimes and sizes match the
+    index: each call only stats the directory, and a session is read again
+    only when it was added or changed on disk (by this store or anyone
+    else). Content is read when a single session is asked for. Safe to call
+    from worker threads.
+    """
+
+    def __init__(self, directory, compact_every=64):
+        self.directory = directory
+        self.compact_every = compact_every
+        self.lock = threading.Lock()
+        # id -> metadata; keys starting with "_" are bookkeeping not returned by list()
+        self.index = {}
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, session_id, suffix=".json"):
+        # Ids come from URLs and request bodies: never let one name a path
+        return os.path.join(self.directory, f"table_{os.path.basename(session_id)}{suffix}")
+
+    def _stats(self, session_id):
+        stats = []
+        for suffix in (".json", ".journal"):
+            try:
+                stat = os.stat(self._path(session_id, suffix))
+                stats.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                stats.append(None)
+        return tuple(stats)
+
+    def _read(self, path):
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _load(self, session_id):
+        """Snapshot plus replayed journal as a state dict, or None if there is no session."""
+        snapshot = self._read(self._path(session_id))
+        journal_path = self._path(session_id, ".journal")
+        if not isinstance(snapshot, dict) and not os.path.exists(journal_path):
+            return None
+        state = {"id": session_id, "name": "Untitled", "timestamp": "", "version": 0, "content": None, "records": 0}
+        if isinstance(snapshot, dict):
+            state.update({k: snapshot[k] for k in ("id", "name", "timestamp", "version", "content", "tables", "order")
+                          if k in snapshot})
+        try:
+            with open(journal_path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash mid-append
+                        continue
+                    if record.get("version", 0) > state["version"]:
+                        self._apply_record(state, record)
+                        state["records"] += 1
+        except OSError:
+            pass
+        return state
+
+    @staticmethod
+    def _apply_record(state, record):
+        if "tables" not in state:
+            # First incremental save of a session saved whole: the client sends every table
+            state["tables"] = {}
+            state["order"] = []
+            state["content"] = None
+        tables, order = state["tables"], state["order"]
+        for op in record.get("ops", []):
+            if op["op"] == "put":
+                if op["table_id"] not in tables:
+                    order.append(op["table_id"])
+                tables[op["table_id"]] = op["html"]
+            else:
+                tables.pop(op["table_id"], None)
+                if op["table_id"] in order:
+                    order.remove(op["table_id"])
+        if record.get("order") is not None:
+            state["order"] = [table_id for table_id in record["order"] if table_id in tables]
+            for table_id in list(tables):
+                if table_id not in state["order"]:
+                    del tables[table_id]
+        state["name"] = record.get("name", state["name"])
+        state["timestamp"] = record.get("timestamp", state["timestamp"])
+        state["version"] = record["version"]
+
+    def _index_state(self, session_id, state, stats=None):
+        stats = stats or self._stats(session_id)
+        self.index[session_id] = {
+            "id": state["id"],
+            "name": state["name"],
+            "timestamp": state["timestamp"],
+            "size": sum(stat[1] for stat in stats if stat),
+            "_stats": stats,
+            "_version": state["version"],
+            "_records": state["records"],
+        }
+
+    def _refresh(self):
+        seen = set()
+        for entry in os.scandir(self.directory):
+            name = entry.name
+            if name.startswith("table_") and (name.endswith(".json") or name.endswith(".journal")):
+                seen.add(name[len("table_"):].rsplit(".", 1)[0])
+        for session_id in seen:
+            stats = self._stats(session_id)
+            cached = self.index.get(session_id)
+            if cached is None or cached["_stats"] != stats:
+                state = self._load(session_id)
+                if state is None:
+                    self.index.pop(session_id, None)
+                else:
+                    self._index_state(session_id, state, stats)
+        for session_id in set(self.index) - seen:
+            del self.index[session_id]
+
+    def _current(self, session_id):
+        """Index entry for a session, read again if its files changed on disk; None if it does not exist."""
+        stats = self._stats(session_id)
+        cached = self.index.get(session_id)
+        if cached is None or cached["_stats"] != stats:
+            state = self._load(session_id)
+            if state is None:
+                self.index.pop(session_id, None)
+                return None
+            self._index_state(session_id, state, stats)
+        return self.index[session_id]
+
+    def _write_snapshot(self, session_id, state):
+        path = self._path(session_id)
+        snapshot = {k: state[k] for k in ("id", "timestamp", "name", "version", "content", "tables", "order") if k in state}
+        temporary = path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        # Readers see either the old snapshot or the new one, never half of one
+        os.replace(temporary, path)
+
+    def list(self, offset=0, limit=None):
+        """(total, metadata of sessions [offset:offset+limit]), newest first."""
+        with self.lock:
+            self._refresh()
+            items = sorted(self.index.values(), key=lambda item: item["timestamp"], reverse=True)
+        end = None if limit is None else offset + limit
+        return len(items), [{k: v for k, v in item.items() if not k.startswith("_")} for item in items[offset:end]]
+
+    def exists(self, session_id):
+        return any(os.path.exists(self._path(session_id, suffix)) for suffix in (".json", ".journal"))
+
+    def get(self, session_id):
+        """The session with its content assembled; `tables` lists table ids, None for sessions saved whole."""
+        with self.lock:
+            state = self._load(os.path.basename(session_id))
+        if state is None:
+            return None
+        if "tables" in state:
+            content = "".join(state["tables"][table_id] for table_id in state["order"])
+            tables = list(state["order"])
+        else:
+            content, tables = state["content"], None
+        return {"id": state["id"], "timestamp": state["timestamp"], "name": state["name"],
+                "version": state["version"], "content": content, "tables": tables}
+
+    def save(self, session_id, name, content, timestamp):
+        """Replace a session with whole `content`; returns the new version."""
+        session_id = os.path.basename(session_id)
+        with self.lock:
+            current = self._current(session_id)
+            state = {"id": session_id, "timestamp": timestamp, "name": name, "content": content,
+                     "version": (current["_version"] if current else 0) + 1, "records": 0}
+            self._write_snapshot(session_id, state)
+            if os.path.exists(self._path(session_id, ".journal")):
+                os.remove(self._path(session_id, ".journal"))
+            self._index_state(session_id, state)
+        return state["version"]
+
+    def apply(self, session_id, name, timestamp, base_version, ops, order=None):
+        """Append one incremental save; returns the new version.
+
+        `ops` is a list of {"op": "put", "table_id", "html"} and
+        {"op": "remove", "table_id"}; `order`, when given, is the complete
+        list of table ids and drops tables not in it.
+        """
+        if not isinstance(ops, list) or not all(isinstance(op, dict) for op in ops):
+            raise ValueError("ops must be a list of table operations")
+        for op in ops:
+            if op.get("op") not in ("put", "remove") or not isinstance(op.get("table_id"), str) or (
+                    op["op"] == "put" and not isinstance(op.get("html"), str)):
+                raise ValueError(f"Invalid table operation: {op!r}")
+        if order is not None and not (isinstance(order, list) and all(isinstance(table_id, str) for table_id in order)):
+            raise ValueError("order must be a list of table ids")
+
+        session_id = os.path.basename(session_id)
+        with self.lock:
+            current = self._current(session_id)
+            version = current["_version"] if current else 0
+            if base_version != version:
+                raise StaleVersionError(version)
+
+            record = {"version": version + 1, "timestamp": timestamp, "name": name, "ops": ops}
+            if order is not None:
+                record["order"] = order
+            with open(self._path(session_id, ".journal"), "a+b") as f:
+                line = json.dumps(record).encode() + b"\n"
+                if f.seek(0, os.SEEK_END) > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        # A line torn by a crash: start on a line of our own, not at the end of it
+                        line = b"\n" + line
+                f.write(line)
+                # Acknowledged saves are on disk
+                f.flush()
+                os.fsync(f.fileno())
+
+            records = (current["_records"] if current else 0) + 1
+            if records >= self.compact_every:
+                self._compact(session_id)
+            elif current is None:
+                self._index_state(session_id, self._load(session_id))
+            else:
+                current.update(name=name, timestamp=timestamp, _version=version + 1, _records=records)
+                current["_stats"] = self._stats(session_id)
+                current["size"] = sum(stat[1] for stat in current["_stats"] if stat)
+        return version + 1
+
+    def _compact(self, session_id):
+        state = self._load(session_id)
+        self._write_snapshot(session_id, state)
+        os.remove(self._path(session_id, ".journal"))
+        state["records"] = 0
+        self._index_state(session_id, state)
+
+    def delete(self, session_id):
+        session_id = os.path.basename(session_id)
+        removed = False
+        with self.lock:
+            self.index.pop(session_id, None)
+            for suffix in (".json", ".journal"):
+                path = self._path(session_id, suffix)
+                if os.path.exists(path):
+                    os.remove(path)
+                    removed = True
+        return removed
@@ -2,6 +2,16 @@ let currentSessionId = null;
 let currentSessionType = 'table';
 let autoSaveTimer = null;
 
+// What the server has for the current session: saves send only the difference
+let sessionVersion = 0;
+let savedTables = new Map(); // table container id -> outerHTML as last saved
+let savedOrder = [];
+let savedName = null;
+let savedEpoch = 0; // bumped when the saved state is reset, so a late reply cannot apply to another session
+let saveInFlight = null;
+let saveQueued = false;
+let saveError = null; // why the last save did not reach the server, if it did not
+
 // Queue and Editor variables
 let fileQueue = [];
 let currentProcessingFile = null;
@@ -9,6 +19,7 @@ let cropper = null;
 let editorModal = null;
 let shouldProcessNextOnHide = false;
 let currentAbortController = null;
+let currentJobId = null;
 
 document.addEventListener("DOMContentLoaded", () => {
     // Load Theme
@@ -91,9 +102,18 @@ function processNextInQueue() {
     }
     
     currentProcessingFile = fileQueue.shift();
+    // The editor cannot display PDFs or TIFFs; documents go straight to the server
+    if (isDocument(currentProcessingFile)) {
+        uploadFile(currentProcessingFile);
+        return;
+    }
     showEditor(currentProcessingFile);
 }
 
+function isDocument(file) {
+    return /\.(pdf|tiff?)$/i.test(file.name) || ['application/pdf', 'image/tiff'].includes(file.type);
+}
+
 function showEditor(file) {
     const img = document.getElementById('image-to-edit');
     const reader = new FileReader();
@@ -161,8 +181,15 @@ function processAndUpload() {
 }
 
 function cancelProcessing() {
-    // 0. Signal backend to stop (Free GPU)
-    fetch('/cancel', { method: 'POST' }).catch(e => console.error("Failed to signal cancel to backend", e));
+    // 0. Signal backend to stop our job only (Free GPU)
+    if (currentJobId) {
+        fetch('/cancel', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ job_id: currentJobId })
+        }).catch(e => console.error("Failed to signal cancel to backend", e));
+        currentJobId = null;
+    }
 
     // 1. Abort current request
     if (currentAbortController) {
@@ -194,8 +221,14 @@ async function uploadFile(file) {
     formData.append('file', file);
     formData.append('type', currentSessionType);
     formData.append('session_id', currentSessionId || '');
+    // Files still waiting behind this one make it a bulk job; it yields to interactive uploads
+    formData.append('priority', fileQueue.length > 0 ? 'bulk' : 'interactive');
+    // Tables stream as NDJSON events with each row already parsed by the server
+    if (currentSessionType === 'table') formData.append('events', 'ndjson');
     
     currentAbortController = new AbortController();
+    const loaderText = document.getElementById('loader-text');
+    const defaultLoaderText = loaderText ? loaderText.innerText : '';
     
     try {
         const response = await fetch('/ocr', {
@@ -206,9 +239,11 @@ async function uploadFile(file) {
         
         if (!response.ok) {
             const errorData = await response.json();
-            throw new Error(errorData.detail || 'OCR Failed');
+            const retryAfter = response.headers.get('Retry-After');
+            throw new Error((errorData.detail || 'OCR Failed') + (retryAfter ? ` (retry in ${retryAfter}s)` : ''));
         }
         
+        currentJobId = response.headers.get('X-Job-ID');
         const filename = response.headers.get('X-Filename') || file.name;
         
         // Update session ID if we started a new session
@@ -217,12 +252,10 @@ async function uploadFile(file) {
             currentSessionId = newSessionId;
         }
 
-        // Construct Image URL
+        // Where the server keeps the upload; the image viewer cannot show PDFs or TIFFs
         let imageUrl = null;
-        const fileId = response.headers.get('X-File-ID');
-        if (currentSessionId && fileId) {
-            const ext = filename.split('.').pop();
-            imageUrl = `/uploads/${currentSessionId}/${fileId}.${ext}`;
+        if (!isDocument(file) && !response.headers.get('X-Document-Type')) {
+            imageUrl = response.headers.get('X-Image-URL');
         }
 
         const contentElement = addTableToWorkspace('', filename, imageUrl);
@@ -231,29 +264,90 @@ async function uploadFile(file) {
         const decoder = new TextDecoder();
         let accumulatedHtml = '';
         
-        while (true) {
-            const { done, value } = await reader.read();
-            if (done) break;
-            
-            const chunk = decoder.decode(value, { stream: true });
-            
-            if (chunk.includes("<!-- Process Aborted -->")) {
-                console.log("Processing aborted by user (via stream signal)");
-                break;
+        // Queue position updates arrive before the first token
+        const showQueuePosition = (position) => {
+            if (loaderText) {
+                loaderText.innerText = position === 0 ? defaultLoaderText : `Queued (position ${position})...`;
             }
+        };
+        
+        if (currentSessionType === 'table') {
+            // Append each completed row as it arrives instead of re-parsing the
+            // whole accumulated HTML; the raw text is rendered once at the end
+            const liveTables = [];
+            let buffer = '';
+            let aborted = false;
+            const handleEvent = (event) => {
+                if (event.type === 'queue') {
+                    showQueuePosition(event.position);
+                } else if (event.type === 'text') {
+                    accumulatedHtml += event.text;
+                } else if (event.type === 'row') {
+                    let table = liveTables[event.table];
+                    if (!table) {
+                        table = liveTables[event.table] = document.createElement('table');
+                        contentElement.appendChild(table);
+                    }
+                    const row = table.insertRow();
+                    for (const text of event.cells) row.insertCell().textContent = text;
+                } else if (event.type === 'aborted') {
+                    console.log("Processing aborted by user (via stream signal)");
+                    aborted = true;
+                } else if (event.type === 'error') {
+                    accumulatedHtml += `<!-- Error: ${event.message} -->`;
+                }
+            };
             
-            accumulatedHtml += chunk;
+            while (!aborted) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                const lines = buffer.split('\n');
+                buffer = lines.pop();
+                for (const line of lines) {
+                    if (line && !aborted) handleEvent(JSON.parse(line));
+                }
+            }
+            contentElement.innerHTML = accumulatedHtml;
+        } else {
+            let renderFrame = null;
             
-            // Update the UI
-            if (currentSessionType === 'text') {
+            // Re-rendering the whole accumulated string is costly for long outputs,
+            // so paint at most once per animation frame however many chunks arrive
+            const render = () => {
+                renderFrame = null;
                 contentElement.innerText = accumulatedHtml;
-            } else {
-                contentElement.innerHTML = accumulatedHtml;
-            }
+            };
             
-            // Auto-scroll to bottom of the content element if it's getting long
-            // Actually, usually the workspace handles it, but maybe scroll into view?
-            // contentElement.scrollIntoView({ behavior: 'smooth', block: 'end' });
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                
+                let chunk = decoder.decode(value, { stream: true });
+                
+                const queueMatches = [...chunk.matchAll(/<!-- Queue position: (\d+) -->/g)];
+                if (queueMatches.length) {
+                    showQueuePosition(Number(queueMatches[queueMatches.length - 1][1]));
+                    chunk = chunk.replace(/<!-- Queue position: \d+ -->/g, '');
+                }
+                
+                // The server coalesces tokens, so the marker may follow some text
+                const abortIndex = chunk.indexOf("<!-- Process Aborted -->");
+                if (abortIndex !== -1) {
+                    console.log("Processing aborted by user (via stream signal)");
+                    accumulatedHtml += chunk.slice(0, abortIndex);
+                    break;
+                }
+                
+                accumulatedHtml += chunk;
+                
+                if (renderFrame === null) {
+                    renderFrame = requestAnimationFrame(render);
+                }
+            }
+            // Paint the tail now; a frame firing later would overwrite the final content
+            if (renderFrame !== null) cancelAnimationFrame(renderFrame);
+            render();
         }
 
         // Finalize editability and saving
@@ -271,6 +365,8 @@ async function uploadFile(file) {
         alert(`Error processing ${file.name}: ${err.message}`);
     } finally {
         currentAbortController = null;
+        currentJobId = null;
+        if (loaderText) loaderText.innerText = defaultLoaderText;
         loader.style.display = 'none';
     }
     
@@ -326,7 +422,13 @@ function addTableToWorkspace(htmlContent, title = "Table", imageUrl = null) {
 
 function showImageModal(url) {
     const img = document.getElementById('image-to-view');
-    img.src = url;
+    // Show the server's downscaled preview; uploads from before previews existed have none
+    img.onerror = () => {
+        img.onerror = null;
+        img.src = url;
+    };
+    img.src = url.replace(/\.[^./]+$/, '.preview.jpg');
+    document.getElementById('view-original-link').href = url;
     const modalEl = document.getElementById('viewImageModal');
     const modal = new bootstrap.Modal(modalEl);
     modal.show();
@@ -412,6 +514,33 @@ function mergeSelectedTables() {
 }
 
 async function autoSave() {
+    // One save at a time: each delta is based on the version the previous one produced
+    if (saveInFlight) {
+        saveQueued = true;
+        return saveInFlight;
+    }
+    saveInFlight = saveChanges();
+    try {
+        await saveInFlight;
+    } finally {
+        saveInFlight = null;
+    }
+    if (saveQueued) {
+        saveQueued = false;
+        await autoSave();
+    }
+}
+
+function resetSavedState(version = 0) {
+    savedEpoch++;
+    sessionVersion = version;
+    savedTables = new Map();
+    savedOrder = [];
+    savedName = null;
+    saveError = null;
+}
+
+async function saveChanges(resync = false) {
     const wrapper = document.getElementById('tables-wrapper');
     if (!wrapper) return;
     
@@ -419,33 +548,60 @@ async function autoSave() {
     if (wrapper.innerHTML.trim() === "" && !currentSessionId) return;
 
     let title = document.getElementById('session-title').innerText;
-    const html = wrapper.innerHTML;
+    
+    // Only tables that were added, edited or removed since the last save are sent
+    const current = new Map();
+    wrapper.querySelectorAll(':scope > .table-container').forEach(el => current.set(el.id, el.outerHTML));
+    const order = [...current.keys()];
+    const ops = [];
+    current.forEach((html, id) => {
+        if (savedTables.get(id) !== html) ops.push({ op: 'put', table_id: id, html });
+    });
+    savedTables.forEach((_, id) => {
+        if (!current.has(id)) ops.push({ op: 'remove', table_id: id });
+    });
+    const orderChanged = order.join('\n') !== savedOrder.join('\n');
+    if (currentSessionId && !ops.length && !orderChanged && title === savedName) return;
+    
+    const epoch = savedEpoch;
+    const body = { id: currentSessionId, name: title, base_version: sessionVersion, ops };
+    if (orderChanged) body.order = order;
     
     try {
         const response = await fetch('/save', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ 
-                name: title, 
-                content: html,
-                id: currentSessionId 
-            })
+            body: JSON.stringify(body)
         });
         
-        const res = await response.json();
-        if (res.status === 'success') {
-            currentSessionId = res.id;
-            loadHistory(); // Update timestamps in list
-            
-            // Optional: Visual indicator that save happened
-            const statusIndicator = document.getElementById('session-title');
-            const originalColor = statusIndicator.style.color;
-            statusIndicator.style.color = 'green';
-            setTimeout(() => {
-                statusIndicator.style.color = originalColor;
-            }, 500);
+        const res = await response.json().catch(() => ({}));
+        if (epoch !== savedEpoch) return; // Another session was opened meanwhile
+        if (response.status === 409) {
+            // Saved elsewhere in the meantime (another tab): resend everything on top of that version
+            if (resync) throw new Error("Session keeps changing on the server");
+            resetSavedState(res.version);
+            return saveChanges(true);
         }
+        if (!response.ok || res.status !== 'success') {
+            throw new Error(res.detail || `Save failed (HTTP ${response.status})`);
+        }
+        saveError = null;
+        currentSessionId = res.id;
+        sessionVersion = res.version;
+        savedTables = current;
+        savedOrder = order;
+        savedName = title;
+        loadHistory(); // Update timestamps in list
+        
+        // Optional: Visual indicator that save happened
+        const statusIndicator = document.getElementById('session-title');
+        const originalColor = statusIndicator.style.color;
+        statusIndicator.style.color = 'green';
+        setTimeout(() => {
+            statusIndicator.style.color = originalColor;
+        }, 500);
     } catch(e) {
+        if (epoch === savedEpoch) saveError = e.message;
         console.error("Auto-save failed", e);
     }
 }
@@ -461,12 +617,17 @@ async function saveCurrentWork() {
     }
 }
 
+const HISTORY_PAGE_SIZE = 50;
+let historyShown = HISTORY_PAGE_SIZE;
+
 async function loadHistory() {
     const list = document.getElementById('history-list');
     if(!list) return;
 
-    const response = await fetch('/history');
+    // Metadata only; the server answers 304 while nothing changed
+    const response = await fetch(`/history?limit=${historyShown}`);
     const files = await response.json();
+    const total = parseInt(response.headers.get('X-Total-Count') || files.length, 10);
     
     list.innerHTML = '';
     files.forEach(f => {
@@ -481,7 +642,7 @@ async function loadHistory() {
             <h6 class="mb-1">${f.name}</h6>
             <small class="text-muted">${f.timestamp}</small>
         `;
-        contentDiv.onclick = () => loadSession(f);
+        contentDiv.onclick = () => loadSession(f.id);
         
         // Delete button
         const delBtn = document.createElement('button');
@@ -496,6 +657,17 @@ async function loadHistory() {
         item.appendChild(delBtn);
         list.appendChild(item);
     });
+
+    if (total > files.length) {
+        const moreBtn = document.createElement('button');
+        moreBtn.className = 'list-group-item list-group-item-action text-center text-muted small';
+        moreBtn.innerText = `Show more (${total - files.length})`;
+        moreBtn.onclick = () => {
+            historyShown += HISTORY_PAGE_SIZE;
+            loadHistory();
+        };
+        list.appendChild(moreBtn);
+    }
 }
 
 async function deleteSession(id) {
@@ -517,8 +689,15 @@ async function deleteSession(id) {
     }
 }
 
-function loadSession(sessionData) {
+async function loadSession(id) {
     // Removed confirmation as requested
+    const response = await fetch('/session/' + id);
+    if (!response.ok) {
+        alert("Failed to load session");
+        loadHistory();
+        return;
+    }
+    const sessionData = await response.json();
     currentSessionId = sessionData.id;
     
     const wrapper = document.getElementById('tables-wrapper');
@@ -538,6 +717,14 @@ function loadSession(sessionData) {
     // Re-attach listeners because innerHTML replaced elements
     const containers = wrapper.querySelectorAll('.generated-content');
     containers.forEach(div => makeEditable(div));
+    
+    // Sessions saved whole (tables === null) are resent table by table on the first save
+    resetSavedState(sessionData.version || 0);
+    if (sessionData.tables) {
+        wrapper.querySelectorAll(':scope > .table-container').forEach(el => savedTables.set(el.id, el.outerHTML));
+        savedOrder = [...savedTables.keys()];
+        savedName = document.getElementById('session-title').innerText;
+    }
 }
 
 function startNewSession(type = 'table') {
@@ -557,15 +744,35 @@ function startNewSession(type = 'table') {
     }
     
     currentSessionId = null;
+    resetSavedState();
 }
 
-function exportToCSV() {
+async function exportToCSV() {
     const tables = document.querySelectorAll('#tables-wrapper table');
     if (tables.length === 0) {
         alert("No tables to export");
         return;
     }
     
+    // The server builds the CSV from the saved session, so save pending edits first
+    if (currentSessionId) {
+        clearTimeout(autoSaveTimer);
+        await autoSave();
+        while (saveInFlight) await saveInFlight;
+        if (saveError) {
+            // Exporting now would hand out what the server had before these edits
+            alert("Could not save the session, so nothing was exported: " + saveError);
+            return;
+        }
+        const link = document.createElement("a");
+        link.setAttribute("href", `/session/${currentSessionId}/csv`);
+        link.setAttribute("download", "extracted_tables.csv");
+        document.body.appendChild(link);
+        link.click();
+        document.body.removeChild(link);
+        return;
+    }
+    
     let csvContent = "data:text/csv;charset=utf-8,";
     
     tables.forEach((table, index) => {
@@ -623,6 +830,25 @@ function exportToTXT() {
     URL.revokeObjectURL(url);
 }
 
+// Inline SVG line of the last `values` (0-100), oldest on the left
+function sparkline(values) {
+    if (values.length < 2) return '';
+    const points = values.map((v, i) => `${(i / (values.length - 1) * 100).toFixed(1)},${(30 - (v || 0) * 0.3).toFixed(1)}`).join(' ');
+    return `<svg viewBox="0 0 100 30" preserveAspectRatio="none" style="width: 100%; height: 30px;">
+                <polyline points="${points}" fill="none" stroke="currentColor" stroke-width="1" vector-effect="non-scaling-stroke"/>
+            </svg>`;
+}
+
+function usageBar(label, percent, detail) {
+    return `
+        <div class="mb-2">
+            <label class="small text-muted">${label}</label>
+            <div class="progress" style="height: 20px;">
+                <div class="progress-bar bg-success" role="progressbar" style="width: ${percent}%;" aria-valuenow="${percent}" aria-valuemin="0" aria-valuemax="100">${detail}</div>
+            </div>
+        </div>`;
+}
+
 async function checkGPUStatus() {
     const modalEl = document.getElementById('gpuStatusModal');
     const modalBody = document.getElementById('gpu-status-content');
@@ -644,44 +870,63 @@ async function checkGPUStatus() {
     `;
     
     try {
-        const response = await fetch('/gpu');
+        // Last five minutes of samples for the history lines
+        const response = await fetch('/gpu?seconds=300');
         const data = await response.json();
         
-        if (!data.available) {
-            modalBody.innerHTML = `<div class="alert alert-warning">No CUDA GPU available on server.</div>`;
+        if (!data.process) {
+            modalBody.innerHTML = `<div class="alert alert-warning">No telemetry sampled yet.</div>`;
             return;
         }
         
         let html = '';
-        data.info.forEach((gpu, idx) => {
+        if (!data.available) {
+            html += `<div class="alert alert-warning">No CUDA GPU available on server.</div>`;
+        }
+        data.info.forEach((gpu) => {
+            const memoryPercent = (gpu.memory_used_mb / gpu.memory_total_mb * 100).toFixed(1);
+            const history = data.series.map(sample => (sample.devices[gpu.index] || {}).utilization);
+            const extras = [gpu.temperature_c != null ? `${gpu.temperature_c} °C` : null,
+                            gpu.power_w != null ? `${gpu.power_w} W` : null].filter(Boolean).join(' · ');
             html += `
                 <div class="card mb-3">
-                    <div class="card-header fw-bold">GPU ${idx}: ${gpu.name}</div>
+                    <div class="card-header fw-bold">GPU ${gpu.index}: ${gpu.name}</div>
                     <div class="card-body">
-                        <div class="mb-2">
-                            <label class="small text-muted">Memory Usage (Reserved / Total)</label>
-                            <div class="progress" style="height: 20px;">
-                                <div class="progress-bar bg-success" role="progressbar" style="width: ${gpu.utilization};" aria-valuenow="${parseFloat(gpu.utilization)}" aria-valuemin="0" aria-valuemax="100">${gpu.utilization}</div>
-                            </div>
-                        </div>
-                        <ul class="list-group list-group-flush small">
-                            <li class="list-group-item d-flex justify-content-between">
-                                <span>Total Memory</span>
-                                <strong>${gpu.total_memory}</strong>
-                            </li>
-                            <li class="list-group-item d-flex justify-content-between">
-                                <span>Reserved</span>
-                                <strong>${gpu.reserved_memory}</strong>
-                            </li>
-                             <li class="list-group-item d-flex justify-content-between">
-                                <span>Allocated</span>
-                                <strong>${gpu.allocated_memory}</strong>
-                            </li>
-                        </ul>
+                        ${usageBar('Utilisation', gpu.utilization, `${gpu.utilization}%`)}
+                        <div class="text-success">${sparkline(history)}</div>
+                        ${usageBar('Memory Used / Total', memoryPercent, `${gpu.memory_used_mb} / ${gpu.memory_total_mb} MB`)}
+                        ${extras ? `<div class="small text-muted">${extras}</div>` : ''}
                     </div>
                 </div>
             `;
         });
+
+        const proc = data.process;
+        const cpuHistory = data.series.map(sample => sample.process.cpu_percent);
+        html += `
+            <div class="card mb-3">
+                <div class="card-header fw-bold">Server process</div>
+                <div class="card-body">
+                    ${usageBar('CPU', Math.min(proc.cpu_percent, 100), `${proc.cpu_percent}%`)}
+                    <div class="text-success">${sparkline(cpuHistory)}</div>
+                    <ul class="list-group list-group-flush small">
+                        <li class="list-group-item d-flex justify-content-between">
+                            <span>Resident Memory</span>
+                            <strong>${proc.rss_mb} MB</strong>
+                        </li>
+                        ${proc.host_memory_total_mb != null ? `
+                        <li class="list-group-item d-flex justify-content-between">
+                            <span>Host Memory Available</span>
+                            <strong>${proc.host_memory_available_mb} / ${proc.host_memory_total_mb} MB</strong>
+                        </li>` : ''}
+                        <li class="list-group-item d-flex justify-content-between">
+                            <span>Jobs Running</span>
+                            <strong>${data.jobs.length}</strong>
+                        </li>
+                    </ul>
+                </div>
+            </div>
+        `;
         
         modalBody.innerHTML = html;
         
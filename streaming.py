@@ -0,0 +1,132 @@
+import asyncio
+import threading
+from collections import deque
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+async def stream_in_thread(make_iterator, flush_interval=0.025, flush_bytes=4096):
+    """Iterate a blocking text iterator on a worker thread and yield coalesced chunks.
+
+    The iterator runs to completion on a single executor thread (one hop per
+    stream instead of one per token). The thread hands chunks to the event
+    loop via `loop.call_soon_threadsafe`, scheduling at most one callback at
+    a time, so a fast producer wakes the loop once per batch of tokens rather
+    than once per token.
+
+    On the loop side, the first chunk after a quiet period is yielded at once
+    (time to first token is untouched); after that, text is held back until
+    `flush_interval` seconds have passed since the last write, `flush_bytes`
+    characters have piled up, or the stream ends. `flush_interval=0` yields
+    every delivery as-is.
+
+    Exceptions raised by the iterator are re-raised here. If the consumer
+    stops early, the iterator is closed on its thread.
+    """
+    loop = asyncio.get_running_loop()
+    lock = threading.Lock()
+    pending = []  # producer side, guarded by lock
+    scheduled = False
+    stopped = threading.Event()
+
+    ready = deque()  # loop side
+    ready_chars = 0
+    ended = False
+    waiter = None
+    wake_on_any = False
+
+    def deliver():
+        nonlocal scheduled, ready_chars, ended
+        with lock:
+            items = pending[:]
+            pending.clear()
+            scheduled = False
+        for item in items:
+            ready.append(item)
+            if isinstance(item, str):
+                ready_chars += len(item)
+            else:
+                ended = True
+        if waiter is not None and not waiter.done() and (wake_on_any or ended or ready_chars >= flush_bytes):
+            waiter.set_result(None)
+
+    def push(item):
+        nonlocal scheduled
+        if stopped.is_set():
+            # Nobody is listening any more and the loop may already be gone
+            return
+        with lock:
+            pending.append(item)
+            if scheduled:
+                return
+            scheduled = True
+        loop.call_soon_threadsafe(deliver)
+
+    def produce():
+        iterator = None
+        try:
+            iterator = make_iterator()
+            for chunk in iterator:
+                if stopped.is_set():
+                    break
+                push(chunk)
+        except Exception as e:
+            push(_Failure(e))
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+            push(_END)
+
+    async def wait(timeout=None):
+        nonlocal waiter
+        waiter = loop.create_future()
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            waiter = None
+
+    producer = loop.run_in_executor(None, produce)
+    last_flush = None
+    finished = False
+    try:
+        while not finished:
+            if not ready:
+                wake_on_any = True
+                await wait()
+                wake_on_any = False
+
+            # Hold the text back until the flush window closes or enough piled up
+            if last_flush is not None and not ended and ready_chars < flush_bytes:
+                remaining = flush_interval - (loop.time() - last_flush)
+                if remaining > 0:
+                    await wait(remaining)
+
+            text = []
+            failure = None
+            while ready:
+                item = ready.popleft()
+                if item is _END:
+                    finished = True
+                elif isinstance(item, _Failure):
+                    failure = item
+                else:
+                    text.append(item)
+            ready_chars = 0
+
+            if text:
+                yield "".join(text)
+                last_flush = loop.time()
+            if failure is not None:
+                raise failure.error
+    finally:
+        stopped.set()
+        if finished:
+            await producer
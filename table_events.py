@@ -0,0 +1,175 @@
+"""Incremental table parsing and structured stream events for /ocr.
+
+`TableParser` consumes model output as it streams and hands back each table
+row as soon as its `</tr>` (or the next row, or the end of the table) is
+seen. `StreamEvents` turns the plain /ocr text stream into NDJSON lines or
+server-sent events carrying the raw text, the completed rows and the
+control markers (queue position, abort, error) as separate events.
+"""
+import csv
+import io
+import json
+import re
+from html.parser import HTMLParser
+
+# Control comments the server mixes into the text stream; page markers stay in the text
+MARKER = re.compile(r"<!-- (?:Queue position: (\d+)|(Process Aborted)|Error: (.*?)|Server-Timing: (.*?)) -->", re.S)
+
+
+class TableParser(HTMLParser):
+    """Rows of the outermost tables in a stream of HTML, as lists of cell texts.
+
+    Work per call is proportional to the text fed, so parsing a whole
+    response costs the same whether it arrives in one piece or token by
+    token. A cell spanning several columns is followed by empty cells so
+    columns line up; tables nested in a cell become part of its text.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.table = -1  # index of the current outermost table
+        self.depth = 0
+        self.row = None  # cells of the open row
+        self.cell = None  # text parts of the open cell
+        self.colspan = 1
+        self.row_index = 0
+        self.completed = []
+
+    def feed(self, data):
+        """Parse more text; returns the rows it completed as (table, row, cells)."""
+        super().feed(data)
+        rows, self.completed = self.completed, []
+        return rows
+
+    def close(self):
+        super().close()
+        self._end_row()
+        rows, self.completed = self.completed, []
+        return rows
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "table":
+            self.depth += 1
+            if self.depth == 1:
+                self.table += 1
+                self.row_index = 0
+        elif self.depth != 1:
+            return
+        elif tag == "tr":
+            self._end_row()
+            self.row = []
+        elif tag in ("td", "th"):
+            self._end_cell()
+            if self.row is None:
+                self.row = []
+            self.cell = []
+            try:
+                self.colspan = max(1, min(int(dict(attrs).get("colspan") or 1), 1000))
+            except ValueError:
+                self.colspan = 1
+        elif tag == "br" and self.cell is not None:
+            self.cell.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag == "table":
+            if self.depth == 1:
+                self._end_row()
+            self.depth = max(0, self.depth - 1)
+        elif self.depth != 1:
+            return
+        elif tag in ("td", "th"):
+            self._end_cell()
+        elif tag == "tr":
+            self._end_row()
+
+    def handle_data(self, data):
+        if self.cell is not None:
+            self.cell.append(data)
+
+    def _end_cell(self):
+        if self.cell is None:
+            return
+        self.row.append("".join(self.cell).strip())
+        self.row.extend([""] * (self.colspan - 1))
+        self.cell = None
+
+    def _end_row(self):
+        self._end_cell()
+        if self.row:
+            self.completed.append((self.table, self.row_index, self.row))
+            self.row_index += 1
+        self.row = None
+
+
+class StreamEvents:
+    """Encodes /ocr output chunks as `ndjson` lines or `sse` messages.
+
+    Events: `text` (raw model output, concatenating to the plain response),
+    `row` (a completed table row, when `parse_tables`), `queue`, `aborted`,
+    `error`, `timing`, and a final `done` with the number of rows.
+    """
+
+    def __init__(self, format="ndjson", parse_tables=True):
+        if format not in ("ndjson", "sse"):
+            raise ValueError(f"Unknown event format: {format}")
+        self.format = format
+        self.parser = TableParser() if parse_tables else None
+        self.rows = 0
+
+    def _encode(self, event):
+        data = json.dumps(event, ensure_ascii=False)
+        if self.format == "sse":
+            return f"event: {event['type']}\ndata: {data}\n\n"
+        return data + "\n"
+
+    def _rows(self, rows):
+        self.rows += len(rows)
+        return [self._encode({"type": "row", "table": table, "row": index, "cells": cells})
+                for table, index, cells in rows]
+
+    def _text(self, text):
+        if not text:
+            return []
+        events = [self._encode({"type": "text", "text": text})]
+        if self.parser is not None:
+            events += self._rows(self.parser.feed(text))
+        return events
+
+    def feed(self, chunk):
+        events = []
+        position = 0
+        for match in MARKER.finditer(chunk):
+            events += self._text(chunk[position:match.start()])
+            queue, aborted, error, timing = match.groups()
+            if queue is not None:
+                events.append(self._encode({"type": "queue", "position": int(queue)}))
+            elif aborted:
+                events.append(self._encode({"type": "aborted"}))
+            elif error is not None:
+                events.append(self._encode({"type": "error", "message": error}))
+            else:
+                events.append(self._encode({"type": "timing", "server_timing": timing}))
+            position = match.end()
+        events += self._text(chunk[position:])
+        return "".join(events)
+
+    def close(self):
+        events = self._rows(self.parser.close()) if self.parser is not None else []
+        events.append(self._encode({"type": "done", "rows": self.rows}))
+        return "".join(events)
+
+
+def tables_to_csv(html):
+    """Every outermost table in `html` as CSV, tables separated by a `--- Table N ---` line."""
+    parser = TableParser()
+    rows = parser.feed(html) + parser.close()
+    out = io.StringIO()
+    writer = csv.writer(out, quoting=csv.QUOTE_ALL, lineterminator="\r\n")
+    tables = []
+    for table, _, cells in rows:
+        if table not in tables:
+            if tables:
+                out.write(f"\n\n--- Table {len(tables) + 1} ---\n")
+            tables.append(table)
+        writer.writerow(cells)
+    return out.getvalue() if tables else None
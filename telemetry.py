@@ -0,0 +1,194 @@
+"""Background sampling of device utilisation behind GET /gpu.
+
+A daemon thread polls every `interval` seconds and appends one sample to a
+bounded ring buffer, so reading the dashboard never touches the devices.
+GPUs are read through NVML (`nvidia-ml-py`): real utilisation, memory used
+by every process on the device, temperature and power. The process side is
+always sampled from /proc: CPU utilisation and resident memory of the
+server plus any model replica processes, and the host's available memory.
+Each sample also lists the OCR jobs that were running when it was taken.
+"""
+import collections
+import os
+import threading
+import time
+
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+MB = 1024**2
+
+
+def _cpu_count():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _process_usage(pid):
+    """(CPU seconds, resident bytes) of one process, or None once it is gone."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # Fields after the parenthesised command name; utime and stime are the 14th and 15th
+            fields = f.read().rpartition(")")[2].split()
+        with open(f"/proc/{pid}/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS, pages * PAGE_SIZE
+
+
+def _host_memory():
+    info = {}
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("MemTotal", "MemAvailable"):
+                    info[name] = int(value.split()[0]) * 1024
+    except OSError:
+        return None, None
+    return info.get("MemTotal"), info.get("MemAvailable")
+
+
+class NvmlDevices:
+    """Every GPU NVML can see; construction fails where there is no driver."""
+
+    def __init__(self):
+        if pynvml is None:
+            raise RuntimeError("nvidia-ml-py is not installed")
+        pynvml.nvmlInit()
+        self.handles = [pynvml.nvmlDeviceGetHandleByIndex(i) for i in range(pynvml.nvmlDeviceGetCount())]
+        self.names = []
+        for handle in self.handles:
+            name = pynvml.nvmlDeviceGetName(handle)
+            self.names.append(name.decode() if isinstance(name, bytes) else name)
+
+    def _optional(self, read):
+        # Temperature and power are not reported by every board
+        try:
+            return read()
+        except pynvml.NVMLError:
+            return None
+
+    def sample(self):
+        devices = []
+        for index, (handle, name) in enumerate(zip(self.handles, self.names)):
+            rates = pynvml.nvmlDeviceGetUtilizationRates(handle)
+            memory = pynvml.nvmlDeviceGetMemoryInfo(handle)
+            power = self._optional(lambda: pynvml.nvmlDeviceGetPowerUsage(handle))
+            devices.append({
+                "index": index,
+                "name": name,
+                "utilization": rates.gpu,
+                "memory_utilization": rates.memory,
+                "memory_used_mb": round(memory.used / MB),
+                "memory_total_mb": round(memory.total / MB),
+                "temperature_c": self._optional(
+                    lambda: pynvml.nvmlDeviceGetTemperature(handle, pynvml.NVML_TEMPERATURE_GPU)),
+                "power_w": None if power is None else round(power / 1000, 1),
+            })
+        return devices
+
+    def close(self):
+        pynvml.nvmlShutdown()
+
+
+class TelemetrySampler:
+    """Samples devices every `interval` seconds into a ring buffer of `history` samples.
+
+    `jobs` returns the ids of the jobs running right now and `processes` the
+    pids to count besides this one (model replicas); both are called from the
+    sampler thread.
+    """
+
+    def __init__(self, interval=1.0, history=600, jobs=None, processes=None):
+        self.interval = interval
+        self.samples = collections.deque(maxlen=history)
+        self.jobs = jobs or (lambda: [])
+        self.processes = processes or (lambda: [])
+        self.cpus = _cpu_count()
+        self.last_cpu = {}  # pid -> (CPU seconds, monotonic time) at the previous sample
+        self.stop_event = threading.Event()
+        self.thread = None
+        try:
+            self.gpus = NvmlDevices()
+        except Exception as e:
+            print(f"[TELEMETRY] No NVML ({e}); sampling the CPU and process memory only")
+            self.gpus = None
+
+    @property
+    def source(self):
+        return "nvml" if self.gpus is not None else "process"
+
+    def _process_sample(self, now):
+        cpu_percent, rss, seen = 0.0, 0, {}
+        for pid in [os.getpid(), *self.processes()]:
+            usage = _process_usage(pid)
+            if usage is None:
+                continue
+            seconds, resident = usage
+            rss += resident
+            seen[pid] = (seconds, now)
+            previous = self.last_cpu.get(pid)
+            if previous is not None and now > previous[1]:
+                cpu_percent += (seconds - previous[0]) / (now - previous[1])
+        self.last_cpu = seen
+        total, available = _host_memory()
+        return {
+            # 100 means every CPU this process may run on was busy
+            "cpu_percent": round(cpu_percent / self.cpus * 100, 1),
+            "rss_mb": round(rss / MB),
+            "host_memory_total_mb": None if total is None else round(total / MB),
+            "host_memory_available_mb": None if available is None else round(available / MB),
+        }
+
+    def sample(self):
+        now = time.monotonic()
+        sample = {"time": time.time(), "devices": [], "process": self._process_sample(now), "jobs": []}
+        if self.gpus is not None:
+            try:
+                sample["devices"] = self.gpus.sample()
+            except Exception as e:
+                print(f"[TELEMETRY] NVML query failed: {e}")
+        try:
+            sample["jobs"] = list(self.jobs())
+        except RuntimeError:
+            # The running set changed under us; the next sample will have it
+            pass
+        self.samples.append(sample)
+        return sample
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            started = time.monotonic()
+            self.sample()
+            self.stop_event.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def start(self):
+        if self.thread is None and self.interval > 0:
+            self.thread = threading.Thread(target=self._run, name="telemetry", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+        if self.gpus is not None:
+            self.gpus.close()
+            self.gpus = None
+
+    def latest(self):
+        return self.samples[-1] if self.samples else None
+
+    def series(self, seconds=None):
+        """Samples oldest first, only those of the last `seconds` when given."""
+        samples = list(self.samples)
+        if seconds is not None:
+            cutoff = time.time() - seconds
+            samples = [sample for sample in samples if sample["time"] >= cutoff]
+        return samples
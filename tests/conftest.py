@@ -3,6 +3,7 @@ from fastapi.testclient import TestClient
 import os
 import shutil
 import sys
+import time
 
 # Add project root to sys.path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
@@ -13,8 +14,10 @@ def client():
     from main import app
     
     # TestClient context manager triggers the lifespan events (startup/shutdown)
-    # This will load the REAL GLMOCR model.
+    # This will load the REAL GLMOCR model, in the background: wait until it is ready.
     with TestClient(app) as c:
+        while c.get("/readyz").json()["state"] in ("starting", "loading"):
+            time.sleep(0.5)
         yield c
 
 @pytest.fixture(autouse=True)
@@ -23,4 +26,11 @@ def clean_directories():
     os.makedirs("uploads", exist_ok=True)
     os.makedirs("data", exist_ok=True)
     yield
-    # Teardown: Clean up specific test artifacts if needed
\ No newline at end of file
+    # Teardown: Clean up specific test artifacts if needed
+
+
+@pytest.fixture(scope="session")
+def tiny_model_path(tmp_path_factory):
+    # Tiny random GLM-OCR checkpoint: runs offline on CPU, output is gibberish
+    from bench.tiny_model import build_tiny_model
+    return build_tiny_model(str(tmp_path_factory.mktemp("tiny-glm-ocr")))
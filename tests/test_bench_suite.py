@@ -0,0 +1,23 @@
+from bench.suite import compare_results
+
+
+def report(**results):
+    return {"meta": {}, "results": results}
+
+
+def test_compare_flags_regressions_by_direction():
+    baseline = report(**{"direct/1": {"mean_latency": 1.0, "throughput": 100.0, "mean_cer": 0.10}})
+    candidate = report(**{
+        "direct/1": {"mean_latency": 1.05, "throughput": 80.0, "mean_cer": 0.15},
+        "api/1": {"mean_latency": 9.0},
+    })
+    rows = {row[1]: row for row in compare_results(baseline, candidate, threshold=0.1, cer_threshold=0.01)}
+
+    assert set(rows) == {"mean_latency", "throughput", "mean_cer"}
+    assert not rows["mean_latency"][5]  # 5% slower is within the threshold
+    assert rows["throughput"][5]  # 20% fewer tokens/s
+    assert rows["mean_cer"][5] and abs(rows["mean_cer"][4] - 0.05) < 1e-9
+
+    # Improvements never count as regressions
+    improved = report(**{"direct/1": {"mean_latency": 0.5, "throughput": 200.0, "mean_cer": 0.0}})
+    assert not any(row[5] for row in compare_results(baseline, improved))
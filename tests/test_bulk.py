@@ -0,0 +1,67 @@
+import json
+import os
+import shutil
+
+import bulk
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_source(tmp_path):
+    source = tmp_path / "scans"
+    (source / "tables").mkdir(parents=True)
+    for name in ("a.jpg", "b.jpg"):
+        shutil.copy(os.path.join(ROOT, "test_images", "hand_written_table.jpg"), source / "tables" / name)
+    shutil.copy(os.path.join(ROOT, "test_images", "test_text.PNG"), source / "page.png")
+    return source
+
+
+def read_jsonl(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_bulk_run_applies_rules_and_resumes(tiny_model_path, tmp_path):
+    source = make_source(tmp_path)
+    output = str(tmp_path / "results.jsonl")
+    argv = [str(source), "--output", output, "--model", tiny_model_path, "--device", "cpu",
+            "--max-new-tokens", "8", "--mode", "text", "--rule", "tables/*=table:2"]
+    bulk.main(argv)
+
+    records = read_jsonl(output)
+    modes = {record["path"]: record["mode"] for record in records}
+    assert modes == {os.path.join("tables", "a.jpg"): "table", os.path.join("tables", "b.jpg"): "table",
+                     "page.png": "text"}
+    assert all("text" in record and "error" not in record for record in records)
+
+    # A crash after the last record was written but before it was checkpointed
+    with open(output + ".checkpoint") as f:
+        lines = f.readlines()
+    with open(output + ".checkpoint", "w") as f:
+        f.writelines(lines[:-1])
+        f.write('{"path": "tru')
+    bulk.main(argv)
+    resumed = read_jsonl(output)
+    assert sorted(record["path"] for record in resumed) == sorted(modes)
+    assert resumed[:2] == records[:2]
+
+    # Nothing left to do
+    bulk.main(argv)
+    assert read_jsonl(output) == resumed
+
+
+def test_bulk_csv_output_and_manifest(tiny_model_path, tmp_path):
+    import csv
+
+    source = make_source(tmp_path)
+    manifest = source / "manifest.txt"
+    manifest.write_text('page.png\n{"path": "tables/a.jpg", "mode": "text"}\nmissing.png\n')
+    output = str(tmp_path / "results.csv")
+    bulk.main([str(manifest), "--output", output, "--model", tiny_model_path, "--device", "cpu",
+               "--max-new-tokens", "8", "--batch-size", "1"])
+
+    with open(output, newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert {row["path"]: row["mode"] for row in rows} == {"page.png": "table", os.path.join("tables", "a.jpg"): "text",
+                                                         "missing.png": "table"}
+    assert [row["path"] for row in rows if row["error"]] == ["missing.png"]
@@ -0,0 +1,57 @@
+import os
+import time
+
+from cache import ResultCache, cache_key
+
+
+def test_key_covers_mode_and_signature():
+    key = cache_key("digest", "table", "rev1")
+    assert key == cache_key("digest", "table", "rev1")
+    assert key != cache_key("digest", "text", "rev1")
+    assert key != cache_key("digest", "table", "rev2")
+    assert key != cache_key("other", "table", "rev1")
+
+
+def test_memory_and_disk_tiers(tmp_path):
+    cache = ResultCache(str(tmp_path), memory_max_bytes=1024, disk_max_bytes=1024)
+    assert cache.get("a") is None
+    cache.put("a", "<table></table>")
+    assert cache.get("a") == "<table></table>"
+
+    # A fresh instance over the same directory is served from disk
+    reopened = ResultCache(str(tmp_path), memory_max_bytes=1024, disk_max_bytes=1024)
+    assert reopened.get("a") == "<table></table>"
+    stats = reopened.stats()
+    assert stats["disk_hits"] == 1 and stats["memory_entries"] == 1
+
+
+def test_lru_eviction_by_size(tmp_path):
+    cache = ResultCache(str(tmp_path), memory_max_bytes=20, disk_max_bytes=0)
+    cache.put("a", "x" * 10)
+    cache.put("b", "y" * 10)
+    cache.get("a")
+    cache.put("c", "z" * 10)
+    assert cache.get("b") is None
+    assert cache.get("a") == "x" * 10
+    assert cache.stats()["evictions"] == 1
+
+
+def test_disk_size_cap(tmp_path):
+    cache = ResultCache(str(tmp_path), memory_max_bytes=0, disk_max_bytes=200)
+    for i in range(10):
+        cache.put(str(i), "x" * 50)
+        time.sleep(0.01)
+    assert cache.stats()["disk_bytes"] <= 200
+    assert cache.get("9") == "x" * 50
+    assert cache.get("0") is None
+
+
+def test_expiry(tmp_path):
+    cache = ResultCache(str(tmp_path), max_age=60)
+    cache.put("a", "old")
+    cache.memory["a"] = ("old", time.time() - 120)
+    path = os.path.join(str(tmp_path), "a.txt")
+    with open(path, "w") as f:
+        f.write(f"{time.time() - 120}\nold")
+    assert cache.get("a") is None
+    assert not os.path.exists(path)
@@ -0,0 +1,427 @@
+import os
+import threading
+import pytest
+import torch
+
+from transformers import CompileConfig
+
+from glm import GLMOCR, KVCacheBudget, StaticCachePool
+from tracing import Trace
+
+IMAGES = [
+    (os.path.join("test_images", "hand_written_table.jpg"), "table"),
+    (os.path.join("test_images", "test_text.PNG"), "text"),
+]
+
+
+@pytest.fixture(scope="module")
+def reference_model(tiny_model_path):
+    # One model.generate per request on freshly encoded images: the behaviour to reproduce
+    return GLMOCR(tiny_model_path, device="cpu", max_batch_size=0, max_new_tokens=24, vision_cache_bytes=0)
+
+
+@pytest.fixture(scope="module")
+def batched_model(tiny_model_path):
+    ocr = GLMOCR(tiny_model_path, device="cpu", max_batch_size=4, max_new_tokens=24)
+    yield ocr
+    ocr.close()
+
+
+def test_scheduler_matches_generate(reference_model, batched_model):
+    for image_path, mode in IMAGES:
+        expected = reference_model.process_image(image_path, type=mode)
+        assert batched_model.process_image(image_path, type=mode) == expected
+
+
+def test_scheduler_concurrent_streams(reference_model, batched_model):
+    expected = ["".join(reference_model.process_image_stream(p, type=m)) for p, m in IMAGES]
+
+    # More clients than batch slots, so some are admitted mid-decode
+    results = {}
+    def client(index):
+        image_path, mode = IMAGES[index % len(IMAGES)]
+        results[index] = "".join(batched_model.process_image_stream(image_path, type=mode))
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for index, text in results.items():
+        assert text == expected[index % len(IMAGES)]
+    assert batched_model.scheduler.stats() == {"active": 0, "pending": 0}
+
+
+def test_vision_cache_reused_across_modes(tiny_model_path, reference_model):
+    ocr = GLMOCR(tiny_model_path, device="cpu", max_batch_size=4, max_new_tokens=24)
+    image_path = IMAGES[0][0]
+
+    _, first = ocr._prepare_inputs(image_path, "table")
+    _, second = ocr._prepare_inputs(image_path, "text")
+    assert first["vision_cache"] == "miss"
+    assert second["vision_cache"] == "hit"
+    assert second["prefill_saved"] > 0
+
+    for mode in ("table", "text", "table"):
+        assert ocr.process_image(image_path, type=mode) == reference_model.process_image(image_path, type=mode)
+    assert ocr.vision_cache.stats() == {"hits": 4, "misses": 1, "entries": 1, "bytes": ocr.vision_cache.total_bytes}
+
+
+def test_in_memory_images_match_paths(reference_model):
+    from PIL import Image
+
+    for image_path, mode in IMAGES:
+        expected = reference_model.process_image(image_path, type=mode)
+        with open(image_path, "rb") as f:
+            data = f.read()
+        assert "".join(reference_model.process_image_stream(data, type=mode)) == "".join(
+            reference_model.process_image_stream(image_path, type=mode))
+        assert reference_model.process_image(data, type=mode) == expected
+        with Image.open(image_path) as image:
+            assert reference_model.process_image(image, type=mode) == expected
+
+
+def test_image_token_budget(reference_model):
+    image_path = IMAGES[1][0]
+    inputs, _ = reference_model._prepare_inputs(image_path, "text")
+    full_tokens = int(inputs["image_grid_thw"][0].prod()) // 4
+
+    reference_model.image_token_budget = {"text": 64}
+    try:
+        inputs, _ = reference_model._prepare_inputs(image_path, "text")
+        assert int(inputs["image_grid_thw"][0].prod()) // 4 <= 64 < full_tokens
+        # Only the budgeted mode is affected
+        inputs, _ = reference_model._prepare_inputs(image_path, "table")
+        assert int(inputs["image_grid_thw"][0].prod()) // 4 == full_tokens
+        assert "image_tokens=text:64" in reference_model.cache_signature()
+    finally:
+        reference_model.image_token_budget = {}
+
+
+def test_scheduler_close_stops_its_thread(tiny_model_path, reference_model):
+    from glm import GenerationRequest
+
+    ocr = GLMOCR(tiny_model_path, device="cpu", max_batch_size=2, max_new_tokens=24, vision_cache_bytes=0)
+    image_path, mode = IMAGES[1]
+    assert ocr.process_image(image_path, type=mode) == reference_model.process_image(image_path, type=mode)
+    thread = ocr.scheduler.thread
+    ocr.close()
+    assert not thread.is_alive()
+    with pytest.raises(RuntimeError):
+        ocr.scheduler.submit(GenerationRequest(ocr._prepare_inputs(image_path, mode)[0]))
+
+
+def test_tiled_batches_match(reference_model, batched_model):
+    # Padded model.generate over all bands and the scheduler agree band for band
+    image_path, mode = IMAGES[1]
+    stops = [sum(model.stop_stats().values()) for model in (reference_model, batched_model)]
+    expected = reference_model.process_image_tiled(image_path, type=mode, band_tokens=64)
+    assert batched_model.process_image_tiled(image_path, type=mode, band_tokens=64) == expected
+    assert batched_model.scheduler.stats() == {"active": 0, "pending": 0}
+    # A stop reason per generation: the one padded call, or each band in the scheduler
+    assert sum(reference_model.stop_stats().values()) == stops[0] + 1
+    assert sum(batched_model.stop_stats().values()) > stops[1] + 1
+
+
+def test_pages_stream_in_order(reference_model, batched_model):
+    from PIL import Image
+
+    images = [Image.open(path).convert("RGB") for path, _ in IMAGES]
+    expected = "".join(
+        f"<!-- Page {number} -->\n" + "".join(reference_model.process_image_stream(image, type="text")) + "\n"
+        for number, image in enumerate(images, 1)
+    )
+    assert "".join(batched_model.process_pages_stream(iter(images), type="text")) == expected
+
+
+def test_repetition_criteria():
+    import torch
+    from glm import RepetitionCriteria
+
+    def fires(generated):
+        criteria = RepetitionCriteria(prompt_length=4, max_period=8, repeats=6, min_span=24, check_every=1)
+        ids = torch.tensor([[9, 9, 9, 9] + generated])
+        return bool(criteria(ids, None)[0])
+
+    assert fires([1, 2, 3] * 12)
+    assert fires([5, 6] + [7] * 40)
+    assert not fires([1, 2, 3] * 6)  # too short to call it a loop
+    assert not fires(list(range(60)))
+
+
+def test_table_end_criteria(reference_model):
+    import torch
+    from glm import TableEndCriteria
+
+    tokenizer = reference_model.processor.tokenizer
+    text = "<table><tr><td><table><tr><td>x</td></tr></table></td></tr></table>"
+    ids = tokenizer(text, add_special_tokens=False).input_ids + tokenizer("trailing", add_special_tokens=False).input_ids
+    criteria = TableEndCriteria(tokenizer, prompt_length=0)
+    stopped_at = None
+    for end in range(1, len(ids) + 1):
+        if criteria(torch.tensor([ids[:end]]), None)[0]:
+            stopped_at = end
+            break
+    # Nested table closes do not count, the outer one does
+    assert tokenizer.decode(ids[:stopped_at]) == text
+
+
+def test_stop_reasons_and_token_budget(tiny_model_path):
+    ocr = GLMOCR(tiny_model_path, device="cpu", max_batch_size=0, max_new_tokens=24, vision_cache_bytes=0,
+                 output_token_ratio={"text": 2.0})
+    assert ocr._token_budget("text", 10000) == 24
+    assert ocr._token_budget("table", 10) == 24
+    ocr.max_new_tokens = 8192
+    assert ocr._token_budget("text", 100) == 456
+    ocr.max_new_tokens = 24
+
+    trace = Trace()
+    "".join(ocr.process_image_stream(IMAGES[1][0], type="text", trace=trace))
+    # Output cut off by the token limit is marked so main.py keeps it out of the result cache
+    assert ("truncated" in trace.marks) == (ocr.stop_stats()["max_new_tokens"] == 1)
+    ocr.process_image(IMAGES[1][0], type="text")
+    stats = ocr.stop_stats()
+    assert sum(stats.values()) == 2
+    assert stats["eos"] + stats["max_new_tokens"] == 2
+
+
+def test_stream_records_metrics(tiny_model_path):
+    import metrics
+
+    ocr = GLMOCR(tiny_model_path, device="cpu", max_batch_size=0, max_new_tokens=24, vision_cache_bytes=0)
+    output_tokens = metrics.OUTPUT_TOKENS.labels("text")
+    count, total = sum(output_tokens.counts), output_tokens.sum
+
+    "".join(ocr.process_image_stream(IMAGES[1][0], type="text"))
+    assert sum(output_tokens.counts) == count + 1
+    generated = output_tokens.sum - total
+    # Counted from the generated ids, not by re-tokenising the text
+    stats = ocr.stop_stats()
+    assert generated == 24 if stats["max_new_tokens"] else 0 < generated < 24
+    assert sum(metrics.TTFT.labels("text").counts) >= 1
+    assert 'glm_ocr_generation_stops_total{mode="text",reason=' in metrics.render()
+
+
+def test_speculative_matches_greedy(tiny_model_path):
+    # Long enough runs for the drafts to kick in; loops are left to run their course
+    settings = dict(device="cpu", max_batch_size=0, max_new_tokens=96, vision_cache_bytes=0, stop_on_repetition=False)
+    greedy = GLMOCR(tiny_model_path, **settings)
+    speculative = GLMOCR(tiny_model_path, speculative_draft_tokens=6, **settings)
+    for image_path, mode in IMAGES:
+        assert speculative.process_image(image_path, type=mode) == greedy.process_image(image_path, type=mode)
+        assert "".join(speculative.process_image_stream(image_path, type=mode)) == "".join(
+            greedy.process_image_stream(image_path, type=mode))
+
+
+def test_ngram_index_drafts_continuation():
+    from glm import NgramIndex
+
+    index = NgramIndex(max_ngram=2)
+    for token in [1, 2, 3, 4, 1, 2]:
+        index.append(token)
+    assert index.draft(3) == [3, 4, 1]
+    index.append(9)
+    assert index.draft(3) == []
+
+
+def test_cpu_int8_quantises_language_model(tiny_model_path):
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicLinear
+
+    ocr = GLMOCR(tiny_model_path, device="cpu", max_batch_size=2, max_new_tokens=8, vision_cache_bytes=0,
+                 cpu_precision="int8", warmup=True)
+    language_model = list(ocr.model.model.language_model.modules())
+    assert any(isinstance(m, DynamicLinear) for m in language_model)
+    assert not any(isinstance(m, torch.nn.Linear) for m in language_model)
+    assert isinstance(ocr.model.lm_head, DynamicLinear)
+    # The vision encoder stays in floating point
+    assert not any(isinstance(m, DynamicLinear) for m in ocr.model.model.visual.modules())
+    assert ocr.cache_signature().endswith("|precision=int8")
+
+    image_path, mode = IMAGES[1]
+    assert ocr.process_image(image_path, type=mode)
+    assert "".join(ocr.process_image_stream(image_path, type=mode))
+
+    with pytest.raises(ValueError):
+        GLMOCR(tiny_model_path, device="cpu", cpu_precision="int4")
+
+
+def test_static_cache_matches_eager(tiny_model_path, reference_model):
+    ocr = GLMOCR(tiny_model_path, device="cpu", max_batch_size=4, max_new_tokens=24, vision_cache_bytes=0,
+                 static_cache_buckets=[512, 1024], warmup=True)
+    assert ocr.scheduler is None
+    # Warm-up compiled every bucket: prompts of other lengths reuse those graphs and the same caches
+    with torch.compiler.set_stance("fail_on_recompile"):
+        for image_path, mode in IMAGES:
+            assert ocr.process_image(image_path, type=mode) == reference_model.process_image(image_path, type=mode)
+            assert "".join(ocr.process_image_stream(image_path, type=mode)) == "".join(
+                reference_model.process_image_stream(image_path, type=mode))
+    stats = ocr.static_caches.stats()
+    assert stats["allocated"] == 2 and stats["fallbacks"] == 0
+
+    # The decode step is compiled on the CPU too, once per bucket: counted by the backend it compiles with
+    graphs = []
+
+    def backend(graph, example_inputs):
+        graphs.append(graph)
+        return graph.forward
+
+    cold = GLMOCR(tiny_model_path, device="cpu", max_batch_size=0, vision_cache_bytes=0)
+    pool = StaticCachePool(cold.model, [512], CompileConfig(backend=backend, mode=None))
+    for image_path, mode in IMAGES:
+        inputs, _ = cold._prepare_inputs(image_path, mode)
+        with torch.no_grad():
+            pool.generate(inputs, max_new_tokens=4)
+    assert len(graphs) == 1
+
+    # Tiled bands run as a batch, on a dynamic cache
+    image_path, mode = IMAGES[1]
+    assert ocr.process_image_tiled(image_path, type=mode, band_tokens=128) == reference_model.process_image_tiled(
+        image_path, type=mode, band_tokens=128)
+    assert ocr.static_caches.stats()["fallbacks"] == 1
+
+    with pytest.raises(ValueError):
+        GLMOCR(tiny_model_path, device="cpu", speculative_draft_tokens=4, static_cache_buckets="auto")
+
+
+def test_kv_budget_estimates_and_admits(reference_model):
+    budget = KVCacheBudget(reference_model.model, 0, quantized_backend="quanto")
+    # Nothing to offload to when the model already lives in host memory
+    assert budget.strategies == ["full", "quantized"]
+    inputs, _ = reference_model._prepare_inputs(*IMAGES[1])
+    with torch.no_grad():
+        output = reference_model.model.generate(**inputs, max_new_tokens=8, return_dict_in_generate=True)
+    cached = sum(layer.keys.nbytes + layer.values.nbytes for layer in output.past_key_values.layers)
+    # The last token is never fed back, so it has no cache entry
+    assert cached == budget.estimate(output.sequences.shape[1] - 1)
+    assert budget.estimate(4096, "quantized") < budget.estimate(4096)
+
+    tokens = 1000
+    budget.budget_bytes = budget.estimate(tokens) + budget.estimate(tokens, "quantized")
+    first = budget.reserve(tokens)
+    second = budget.reserve(tokens)
+    assert (first.strategy, second.strategy) == ("full", "quantized")
+
+    # Nothing fits beside those two: the next request waits for one to finish
+    waiting = []
+    thread = threading.Thread(target=lambda: waiting.append(budget.reserve(tokens)))
+    thread.start()
+    thread.join(0.3)
+    assert thread.is_alive()
+    budget.release(first)
+    thread.join(5)
+    assert waiting[0].strategy == "full" and waiting[0].waited
+
+    # Too long to fit even alone: runs over the budget on the most compact cache instead of failing
+    alone = budget.reserve(tokens * 10)
+    assert alone.strategy == "quantized" and not alone.waited
+    for reservation in (second, waiting[0], alone, alone):
+        budget.release(reservation)
+    stats = budget.stats()
+    assert stats["reserved_bytes"] == 0
+    assert (stats["waited"], stats["over_budget"], stats["full"], stats["quantized"]) == (1, 1, 2, 2)
+
+
+def test_kv_budget_serialises_requests_it_cannot_hold(tiny_model_path, reference_model):
+    ocr = GLMOCR(tiny_model_path, device="cpu", max_batch_size=4, max_new_tokens=24, vision_cache_bytes=0,
+                 kv_cache_budget_bytes=1)
+    expected = [reference_model.process_image(image_path, type=mode) for image_path, mode in IMAGES]
+    # One request at a time fits (over budget, alone); the others queue for it
+    ocr.kv_budget.budget_bytes = ocr.kv_budget.estimate(1024)
+    results = {}
+
+    def run(index, image_path, mode):
+        results[index] = "".join(ocr.process_image_stream(image_path, type=mode))
+
+    threads = [threading.Thread(target=run, args=(i, *IMAGES[i % 2])) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [results[i] for i in range(4)] == [expected[i % 2] for i in range(4)]
+    assert ocr.process_image(*IMAGES[0]) == expected[0]
+    stats = ocr.kv_budget.stats()
+    assert stats["reserved_bytes"] == 0 and stats["waited"] >= 1
+    assert stats["peak_reserved"] <= stats["budget_bytes"]
+
+
+def test_kv_budget_degrades_speculative_requests(tiny_model_path, monkeypatch):
+    # Long enough for the 4-bit cache to be the smaller one on the tiny model
+    settings = dict(device="cpu", max_batch_size=0, max_new_tokens=512, vision_cache_bytes=0)
+    greedy = GLMOCR(tiny_model_path, **settings)
+    ocr = GLMOCR(tiny_model_path, speculative_draft_tokens=4, kv_cache_budget_bytes=1, **settings)
+    # A quantised cache without a quantisation backend installed: the default cache on the quantised path
+    monkeypatch.setattr(ocr.kv_budget, "strategies", ["full", "quantized"])
+    monkeypatch.setattr(ocr.kv_budget, "new_cache", lambda strategy: None)
+    for image_path, mode in IMAGES:
+        inputs, _ = ocr._prepare_inputs(image_path, mode)
+        tokens = inputs["input_ids"].shape[1] + ocr._token_budget(mode, ocr._visual_tokens(inputs))
+        # Room for the quantised cache only
+        ocr.kv_budget.budget_bytes = ocr.kv_budget.estimate(tokens, "quantized")
+        assert ocr.kv_budget.estimate(tokens) > ocr.kv_budget.budget_bytes
+        degraded, full = Trace(), Trace()
+        assert "".join(ocr.process_image_stream(image_path, type=mode, trace=degraded)) == "".join(
+            greedy.process_image_stream(image_path, type=mode, trace=full))
+        # What main.py checks before putting the output in the result cache
+        assert "kv_cache_degraded" in degraded.marks and "kv_cache_degraded" not in full.marks
+        assert ocr.process_image(image_path, type=mode) == greedy.process_image(image_path, type=mode)
+    assert ocr.kv_budget.stats()["quantized"] == 4
+
+
+def test_kv_budget_accounts_batch_padding(reference_model):
+    budget = KVCacheBudget(reference_model.model, 0)
+    short = budget.reserve(100, batched=True)
+    # Joining the batch pads the short row to this one's length too
+    long = budget.reserve(400, batched=True)
+    assert long.size == budget.estimate(400) * 2 - budget.estimate(100)
+    alone = budget.reserve(400)
+    assert budget.stats()["reserved_bytes"] == budget.estimate(400) * 3
+    budget.release(long)
+    assert budget.stats()["reserved_bytes"] == budget.estimate(100) + budget.estimate(400)
+    # Out of memory in the batch: the request goes on by itself, without the padding
+    budget.fallback(short)
+    assert not short.batched and budget.stats()["reserved_bytes"] == budget.estimate(100) + budget.estimate(400)
+    for reservation in (short, alone):
+        budget.release(reservation)
+    assert budget.stats()["reserved_bytes"] == 0
+
+
+def test_scheduler_out_of_memory_continues_outside_batch(tiny_model_path, reference_model, monkeypatch):
+    import glm
+
+    ocr = GLMOCR(tiny_model_path, device="cpu", max_batch_size=4, max_new_tokens=24, vision_cache_bytes=0,
+                 kv_cache_budget_bytes=1024**3)
+    expected = ["".join(reference_model.process_image_stream(p, type=m)) for p, m in IMAGES]
+    decode_step, prefill = ocr.scheduler._decode_step, glm._prefill
+    failures = {"decode": 3, "prefill": 1}
+
+    def failing_decode_step():
+        # A step partway through fails once the batch is full
+        if len(ocr.scheduler.active) == 2 and failures["decode"]:
+            failures["decode"] -= 1
+            if not failures["decode"]:
+                raise torch.OutOfMemoryError("simulated")
+        return decode_step()
+
+    def failing_prefill(model, request):
+        if failures["prefill"]:
+            failures["prefill"] -= 1
+            raise torch.OutOfMemoryError("simulated")
+        return prefill(model, request)
+
+    monkeypatch.setattr(ocr.scheduler, "_decode_step", failing_decode_step)
+    monkeypatch.setattr(glm, "_prefill", failing_prefill)
+    results = {}
+
+    def run(index, image_path, mode):
+        results[index] = "".join(ocr.process_image_stream(image_path, type=mode))
+
+    threads = [threading.Thread(target=run, args=(i, *IMAGES[i % 2])) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert failures == {"decode": 0, "prefill": 0}
+    assert [results[i] for i in range(3)] == [expected[i % 2] for i in range(3)]
+    assert ocr.process_image(*IMAGES[1]) == reference_model.process_image(*IMAGES[1])
+    assert ocr.kv_budget.stats()["reserved_bytes"] == 0
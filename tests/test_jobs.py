@@ -0,0 +1,67 @@
+import asyncio
+import pytest
+
+from jobs import JobQueue, QueueFullError
+
+
+def test_admission_limits():
+    queue = JobQueue(max_in_flight=1, max_queued=1)
+    running = queue.submit()
+    waiting = queue.submit()
+    assert running.state == "running"
+    assert queue.position(waiting) == 1
+
+    with pytest.raises(QueueFullError) as excinfo:
+        queue.submit()
+    assert excinfo.value.retry_after >= 1
+
+    queue.finish(running)
+    assert waiting.state == "running"
+    assert queue.stats()["running"] == 1
+
+
+def test_interactive_lane_goes_first():
+    queue = JobQueue(max_in_flight=1, max_queued=10)
+    first = queue.submit("bulk")
+    bulk = queue.submit("bulk")
+    interactive = queue.submit("interactive")
+    assert queue.position(interactive) == 1
+    assert queue.position(bulk) == 2
+
+    queue.finish(first)
+    assert interactive.state == "running"
+    assert bulk.state == "queued"
+
+
+def test_cancel_is_per_job():
+    queue = JobQueue(max_in_flight=2, max_queued=10)
+    a = queue.submit(session_id="s1")
+    b = queue.submit(session_id="s2")
+    queued = queue.submit(session_id="s1")
+
+    assert queue.cancel(job_id=a.id) == [a.id]
+    assert a.cancel_event.is_set()
+    assert not b.cancel_event.is_set()
+
+    # Cancelling a queued job removes it from its lane straight away
+    assert queue.cancel(session_id="s1") == [a.id, queued.id]
+    assert queued.state == "cancelled"
+    assert queue.stats()["queued"] == {"interactive": 0, "bulk": 0}
+
+    # There is no cancelling everything at once
+    with pytest.raises(ValueError):
+        queue.cancel()
+    assert not b.cancel_event.is_set()
+
+
+def test_wait_yields_positions_until_running():
+    async def scenario():
+        queue = JobQueue(max_in_flight=1, max_queued=10)
+        running = queue.submit()
+        waiting = queue.submit()
+        asyncio.get_running_loop().call_later(0.05, queue.finish, running)
+        return [position async for position in queue.wait(waiting, poll_interval=1.0)], waiting
+
+    positions, waiting = asyncio.run(scenario())
+    assert positions == [1]
+    assert waiting.state == "running"
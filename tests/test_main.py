@@ -2,6 +2,7 @@ import os
 import json
 import pytest
 import shutil
+import time
 
 def test_read_root(client):
     response = client.get("/")
@@ -47,9 +48,22 @@ def test_ocr_endpoint(client, filename, type_param):
     assert os.path.exists(session_dir)
     assert os.path.isdir(session_dir)
     
-    # Verify file is inside
-    files_in_session = os.listdir(session_dir)
-    assert len(files_in_session) == 1
+    # The upload is stored in the background: the reference and its preview show up shortly
+    file_id = response.headers["X-File-ID"]
+    extension = filename.rsplit(".", 1)[-1].lower()
+    expected = sorted([f"{file_id}.{extension}", f"{file_id}.preview.jpg"])
+    deadline = time.monotonic() + 10
+    while sorted(os.listdir(session_dir)) != expected and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert sorted(os.listdir(session_dir)) == expected
+    
+    # Both are served at the URLs the client was given
+    session_url = f"/uploads/{session_id}"
+    assert response.headers["X-Image-URL"] == f"{session_url}/{file_id}.{extension}"
+    assert response.headers["X-Preview-URL"] == f"{session_url}/{file_id}.preview.jpg"
+    with open(file_path, "rb") as f:
+        assert client.get(response.headers["X-Image-URL"]).content == f.read()
+    assert client.get(response.headers["X-Preview-URL"]).status_code == 200
     
     # Clean up
     shutil.rmtree(session_dir)
@@ -136,9 +150,12 @@ def test_gpu_status(client):
     assert "info" in data
 
 def test_cancel_endpoint(client):
-    response = client.post("/cancel")
+    # Naming no job must not cancel everyone's
+    assert client.post("/cancel").status_code == 400
+    assert client.post("/cancel", json={}).status_code == 400
+    response = client.post("/cancel", json={"job_id": "no-such-job"})
     assert response.status_code == 200
-    assert response.json()["status"] == "cancelled"
+    assert response.json() == {"status": "cancelled", "jobs": []}
 
 def test_image_serving(client):
     filename = "hand_written_table.jpg"
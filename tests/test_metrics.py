@@ -0,0 +1,32 @@
+import metrics
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = metrics.Histogram("test_latency_seconds", "Test latency.", ["mode"], buckets=(0.1, 1))
+    try:
+        for value in (0.05, 0.5, 0.5, 3):
+            histogram.labels("table").observe(value)
+        lines = histogram.render()
+    finally:
+        metrics.REGISTRY.remove(histogram)
+
+    assert lines[:2] == ["# HELP test_latency_seconds Test latency.", "# TYPE test_latency_seconds histogram"]
+    assert 'test_latency_seconds_bucket{mode="table",le="0.1"} 1' in lines
+    assert 'test_latency_seconds_bucket{mode="table",le="1"} 3' in lines
+    assert 'test_latency_seconds_bucket{mode="table",le="+Inf"} 4' in lines
+    assert 'test_latency_seconds_sum{mode="table"} 4.05' in lines
+    assert 'test_latency_seconds_count{mode="table"} 4' in lines
+
+
+def test_counter_labels_and_escaping():
+    counter = metrics.Counter("test_events_total", "Test events.", ["reason"])
+    try:
+        counter.labels("eos").inc()
+        counter.labels("eos").inc(2)
+        counter.labels('say "hi"').inc()
+        text = "\n".join(counter.render())
+    finally:
+        metrics.REGISTRY.remove(counter)
+
+    assert 'test_events_total{reason="eos"} 3' in text
+    assert 'test_events_total{reason="say \\"hi\\""} 1' in text
@@ -0,0 +1,29 @@
+import io
+
+from PIL import Image
+
+from pages import document_type, iter_pages
+
+
+def make_document(format, count=3):
+    frames = [Image.new("RGB", (200 + 10 * i, 100), (40 * i, 0, 0)) for i in range(count)]
+    buffer = io.BytesIO()
+    frames[0].save(buffer, format=format, save_all=True, append_images=frames[1:])
+    return buffer.getvalue()
+
+
+def test_document_type():
+    assert document_type(make_document("PDF")) == "pdf"
+    assert document_type(make_document("TIFF")) == "tiff"
+    # Single-page TIFFs and other images take the normal single-image path
+    assert document_type(make_document("TIFF", count=1)) is None
+    assert document_type(make_document("PNG", count=1)) is None
+
+
+def test_iter_pages_is_lazy():
+    for format in ("PDF", "TIFF"):
+        pages = iter_pages(make_document(format), dpi=72)
+        first = next(pages)
+        assert first.mode == "RGB"
+        assert first.size == (200, 100)
+        assert [page.size for page in pages] == [(210, 100), (220, 100)]
@@ -0,0 +1,64 @@
+import os
+import threading
+
+import metrics
+from glm import GLMOCR
+from pool import ModelPool, core_sets
+from tracing import Trace
+
+IMAGES = [
+    (os.path.join("test_images", "hand_written_table.jpg"), "table"),
+    (os.path.join("test_images", "test_text.PNG"), "text"),
+]
+
+
+def test_core_sets_split_evenly():
+    sets = core_sets(1)
+    if sets[0] is None:
+        return
+    cores = sets[0]
+    for replicas in range(1, len(cores) + 1):
+        split = core_sets(replicas)
+        assert sum(split, []) == cores
+        assert max(map(len, split)) - min(map(len, split)) <= 1
+
+
+def test_pool_matches_single_model(tiny_model_path):
+    kwargs = dict(max_batch_size=2, max_new_tokens=24, vision_cache_bytes=0)
+    reference = GLMOCR(tiny_model_path, device="cpu", **kwargs)
+    expected = ["".join(reference.process_image_stream(path, type=mode)) for path, mode in IMAGES]
+
+    pool = ModelPool(2, {"model_path": tiny_model_path, **kwargs}, devices=["cpu"], cores=[None, None])
+    try:
+        assert pool.cache_signature() == reference.cache_signature()
+        tokens = metrics.OUTPUT_TOKENS.labels("text")
+        count = sum(tokens.counts)
+
+        results = {}
+        def client(index):
+            path, mode = IMAGES[index % len(IMAGES)]
+            with open(path, "rb") as f:
+                results[index] = "".join(pool.process_image_stream(f.read(), type=mode))
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for index, text in results.items():
+            assert text == expected[index % len(IMAGES)]
+        # Both replicas took work, and what they recorded reached this process
+        assert [replica["completed"] for replica in pool.stats()] == [2, 2]
+        assert sum(tokens.counts) == count + 2
+
+        trace = Trace()
+        assert pool.process_image_tiled(IMAGES[1][0], type="text", trace=trace) == reference.process_image_tiled(
+            IMAGES[1][0], type="text")
+        assert "shm_write" in trace.spans and "generate" in trace.spans
+
+        aborted = threading.Event()
+        aborted.set()
+        assert "Aborted" in "".join(pool.process_image_stream(IMAGES[0][0], type="table", abort_event=aborted))
+        assert all(replica["active"] == 0 for replica in pool.stats())
+    finally:
+        pool.close()
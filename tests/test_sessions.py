@@ -0,0 +1,108 @@
+import json
+import os
+
+from sessions import SessionStore
+
+
+def test_list_returns_metadata_newest_first(tmp_path):
+    store = SessionStore(str(tmp_path))
+    store.save("a", "First", "<table>a</table>", "2024-01-01 10:00:00")
+    store.save("b", "Second", "<table>b</table>", "2024-01-02 10:00:00")
+    store.save("c", "Third", "<table>c</table>", "2024-01-03 10:00:00")
+
+    total, items = store.list()
+    assert total == 3
+    assert [item["id"] for item in items] == ["c", "b", "a"]
+    assert set(items[0]) == {"id", "name", "timestamp", "size"}
+
+    total, page = store.list(offset=1, limit=1)
+    assert total == 3 and [item["id"] for item in page] == ["b"]
+
+    assert store.get("a")["content"] == "<table>a</table>"
+    assert store.get("../a") == store.get("a")
+    assert store.get("missing") is None
+
+    assert store.delete("b")
+    assert not store.delete("b")
+    assert [item["id"] for item in store.list()[1]] == ["c", "a"]
+
+
+def test_index_only_rereads_changed_files(tmp_path):
+    store = SessionStore(str(tmp_path))
+    store.save("a", "Mine", "x", "2024-01-01 10:00:00")
+
+    reads = []
+    read = store._read
+    store._read = lambda path: reads.append(path) or read(path)
+
+    # Written by another process: picked up once, then served from the index
+    with open(tmp_path / "table_ext.json", "w") as f:
+        json.dump({"id": "ext", "name": "External", "timestamp": "2024-02-01 00:00:00", "content": "y" * 100}, f)
+    assert [item["name"] for item in store.list()[1]] == ["External", "Mine"]
+    assert store.list()[0] == 2
+    assert len(reads) == 1
+
+    # Removed behind the store's back
+    os.remove(tmp_path / "table_ext.json")
+    assert [item["id"] for item in store.list()[1]] == ["a"]
+    assert len(reads) == 1
+
+
+def test_incremental_saves_journal_and_compact(tmp_path):
+    import pytest
+    from sessions import StaleVersionError
+
+    store = SessionStore(str(tmp_path), compact_every=4)
+    put = lambda table_id, html: {"op": "put", "table_id": table_id, "html": html}
+
+    assert store.apply("s", "Doc", "2024-01-01 10:00:00", 0, [put("t1", "<a>"), put("t2", "<b>")]) == 1
+    assert store.apply("s", "Doc", "2024-01-01 10:00:01", 1, [put("t1", "<A>")]) == 2
+    assert not (tmp_path / "table_s.json").exists()
+    journal_size = (tmp_path / "table_s.journal").stat().st_size
+
+    # A delta based on an old version is rejected and nothing is written
+    with pytest.raises(StaleVersionError) as stale:
+        store.apply("s", "Doc", "2024-01-01 10:00:02", 1, [put("t2", "<lost>")])
+    assert stale.value.version == 2
+    assert (tmp_path / "table_s.journal").stat().st_size == journal_size
+
+    session = store.get("s")
+    assert session["version"] == 2 and session["tables"] == ["t1", "t2"]
+    assert session["content"] == "<A><b>"
+
+    assert store.apply("s", "Renamed", "2024-01-01 10:00:03", 2, [{"op": "remove", "table_id": "t1"}, put("t3", "<c>")]) == 3
+    assert store.apply("s", "Renamed", "2024-01-01 10:00:04", 3, [], order=["t3", "t2"]) == 4
+    # Fourth record: folded into the snapshot and the journal is gone
+    assert not (tmp_path / "table_s.journal").exists()
+    snapshot = json.loads((tmp_path / "table_s.json").read_text())
+    assert snapshot["version"] == 4 and snapshot["order"] == ["t3", "t2"]
+    assert store.get("s")["content"] == "<c><b>"
+    assert store.list()[1][0]["name"] == "Renamed"
+
+    with pytest.raises(ValueError):
+        store.apply("s", "Renamed", "2024-01-01 10:00:05", 4, [{"op": "put", "table_id": "t4"}])
+
+
+def test_journal_replay_survives_crashes_and_legacy_sessions(tmp_path):
+    store = SessionStore(str(tmp_path))
+    # Saved whole, as before incremental saves
+    store.save("s", "Old", "<div>legacy</div>", "2024-01-01 10:00:00")
+    assert store.get("s")["tables"] is None
+
+    # The first incremental save replaces the whole content with the tables it sends
+    store.apply("s", "Old", "2024-01-01 10:00:01", 1, [{"op": "put", "table_id": "t1", "html": "<a>"}], order=["t1"])
+    # A record already covered by the snapshot, then a line cut short mid-append
+    with open(tmp_path / "table_s.journal", "a") as f:
+        f.write(json.dumps({"version": 1, "ops": [{"op": "put", "table_id": "t9", "html": "<x>"}]}) + "\n")
+        f.write('{"version": 3, "ops": [{"op": "put"')
+
+    fresh = SessionStore(str(tmp_path))
+    session = fresh.get("s")
+    assert session["content"] == "<a>" and session["version"] == 2
+    assert fresh.list()[1][0]["id"] == "s"
+
+    # Saves after the torn line are not swallowed by it
+    for version, (table_id, html) in enumerate([("t2", "<b>"), ("t3", "<c>")], 2):
+        fresh.apply("s", "Old", "2024-01-01 10:00:02", version, [{"op": "put", "table_id": table_id, "html": html}])
+    session = SessionStore(str(tmp_path)).get("s")
+    assert session["content"] == "<a><b><c>" and session["version"] == 4
@@ -0,0 +1,37 @@
+import time
+
+from fastapi.testclient import TestClient
+
+
+def test_model_loads_in_background(tiny_model_path, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, "MODEL_PATH", tiny_model_path)
+    monkeypatch.setattr(main, "ocr_model", None)
+    monkeypatch.setattr(main, "model_status", {"state": "starting", "stage": None, "error": None,
+                                               "started_at": None, "load_seconds": None})
+    with TestClient(main.app) as client:
+        # Up and live straight away, ready only once loaded and warmed up
+        assert client.get("/healthz").status_code == 200
+        deadline = time.monotonic() + 120
+        while (response := client.get("/readyz")).status_code == 503 and time.monotonic() < deadline:
+            assert response.json()["state"] in ("starting", "loading")
+            time.sleep(0.1)
+        assert response.status_code == 200 and response.json()["state"] == "ready"
+        assert main.ocr_model is not None
+
+
+def test_failed_load_fails_liveness(monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, "MODEL_PATH", "/nonexistent/model")
+    monkeypatch.setattr(main, "ocr_model", None)
+    monkeypatch.setattr(main, "model_status", {"state": "starting", "stage": None, "error": None,
+                                               "started_at": None, "load_seconds": None})
+    main.load_model()
+    # No lifespan, so nothing starts loading again
+    client = TestClient(main.app)
+    assert client.get("/healthz").status_code == 503
+    assert client.get("/readyz").json()["state"] == "failed"
+    response = client.post("/ocr", files={"file": ("a.png", b"x")})
+    assert response.status_code == 503 and "failed to load" in response.json()["detail"]
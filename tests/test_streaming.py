@@ -0,0 +1,77 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from streaming import stream_in_thread
+
+
+def collect(make_iterator, **kwargs):
+    async def run():
+        return [chunk async for chunk in stream_in_thread(make_iterator, **kwargs)]
+
+    return asyncio.run(run())
+
+
+def test_fast_producer_is_coalesced():
+    tokens = [f"t{i} " for i in range(2000)]
+    chunks = collect(lambda: iter(tokens), flush_interval=0.05)
+    assert "".join(chunks) == "".join(tokens)
+    assert len(chunks) < 50
+
+
+def test_flush_bytes_caps_chunk_size():
+    def slow():
+        for _ in range(20):
+            time.sleep(0.002)
+            yield "x" * 10
+
+    chunks = collect(slow, flush_interval=10, flush_bytes=30)
+    assert "".join(chunks) == "x" * 200
+    # First chunk goes out alone, later ones are released as soon as 30 chars are waiting
+    assert chunks[0] == "x" * 10
+    assert all(len(c) < 60 for c in chunks)
+
+
+def test_error_is_raised_after_buffered_text():
+    def failing():
+        yield "partial"
+        raise RuntimeError("boom")
+
+    received = []
+
+    async def run():
+        async for chunk in stream_in_thread(failing):
+            received.append(chunk)
+
+    with pytest.raises(RuntimeError, match="boom"):
+        asyncio.run(run())
+    assert "".join(received) == "partial"
+
+
+def test_early_close_closes_iterator():
+    closed = threading.Event()
+
+    def endless():
+        try:
+            while True:
+                time.sleep(0.001)
+                yield "."
+        finally:
+            closed.set()
+
+    async def run():
+        async for _ in stream_in_thread(endless, flush_interval=0):
+            break
+
+    asyncio.run(run())
+    assert closed.wait(2)
+
+
+def test_error_creating_iterator_is_raised():
+    def broken():
+        raise ValueError("no image")
+
+    with pytest.raises(ValueError, match="no image"):
+        collect(broken)
@@ -0,0 +1,57 @@
+import json
+
+from table_events import StreamEvents, TableParser, tables_to_csv
+
+HTML = ('<table><tr><th>Name</th><th colspan="2">Value</th></tr>'
+        '<tr><td>a &amp; b</td><td>1</td><td><table><tr><td>x</td></tr></table></td></tr></table>'
+        '<p>between</p><table><tr><td>"q"</td></tr></table>')
+
+
+def test_rows_are_the_same_whatever_the_chunking():
+    whole = TableParser()
+    expected = whole.feed(HTML) + whole.close()
+    assert expected == [
+        (0, 0, ["Name", "Value", ""]),
+        (0, 1, ["a & b", "1", "x"]),
+        (1, 0, ['"q"']),
+    ]
+
+    parser = TableParser()
+    rows = []
+    for i in range(0, len(HTML), 3):
+        rows += parser.feed(HTML[i:i + 3])
+    assert rows + parser.close() == expected
+
+
+def test_row_is_emitted_as_soon_as_it_closes():
+    parser = TableParser()
+    assert parser.feed("<table><tr><td>1</td><td>2") == []
+    assert parser.feed("</td></tr><tr><td>3") == [(0, 0, ["1", "2"])]
+    # Output cut short (abort, token limit): the open row still comes out
+    assert parser.close() == [(0, 1, ["3"])]
+
+
+def test_stream_events_ndjson_and_sse():
+    events = StreamEvents("ndjson")
+    out = events.feed("<!-- Queue position: 2 -->")
+    out += events.feed("<table><tr><td>1</td></tr>")
+    out += events.feed("</table><!-- Process Aborted -->")
+    out += events.close()
+    parsed = [json.loads(line) for line in out.splitlines()]
+    assert [event["type"] for event in parsed] == ["queue", "text", "row", "text", "aborted", "done"]
+    assert parsed[0]["position"] == 2
+    assert parsed[2] == {"type": "row", "table": 0, "row": 0, "cells": ["1"]}
+    assert "".join(event["text"] for event in parsed if event["type"] == "text") == "<table><tr><td>1</td></tr></table>"
+    assert parsed[-1]["rows"] == 1
+
+    sse = StreamEvents("sse", parse_tables=False)
+    out = sse.feed("plain <!-- Error: boom -->") + sse.close()
+    assert out == ('event: text\ndata: {"type": "text", "text": "plain "}\n\n'
+                   'event: error\ndata: {"type": "error", "message": "boom"}\n\n'
+                   'event: done\ndata: {"type": "done", "rows": 0}\n\n')
+
+
+def test_tables_to_csv():
+    assert tables_to_csv(HTML) == ('"Name","Value",""\r\n"a & b","1","x"\r\n'
+                                   '\n\n--- Table 2 ---\n"""q"""\r\n')
+    assert tables_to_csv("<p>no tables</p>") is None
@@ -0,0 +1,57 @@
+import os
+import time
+
+from fastapi.testclient import TestClient
+
+from telemetry import TelemetrySampler
+
+
+def test_samples_go_to_a_bounded_ring_buffer():
+    sampler = TelemetrySampler(interval=0, history=3, jobs=lambda: ["job-1"], processes=lambda: [2**22 + 1])
+    first = sampler.sample()
+    # Keep a CPU busy so the second sample has something to measure
+    deadline = time.process_time() + 0.2
+    while time.process_time() < deadline:
+        pass
+    second = sampler.sample()
+    assert second["jobs"] == ["job-1"]
+    if os.path.exists("/proc/self/stat"):
+        # The pid that does not exist is skipped
+        assert first["process"]["rss_mb"] > 0
+        assert second["process"]["cpu_percent"] > 0
+
+    for _ in range(3):
+        sampler.sample()
+    assert len(sampler.series()) == 3
+    assert sampler.latest() is sampler.series()[-1]
+    assert sampler.series(seconds=-1) == []
+
+
+def test_background_thread_samples_until_stopped():
+    sampler = TelemetrySampler(interval=0.05, history=100)
+    sampler.start()
+    time.sleep(0.3)
+    sampler.stop()
+    count = len(sampler.samples)
+    assert count >= 2
+    time.sleep(0.1)
+    assert len(sampler.samples) == count
+
+
+def test_gpu_endpoint_serves_the_buffer(monkeypatch):
+    import main
+
+    sampler = TelemetrySampler(interval=0, history=10)
+    monkeypatch.setattr(main, "telemetry", sampler)
+    client = TestClient(main.app)
+    assert client.get("/gpu").json()["series"] == []
+
+    sampler.sample()
+    sampler.sample()
+    data = client.get("/gpu").json()
+    assert data["source"] in ("nvml", "process")
+    assert data["process"] == sampler.latest()["process"]
+    assert data["device_count"] == len(data["info"])
+    assert len(data["series"]) == 2
+    # Reading it does not take samples
+    assert len(sampler.samples) == 2
@@ -0,0 +1,42 @@
+from tiling import band_boxes, stitch_tables, stitch_text
+
+
+def test_band_boxes_cover_image_with_overlap():
+    boxes = band_boxes(600, 1000, 300, 60)
+    assert boxes[0] == (0, 0, 600, 300)
+    assert boxes[-1][3] == 1000
+    assert all(b[3] - b[1] == 300 for b in boxes)
+    for previous, current in zip(boxes, boxes[1:]):
+        assert current[1] <= previous[3] - 60
+
+    assert band_boxes(600, 200, 300, 60) == [(0, 0, 600, 200)]
+
+
+def test_stitch_text_drops_overlap_and_cut_lines():
+    parts = [
+        "Nel mezzo del cammin di nostra vita\nmi ritrovai per una selva oscura,\nché la diritta v",
+        "mi ritrovai per una selva oscura,\nché la diritta via era smarrita.\n\nAhi quanto a dir qual era è cosa dura",
+    ]
+    assert stitch_text(parts) == (
+        "Nel mezzo del cammin di nostra vita\n"
+        "mi ritrovai per una selva oscura,\n"
+        "ché la diritta via era smarrita.\n"
+        "Ahi quanto a dir qual era è cosa dura"
+    )
+
+    # Nothing shared: plain concatenation
+    assert stitch_text(["a\nb", "c\nd"]) == "a\nb\nc\nd"
+
+
+def test_stitch_tables_merges_rows_across_bands():
+    parts = [
+        "<table><tr><td>COD</td><td>kg</td></tr><tr><td>30101048</td><td>770</td></tr><tr><td>3010</td></tr></table>",
+        "<table><tr><td>30101048</td><td>770</td></tr><tr><td>30101062</td><td>936</td></tr></table>",
+    ]
+    assert stitch_tables(parts) == (
+        "<table><tr><td>COD</td><td>kg</td></tr><tr><td>30101048</td><td>770</td></tr>"
+        "<tr><td>30101062</td><td>936</td></tr></table>"
+    )
+
+    # A band that is not a table falls back to line stitching
+    assert stitch_tables(["<table><tr><td>a</td></tr></table>", "b"]) == "<table><tr><td>a</td></tr></table>\nb"
@@ -0,0 +1,51 @@
+import threading
+
+from tracing import Profiler, Trace
+
+
+def test_trace_accumulates_spans_across_threads():
+    trace = Trace()
+    with trace.span("read"):
+        pass
+    threads = [threading.Thread(target=lambda: trace.add("page_render", 0.25)) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    header = trace.server_timing()
+    assert header.startswith("read;dur=")
+    assert 'page_render;dur=500.0;desc="x2"' in header
+    assert "page_render: 500.0ms" in trace.summary()
+
+
+def test_profiler_captures_armed_requests_only(tmp_path):
+    import torch
+
+    profiler = Profiler(str(tmp_path))
+
+    def work():
+        yield str(int(torch.ones(4, 4).matmul(torch.ones(4, 4)).sum()))
+
+    # Not armed: passes straight through
+    assert list(profiler.capture(work(), "a")) == ["64"]
+    assert profiler.status()["captures"] == []
+
+    profiler.arm(1)
+    assert list(profiler.capture(work(), "b")) == ["64"]
+    assert list(profiler.capture(work(), "c")) == ["64"]
+    status = profiler.status()
+    assert status["armed"] == 0 and not status["active"]
+    assert status["captures"] == [str(tmp_path / "b.json")]
+    assert "aten::" in (tmp_path / "b.json").read_text()
+
+
+def test_profiler_falls_back_to_the_request_thread(tmp_path, monkeypatch):
+    import torch
+
+    # The all-threads config is a private binding that a torch upgrade may drop
+    monkeypatch.delattr(torch._C._profiler, "_ExperimentalConfig")
+    profiler = Profiler(str(tmp_path))
+    profiler.arm(1)
+    assert list(profiler.capture(iter(["x"]), "d")) == ["x"]
+    assert profiler.status()["captures"] == [str(tmp_path / "d.json")]
@@ -0,0 +1,209 @@
+import hashlib
+import io
+import os
+import shutil
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+from uploads import UploadStore, make_preview
+
+
+def png(seed, side=64):
+    buffer = io.BytesIO()
+    Image.new("RGB", (side, side), (seed, 0, 0)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def age(path, seconds):
+    then = time.time() - seconds
+    os.utime(path, (then, then))
+
+
+def blob_contents(store):
+    contents = set()
+    for name in os.listdir(store.blobs):
+        with open(os.path.join(store.blobs, name), "rb") as f:
+            contents.add(f.read())
+    return contents
+
+
+def test_same_upload_is_stored_once(tmp_path):
+    store = UploadStore(str(tmp_path), preview_size=32)
+    data = png(1, side=200)
+    assert store.add("s1", "f1", "scan.png", data)
+    assert store.add("s2", "f2", "SCAN.PNG", data)
+
+    first, second = tmp_path / "s1" / "f1.png", tmp_path / "s2" / "f2.png"
+    assert first.read_bytes() == data
+    assert os.path.samefile(first, second)
+    assert store.stats()["stored"] == 1 and store.stats()["deduplicated"] == 1
+
+    preview = Image.open(tmp_path / "s2" / "f2.preview.jpg")
+    assert preview.format == "JPEG" and max(preview.size) == 32
+
+    # A document gets no preview, a session id cannot name a path or the store
+    assert store.add("s3", "f3", "doc.pdf", b"%PDF-1.4", preview=False)
+    assert not (tmp_path / "s3" / "f3.preview.jpg").exists()
+    for bad in ("", ".store", "../.store"):
+        with pytest.raises(ValueError):
+            store.session_dir(bad)
+
+
+def test_store_requires_hardlinks(tmp_path, monkeypatch):
+    # A copy in place of a link would leave its blob looking unreferenced
+    def no_links(source, target):
+        raise OSError("Invalid cross-device link")
+
+    monkeypatch.setattr(os, "link", no_links)
+    with pytest.raises(RuntimeError):
+        UploadStore(str(tmp_path))
+    assert os.listdir(os.path.join(tmp_path, ".store", "blobs")) == []
+
+
+def test_concurrent_uploads_keep_the_quota_and_their_references(tmp_path):
+    same = png(1, side=200)
+    distinct = [png(i, side=200) for i in range(2, 10)]
+    store = UploadStore(str(tmp_path), preview_size=32)
+    # Room for two uploads, so the others evict each other's blobs while they run
+    store.quota_bytes = 2 * (len(same) + len(make_preview(same, 32)))
+    uploads = [(f"same{i}", same) for i in range(8)] + [(f"new{i}", data) for i, data in enumerate(distinct)]
+    kept = {}
+    write = store._write
+
+    def slow_write(path, data):
+        # Writes take long enough for the uploads to overlap
+        time.sleep(0.02)
+        write(path, data)
+
+    store._write = slow_write
+
+    def add(session_id, data):
+        kept[session_id] = store.add(session_id, "f", "a.png", data)
+
+    threads = [threading.Thread(target=add, args=upload) for upload in uploads]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Every upload reported as kept is there whole; the same content was written and counted once
+    for session_id, data in uploads:
+        if kept[session_id]:
+            assert (tmp_path / session_id / "f.png").read_bytes() == data
+    on_disk = sum(entry.stat().st_size for directory in (store.blobs, store.previews)
+                  for entry in os.scandir(directory))
+    assert store.bytes == on_disk <= store.quota_bytes
+    stats = store.stats()
+    assert stats["stored"] + stats["deduplicated"] + stats["rejected"] == len(uploads)
+
+
+def test_quota_evicts_unreferenced_least_recent_first(tmp_path):
+    blobs = [png(i, side=300) for i in range(3)]
+    store = UploadStore(str(tmp_path), preview_size=16)
+    for i, data in enumerate(blobs[:2]):
+        store.add(f"s{i}", "f", "a.png", data)
+    # One byte short of room for the third upload and its preview
+    store.quota_bytes = store.bytes + len(blobs[2]) + len(make_preview(blobs[2], 16)) - 1
+    # Both sessions deleted; the first one's upload was referenced longest ago
+    shutil.rmtree(tmp_path / "s0")
+    shutil.rmtree(tmp_path / "s1")
+    for name in os.listdir(store.blobs):
+        path = os.path.join(store.blobs, name)
+        with open(path, "rb") as f:
+            age(path, 100 if f.read() == blobs[0] else 50)
+
+    assert store.add("s2", "f", "a.png", blobs[2])
+    assert store.stats()["evicted"] == 1
+    assert blob_contents(store) == {blobs[1], blobs[2]}
+    assert store.bytes <= store.quota_bytes
+
+    # Only referenced uploads left and no room: not kept, nothing else lost
+    store.add("s3", "f", "a.png", blobs[1])
+    assert not store.add("s4", "f", "a.png", png(9, side=600))
+    assert store.stats()["rejected"] == 1
+    assert not (tmp_path / "s4" / "f.png").exists()
+    assert (tmp_path / "s2" / "f.png").read_bytes() == blobs[2]
+
+
+def test_sweep_expires_unsaved_sessions_then_their_uploads(tmp_path):
+    saved = {"kept"}
+    store = UploadStore(str(tmp_path), ttl=60, is_saved=lambda session_id: session_id in saved)
+    store.add("kept", "f", "a.png", png(1))
+    store.add("abandoned", "f", "a.png", png(2))
+    store.add("fresh", "f", "a.png", png(3))
+    for session in ("kept", "abandoned"):
+        age(tmp_path / session, 120)
+
+    store.sweep()
+    assert sorted(name for name in os.listdir(tmp_path) if not name.startswith(".")) == ["fresh", "kept"]
+    # The abandoned upload was referenced recently, so it outlives its session for now
+    assert len(os.listdir(store.blobs)) == 3
+
+    for name in os.listdir(store.blobs):
+        age(os.path.join(store.blobs, name), 120)
+    store.sweep()
+    assert blob_contents(store) == {png(1), png(3)}
+    assert len(os.listdir(store.previews)) == 2
+    assert store.stats()["sessions_expired"] == 1 and store.stats()["expired"] == 1
+
+    # Restarting finds the same usage on disk
+    assert UploadStore(str(tmp_path)).bytes == store.bytes
+
+
+def test_ocr_upload_is_served_with_a_preview(tiny_model_path, tmp_path, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    import main
+    from cache import ResultCache
+    from glm import GLMOCR
+    from sessions import SessionStore
+
+    # Everything the request writes lands under tmp_path, the mount included
+    uploads = str(tmp_path / "uploads")
+    monkeypatch.setattr(main, "UPLOAD_DIR", uploads)
+    monkeypatch.setattr(main, "upload_store", UploadStore(uploads))
+    monkeypatch.setattr(main, "result_cache", ResultCache(str(tmp_path / "ocr_cache")))
+    monkeypatch.setattr(main, "session_store", SessionStore(str(tmp_path / "data")))
+    mount = next(route for route in main.app.routes if getattr(route, "name", None) == "uploads")
+    monkeypatch.setattr(mount.app, "all_directories", [uploads])
+    monkeypatch.setattr(main, "ocr_model", GLMOCR(tiny_model_path, device="cpu", max_new_tokens=4))
+    client = TestClient(main.app)
+    data = png(5, side=2000)
+    # One digest per request serves the result cache, the vision cache and the upload store
+    sha256, hashed = hashlib.sha256, []
+
+    def counting_sha256(content=b"", **kwargs):
+        if content == data:
+            hashed.append(len(content))
+        return sha256(content, **kwargs)
+
+    monkeypatch.setattr(hashlib, "sha256", counting_sha256)
+    responses = [client.post("/ocr", files={"file": ("big.png", data)}, data={"session_id": session, "type": "text",
+                                                                                "no_cache": "true"})
+                 for session in ("upload-a", "upload-b")]
+    assert client.post("/ocr", files={"file": ("a.png", data)}, data={"session_id": ".store"}).status_code == 400
+
+    for response in responses:
+        assert response.status_code == 200
+        deadline = time.monotonic() + 10
+        # Stored in the background
+        while client.get(response.headers["X-Preview-URL"]).status_code != 200 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert client.get(response.headers["X-Image-URL"]).content == data
+        preview = Image.open(io.BytesIO(client.get(response.headers["X-Preview-URL"]).content))
+        assert max(preview.size) == main.upload_store.preview_size
+    image_a, image_b = (os.path.join(main.UPLOAD_DIR, response.headers["X-Image-URL"][len("/uploads/"):])
+                        for response in responses)
+    assert os.path.samefile(image_a, image_b)
+    assert len(hashed) == len(responses)
+    # Sessions' references are served, the store behind them is not
+    digest = hashlib.sha256(data).hexdigest()
+    assert os.path.exists(os.path.join(main.upload_store.blobs, digest))
+    for path in (f"/uploads/.store/blobs/{digest}", f"/uploads/.store/previews/{digest}.jpg",
+                 f"/uploads/upload-a/../.store/blobs/{digest}"):
+        assert client.get(path).status_code == 404
+    for session in ("upload-a", "upload-b"):
+        client.delete(f"/session/{session}")
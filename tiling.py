@@ -0,0 +1,79 @@
+import re
+
+_ROW = re.compile(r"<tr\b.*?</tr>", re.IGNORECASE | re.DOTALL)
+_TAG = re.compile(r"<[^>]+>")
+
+
+def band_boxes(width, height, band_height, overlap):
+    """Crop boxes (left, top, right, bottom) for full-width bands that overlap by `overlap` pixels."""
+    if band_height >= height:
+        return [(0, 0, width, height)]
+    overlap = min(overlap, band_height // 2)
+    step = band_height - overlap
+    boxes = []
+    top = 0
+    while True:
+        bottom = min(top + band_height, height)
+        # A thin remainder gets folded into the previous band's reach instead
+        boxes.append((0, max(0, bottom - band_height), width, bottom))
+        if bottom >= height:
+            return boxes
+        top += step
+
+
+def _normalize(item):
+    return " ".join(_TAG.sub(" ", item).split()).lower()
+
+
+def _dedupe(previous, current, max_skip=1):
+    """Drop the part of `current` that repeats the end of `previous`.
+
+    Looks for the longest run of items shared by the end of `previous` and
+    the start of `current`, allowing up to `max_skip` items around the band
+    seam to differ (a line cut in half by the crop reads differently in the
+    two bands). Returns (items of `previous` to keep, items of `current` to append).
+    """
+    a = [_normalize(item) for item in previous]
+    b = [_normalize(item) for item in current]
+    best = None
+    for skip_a in range(max_skip + 1):
+        for skip_b in range(max_skip + 1):
+            end = len(a) - skip_a
+            for k in range(min(end, len(b) - skip_b), 0, -1):
+                if a[end - k:end] == b[skip_b:skip_b + k] and any(a[end - k:end]):
+                    if best is None or k > best[0]:
+                        best = (k, skip_a, skip_b)
+                    break
+    if best is None:
+        return previous, current
+    k, skip_a, skip_b = best
+    # The complete copy of a cut line sits in the band that saw it whole; keep the later one
+    return previous[:len(previous) - skip_a], current[skip_b + k:]
+
+
+def stitch_text(parts):
+    lines = []
+    for part in parts:
+        new = [line for line in part.splitlines() if line.strip()]
+        lines, new = _dedupe(lines, new)
+        lines.extend(new)
+    return "\n".join(lines)
+
+
+def stitch_tables(parts):
+    """Merge per-band HTML tables into one, dropping rows repeated across band overlaps.
+
+    Falls back to line stitching when a band did not come back as a table.
+    """
+    band_rows = [_ROW.findall(part) for part in parts]
+    if not all(band_rows):
+        return stitch_text(parts)
+    rows = []
+    for new in band_rows:
+        rows, new = _dedupe(rows, new)
+        rows.extend(new)
+    # Keep whatever wraps the rows in the first band (e.g. <table border="1">)
+    first = parts[0]
+    start = first.find(band_rows[0][0])
+    end = first.rfind(band_rows[0][-1]) + len(band_rows[0][-1])
+    return first[:start] + "".join(rows) + first[end:]
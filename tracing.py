@@ -0,0 +1,150 @@
+"""Per-request stage timings and on-demand torch profiler captures."""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+
+
+class Trace:
+    """Wall-clock time per named stage of one request.
+
+    Spans may be opened from any thread; a stage timed more than once (e.g.
+    once per PDF page) accumulates. Each span is also a `record_function`
+    range, so stages show up by name in profiler captures. Marks note how the
+    request ran where that decides what happens to its result, e.g. that its
+    KV cache was degraded and the output is not worth caching.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = {}
+        self.marks = set()
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            with torch.profiler.record_function(name):
+                yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds, count=1):
+        with self.lock:
+            total, previous = self.spans.get(name, (0.0, 0))
+            self.spans[name] = (total + seconds, previous + count)
+
+    def mark(self, name):
+        with self.lock:
+            self.marks.add(name)
+
+    def server_timing(self):
+        """The spans as a `Server-Timing` header value, in milliseconds."""
+        with self.lock:
+            spans = list(self.spans.items())
+        entries = []
+        for name, (seconds, count) in spans:
+            entry = f"{name};dur={seconds * 1000:.1f}"
+            if count > 1:
+                entry += f';desc="x{count}"'
+            entries.append(entry)
+        return ", ".join(entries)
+
+    def summary(self):
+        with self.lock:
+            spans = list(self.spans.items())
+        return " | ".join(f"{name}: {seconds * 1000:.1f}ms" for name, (seconds, _) in spans)
+
+
+class Profiler:
+    """Arms `torch.profiler` for the next N requests.
+
+    Only one capture runs at a time (the profiler is process-wide); requests
+    arriving while a capture is running are not profiled and do not use up
+    the armed count. Each capture is written as a Chrome trace
+    (chrome://tracing, Perfetto) to `directory`. Where torch supports it all
+    threads are recorded, which takes in the shared batch loop and any
+    concurrent requests; otherwise only the stream worker thread is.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.armed = 0
+        self.active = False
+        self.captures = []
+
+    def arm(self, requests):
+        with self.lock:
+            self.armed = max(0, requests)
+            return self.armed
+
+    def _claim(self):
+        with self.lock:
+            if not self.armed or self.active:
+                return False
+            self.armed -= 1
+            self.active = True
+            return True
+
+    def status(self):
+        with self.lock:
+            return {"armed": self.armed, "active": self.active, "captures": list(self.captures)}
+
+    @staticmethod
+    def _start():
+        """A started profiler, recording every thread where this torch build allows it."""
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        # All-threads capture only exists as an unversioned private binding: used when present and working
+        experimental = getattr(getattr(torch._C, "_profiler", None), "_ExperimentalConfig", None)
+        if experimental is not None:
+            try:
+                profiler = torch.profiler.profile(activities=activities,
+                                                  experimental_config=experimental(profile_all_threads=True))
+                profiler.start()
+                return profiler
+            except Exception as e:
+                print(f"Profiling the request thread only: {e}")
+        profiler = torch.profiler.profile(activities=activities)
+        profiler.start()
+        return profiler
+
+    def capture(self, iterator, name):
+        """Iterate `iterator`, under the profiler if it is armed and free.
+
+        The trace is written to `<directory>/<name>.json` once the iterator
+        ends. The profiler is started and stopped on the thread consuming the
+        iterator, which is the one doing the request's preprocessing.
+        """
+        if not self._claim():
+            yield from iterator
+            return
+
+        try:
+            profiler = self._start()
+        except Exception as e:
+            print(f"Failed to start the profiler: {e}")
+            with self.lock:
+                self.active = False
+            yield from iterator
+            return
+
+        path = os.path.join(self.directory, f"{name}.json")
+        try:
+            yield from iterator
+        finally:
+            try:
+                profiler.stop()
+                os.makedirs(self.directory, exist_ok=True)
+                profiler.export_chrome_trace(path)
+                print(f"Profiler trace written to {path}")
+                with self.lock:
+                    self.captures.append(path)
+            except Exception as e:
+                print(f"Failed to write profiler trace {path}: {e}")
+            with self.lock:
+                self.active = False
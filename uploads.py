@@ -0,0 +1,235 @@
+"""Content-addressed store for uploaded images, bounded by a disk quota.
+
+Each distinct upload is kept once, as `.store/blobs/<sha256>` under
+the uploads directory, with a downscaled JPEG preview next to it in
+`.store/previews/`. A session refers to an upload through hardlinks at the
+URLs the web client already uses, `<session id>/<file id>.<ext>` and
+`<session id>/<file id>.preview.jpg`. The same scan in ten sessions takes
+the space once, deleting a session directory drops its references, and a
+blob whose link count is back to 1 is unreferenced. Link counts being the
+reference counts, the store refuses to start where it cannot hardlink into
+the session directories.
+
+Unreferenced blobs are removed once they have not been referenced for
+`ttl` seconds, and sooner, least recently referenced first, whenever the
+store is over `quota_bytes`. Session directories whose session was never
+saved are dropped after the same `ttl`. `sweep()` does both and runs on a
+background thread every `sweep_interval` seconds. When referenced blobs
+alone fill the quota, new uploads are not kept: OCR still runs, the image
+is just not viewable later. Safe to call from worker threads.
+"""
+import hashlib
+import io
+import os
+import re
+import shutil
+import threading
+import time
+
+from PIL import Image, ImageOps
+
+STORE = ".store"
+
+
+def _extension(filename):
+    extension = re.sub(r"[^a-z0-9]", "", filename.rsplit(".", 1)[-1].lower())[:8] if "." in filename else ""
+    return extension or "bin"
+
+
+def make_preview(data, max_side):
+    """JPEG bytes of the image scaled to fit `max_side`, or None when it cannot be decoded."""
+    try:
+        image = Image.open(io.BytesIO(data))
+        # JPEGs decode straight at a reduced DCT scale
+        image.draft("RGB", (max_side, max_side))
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        image.thumbnail((max_side, max_side), Image.BICUBIC)
+    except Exception:
+        return None
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=80, optimize=True)
+    return buffer.getvalue()
+
+
+class UploadStore:
+    def __init__(self, root, quota_bytes=2 * 1024**3, ttl=7 * 86400, preview_size=1280, sweep_interval=600,
+                 is_saved=None):
+        self.root = root
+        self.blobs = os.path.join(root, STORE, "blobs")
+        self.previews = os.path.join(root, STORE, "previews")
+        self.quota_bytes = quota_bytes
+        self.ttl = ttl
+        self.preview_size = preview_size
+        self.sweep_interval = sweep_interval
+        # session id -> whether it was saved; unsaved session directories expire
+        self.is_saved = is_saved or (lambda session_id: True)
+        self.lock = threading.Lock()
+        self.counters = {"stored": 0, "deduplicated": 0, "rejected": 0, "evicted": 0, "expired": 0,
+                         "sessions_expired": 0}
+        self.stop_event = threading.Event()
+        self.thread = None
+        os.makedirs(self.blobs, exist_ok=True)
+        os.makedirs(self.previews, exist_ok=True)
+        self._check_hardlinks()
+        for directory in (self.blobs, self.previews):
+            for entry in os.scandir(directory):
+                if entry.name.endswith(".tmp"):
+                    # Left by a crash mid-write
+                    os.remove(entry.path)
+        self.bytes = sum(entry.stat().st_size for directory in (self.blobs, self.previews)
+                         for entry in os.scandir(directory))
+
+    def session_dir(self, session_id):
+        # Ids come from request forms: never let one name a path or the store itself
+        session_id = os.path.basename(session_id)
+        if not session_id or session_id.startswith("."):
+            raise ValueError(f"Invalid session id {session_id!r}")
+        return os.path.join(self.root, session_id)
+
+    def reference_names(self, file_id, filename):
+        """File names of an upload's reference and preview inside its session directory."""
+        return f"{file_id}.{_extension(filename)}", f"{file_id}.preview.jpg"
+
+    def _preview_path(self, digest):
+        return os.path.join(self.previews, f"{digest}.jpg")
+
+    def _check_hardlinks(self):
+        """Refuse to run where the store cannot hardlink into session directories.
+
+        Link counts are the reference counts: a copy instead of a link would
+        leave its blob looking unreferenced, to be evicted while still in use.
+        """
+        probe = os.path.join(self.blobs, f".probe.{os.getpid()}.tmp")
+        target = os.path.join(self.root, f".probe.{os.getpid()}.tmp")
+        with open(probe, "wb"):
+            pass
+        try:
+            os.link(probe, target)
+            os.remove(target)
+        except OSError as e:
+            raise RuntimeError(f"Uploads need hardlinks from {self.blobs} into {self.root} "
+                               f"(one filesystem that supports them): {e}") from e
+        finally:
+            os.remove(probe)
+
+    def _link(self, source, target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(source, target)
+        except FileExistsError:
+            pass
+
+    def _write(self, path, data):
+        temporary = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(data)
+        os.replace(temporary, path)
+
+    def add(self, session_id, file_id, filename, data, preview=True, digest=None):
+        """Store `data` once and reference it from the session; returns False when over quota.
+
+        `digest` is the SHA-256 hex digest of `data` when the caller already has it.
+        """
+        directory = self.session_dir(session_id)
+        reference, preview_reference = self.reference_names(file_id, filename)
+        digest = digest or hashlib.sha256(data).hexdigest()
+        blob = os.path.join(self.blobs, digest)
+        preview_path = self._preview_path(digest)
+        with self.lock:
+            # Created and linked in one step: a blob no session links to yet is fair game for
+            # eviction, and a concurrent upload of the same content must find it whole
+            if os.path.exists(blob):
+                # Referenced again: this is what LRU order and the TTL go by
+                os.utime(blob)
+                self.counters["deduplicated"] += 1
+            elif self._make_room(len(data)):
+                self._write(blob, data)
+                self.bytes += len(data)
+                self.counters["stored"] += 1
+            else:
+                self.counters["rejected"] += 1
+                print(f"[UPLOADS] Over quota, not keeping {filename} ({len(data)} bytes)")
+                return False
+            self._link(blob, os.path.join(directory, reference))
+            has_preview = os.path.exists(preview_path)
+        if preview and not has_preview:
+            # Encoded outside the lock, the slow part; stored only if no one got there first
+            encoded = make_preview(data, self.preview_size)
+            with self.lock:
+                if (encoded is not None and os.path.exists(blob) and not os.path.exists(preview_path)
+                        and self._make_room(len(encoded))):
+                    self._write(preview_path, encoded)
+                    self.bytes += len(encoded)
+        with self.lock:
+            if os.path.exists(preview_path) and os.path.exists(blob):
+                self._link(preview_path, os.path.join(directory, preview_reference))
+        return True
+
+    def _unreferenced(self):
+        """(mtime, path, size) of blobs no session links to, least recently referenced first."""
+        entries = []
+        for entry in os.scandir(self.blobs):
+            if entry.name.endswith(".tmp"):
+                continue
+            stat = entry.stat()
+            if stat.st_nlink <= 1:
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return sorted(entries)
+
+    def _remove_blob(self, path, size):
+        os.remove(path)
+        self.bytes -= size
+        preview = self._preview_path(os.path.basename(path))
+        try:
+            self.bytes -= os.stat(preview).st_size
+            os.remove(preview)
+        except FileNotFoundError:
+            pass
+
+    def _make_room(self, size):
+        if self.bytes + size <= self.quota_bytes:
+            return True
+        for _, path, blob_size in self._unreferenced():
+            self._remove_blob(path, blob_size)
+            self.counters["evicted"] += 1
+            if self.bytes + size <= self.quota_bytes:
+                return True
+        return False
+
+    def sweep(self):
+        now = time.time()
+        for entry in os.scandir(self.root):
+            if entry.name == STORE or not entry.is_dir():
+                continue
+            if now - entry.stat().st_mtime > self.ttl and not self.is_saved(entry.name):
+                shutil.rmtree(entry.path, ignore_errors=True)
+                with self.lock:
+                    self.counters["sessions_expired"] += 1
+        with self.lock:
+            for mtime, path, size in self._unreferenced():
+                if now - mtime <= self.ttl:
+                    break
+                self._remove_blob(path, size)
+                self.counters["expired"] += 1
+            self._make_room(0)
+
+    def _run(self):
+        while not self.stop_event.wait(self.sweep_interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"[UPLOADS] Sweep failed: {e}")
+
+    def start(self):
+        if self.thread is None and self.sweep_interval > 0:
+            self.thread = threading.Thread(target=self._run, name="upload-sweeper", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+
+    def stats(self):
+        with self.lock:
+            return {"bytes": self.bytes, "quota_bytes": self.quota_bytes, **self.counters}